@@ -2,8 +2,20 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request,
 from flask_login import login_required, current_user
 from extensions import db
 from models import User, Affiliate, Referral, Treatment, Treatment_Status, TreatmentGroup, APIKey, Ticket, TicketResponse, Notification, Webhook, TreatmentNameMapping
-from analytics import get_conversion_metrics, get_top_affiliates, get_country_stats
+from analytics import get_conversion_metrics, get_top_affiliates, get_country_stats, get_country_summary, count_referrals
 from email_service import send_verification_email, send_welcome_email, send_referral_notification, send_approval_notification
+from api_auth import key_cache
+from mapping_resolver import treatment_name_resolver
+from webhook_service import trigger_webhook_event, trigger_webhook_events
+from commission_service import recalculate_commissions
+from loader_profiles import loader_profile, serializing
+from db_routing import read_only
+import referral_service
+import crm_import
+import usage_service
+from compression import compress_response
+from metrics import registry as metrics_registry
+import hmac
 from functools import wraps
 from datetime import datetime, timedelta
 from decimal import Decimal, InvalidOperation
@@ -12,7 +24,6 @@ import secrets
 import csv
 import io
 from werkzeug.utils import secure_filename
-from sqlalchemy.sql import extract
 from countries import COUNTRIES
 import psutil
 import platform
@@ -21,6 +32,7 @@ import os
 from sqlalchemy.sql import text
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
+bp.after_request(compress_response)
 
 def admin_required(f):
     @wraps(f)
@@ -31,49 +43,54 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def _recalculation_message(summary):
+    """Flash text for a recalculate_commissions summary"""
+    if not summary['referrals_updated']:
+        return 'No commissions needed recalculating.'
+    return (f"Recalculated {summary['referrals_updated']} commission(s) for "
+            f"{summary['affiliates_updated']} affiliate(s), earnings change {summary['total_delta']:+.2f}.")
+
 @bp.route('/dashboard')
 @login_required
 @admin_required
+@read_only
 def dashboard():
     analytics = get_conversion_metrics()
     top_affiliates = get_top_affiliates()
     country_stats = get_country_stats()
     
     # Get total referrals count
-    total_referrals = Referral.query.count()
-    
-    # Calculate this month's referrals and growth
-    current_month = datetime.utcnow().month
-    current_year = datetime.utcnow().year
+    total_referrals = analytics['total_referrals']
     
-    this_month_referrals = Referral.query.filter(
-        extract('month', Referral.created_at) == current_month,
-        extract('year', Referral.created_at) == current_year
-    ).count()
+    # Calculate this month's referrals and growth from the daily rollup
+    this_month_start = datetime.utcnow().date().replace(day=1)
+    last_month_start = (this_month_start - timedelta(days=1)).replace(day=1)
     
-    last_month_referrals = Referral.query.filter(
-        extract('month', Referral.created_at) == (current_month - 1 if current_month > 1 else 12),
-        extract('year', Referral.created_at) == (current_year if current_month > 1 else current_year - 1)
-    ).count()
+    this_month_referrals = count_referrals(start=this_month_start)
+    last_month_referrals = count_referrals(start=last_month_start, end=this_month_start)
     
     monthly_growth = ((this_month_referrals - last_month_referrals) / last_month_referrals * 100) if last_month_referrals > 0 else 0
     
     affiliates = Affiliate.query.all()
     pending_affiliates = Affiliate.query.filter_by(approved=False).all()
-    referrals = Referral.query.order_by(Referral.created_at.desc()).all()
+    # Only the ten most recent are shown (admin/_recent_referrals.html)
+    referrals = Referral.query.options(*loader_profile('admin_referrals')).order_by(
+        Referral.created_at.desc()
+    ).limit(10).all()
     treatments = Treatment.query.filter_by(active=True).all()
     
-    return render_template('admin/dashboard.html',
-                         analytics=analytics,
-                         top_affiliates=top_affiliates,
-                         country_stats=country_stats,
-                         affiliates=affiliates,
-                         pending_affiliates=pending_affiliates,
-                         referrals=referrals,
-                         treatments=treatments,
-                         total_referrals=total_referrals,
-                         monthly_growth=round(monthly_growth, 1),
-                         countries=COUNTRIES)
+    with serializing('admin.dashboard'):
+        return render_template('admin/dashboard.html',
+                             analytics=analytics,
+                             top_affiliates=top_affiliates,
+                             country_stats=country_stats,
+                             affiliates=affiliates,
+                             pending_affiliates=pending_affiliates,
+                             referrals=referrals,
+                             treatments=treatments,
+                             total_referrals=total_referrals,
+                             monthly_growth=round(monthly_growth, 1),
+                             countries=COUNTRIES)
 
 @bp.route('/treatment-groups')
 @login_required
@@ -125,15 +142,11 @@ def edit_treatment_group(id):
         group.description = request.form.get('description')
         group.commission_amount = commission_amount
         
-        # Recalculate commissions for all referrals in this group's treatments
-        for treatment in group.treatments:
-            for referral in treatment.referrals:
-                if referral.status == 'completed':
-                    referral.calculate_and_update_commission()
-                    referral.affiliate.update_earnings()
+        # Reprice completed referrals in this group's treatments in one statement
+        summary = recalculate_commissions(group_ids=[group.id])
         
         db.session.commit()
-        flash('Treatment group updated successfully.', 'success')
+        flash(f'Treatment group updated successfully. {_recalculation_message(summary)}', 'success')
     except (ValueError, InvalidOperation):
         flash('Invalid commission amount.', 'danger')
     except Exception as e:
@@ -155,16 +168,12 @@ def update_commission_rate(id):
         # Update commission rate and recalculate earnings
         affiliate.commission_rate = commission_rate
         
-        # Recalculate commissions for all completed referrals
-        for referral in affiliate.referrals:
-            if referral.status == 'completed':
-                referral.calculate_and_update_commission()
-        
-        # Update total earnings
-        affiliate.update_earnings()
+        # Reprice this affiliate's completed referrals; the commission ledger
+        # keeps total earnings in step
+        summary = recalculate_commissions(affiliate_ids=[affiliate.id])
         
         db.session.commit()
-        flash('Commission rate updated successfully.', 'success')
+        flash(f'Commission rate updated successfully. {_recalculation_message(summary)}', 'success')
     except (ValueError, InvalidOperation):
         flash('Invalid commission rate.', 'danger')
     except Exception as e:
@@ -211,14 +220,12 @@ def edit_treatment(id):
     treatment.group_id = request.form.get('group_id')
     
     # Recalculate commissions if group changed
-    if treatment.group_id and treatment.referrals:
-        for referral in treatment.referrals:
-            if referral.status == 'completed':
-                referral.calculate_and_update_commission()
-                referral.affiliate.update_earnings()
+    message = ''
+    if treatment.group_id:
+        message = _recalculation_message(recalculate_commissions(treatment_ids=[treatment.id]))
     
     db.session.commit()
-    flash('Treatment updated successfully.', 'success')
+    flash(f'Treatment updated successfully. {message}'.strip(), 'success')
     return redirect(url_for('admin.manage_treatments'))
 
 @bp.route('/treatment/<int:id>/toggle', methods=['POST'])
@@ -285,6 +292,7 @@ def update_treatment_status(id):
 @bp.route('/analytics')
 @login_required
 @admin_required
+@read_only
 def get_analytics():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
@@ -374,8 +382,19 @@ def affiliate_details(id):
 @login_required
 @admin_required
 def manage_api_keys():
+    return _render_api_keys()
+
+def _render_api_keys(new_key=None):
     api_keys = APIKey.query.filter_by(user_id=current_user.id).order_by(APIKey.created_at.desc()).all()
-    return render_template('admin/api_keys.html', api_keys=api_keys)
+    key_ids = [key.id for key in api_keys]
+    chart = usage_service.usage_chart_data(key_ids)
+    chart['names'] = {key.id: key.name for key in api_keys}
+    return render_template('admin/api_keys.html',
+                         api_keys=api_keys,
+                         new_key=new_key,
+                         usage_totals=usage_service.usage_totals(key_ids),
+                         quotas={key.id: usage_service.get_quota(key.rate_limit_tier) for key in api_keys},
+                         usage_chart=chart)
 
 @bp.route('/api-key/create', methods=['POST'])
 @login_required
@@ -388,12 +407,16 @@ def create_api_key():
     
     try:
         api_key = current_user.generate_api_key(name)
-        flash('API key created successfully', 'success')
     except Exception as e:
         logging.error(f"Error creating API key: {str(e)}")
         flash('Could not create API key', 'danger')
-    
-    return redirect(url_for('admin.manage_api_keys'))
+        return redirect(url_for('admin.manage_api_keys'))
+
+    # The plaintext only ever appears in this response; it is never stored or put in the session cookie
+    flash('API key created successfully. Copy it now, it will not be shown again', 'success')
+    response = Response(_render_api_keys(new_key=api_key.plaintext))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @bp.route('/api-key/<int:key_id>/revoke', methods=['POST'])
 @login_required
@@ -406,6 +429,7 @@ def revoke_api_key(key_id):
     
     key.is_active = False
     db.session.commit()
+    key_cache.invalidate_key(key.id)
     flash('API key revoked successfully', 'success')
     return redirect(url_for('admin.manage_api_keys'))
 
@@ -453,6 +477,7 @@ def edit_user(id):
     
     try:
         db.session.commit()
+        key_cache.invalidate_user(user.id)
         flash('User updated successfully.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -474,6 +499,7 @@ def delete_user(id):
     try:
         db.session.delete(user)
         db.session.commit()
+        key_cache.invalidate_user(id)
         flash('User deleted successfully.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -543,6 +569,7 @@ def reply_ticket(id):
 @bp.route('/api/referral-heatmap')
 @login_required
 @admin_required
+@read_only
 def referral_heatmap_data():
     # Get filter parameters
     days = request.args.get('days', 'all')
@@ -563,7 +590,14 @@ def referral_heatmap_data():
     if status != 'all':
         query = query.filter(Referral.status == status)
     
-    referrals = query.all()
+    # Only the columns the map needs, not full referral objects
+    referrals = query.with_entities(
+        Referral.latitude,
+        Referral.longitude,
+        Referral.status,
+        Referral.commission_amount,
+        Referral.created_at
+    ).all()
     
     # Calculate intensity based on status and recency
     def calculate_intensity(referral):
@@ -660,8 +694,9 @@ def mark_all_notifications_read():
 @login_required
 @admin_required
 def manage_referrals():
-    referrals = Referral.query.order_by(Referral.created_at.desc()).all()
-    return render_template('admin/referrals.html', referrals=referrals)
+    referrals = Referral.query.options(*loader_profile('admin_referrals')).order_by(Referral.created_at.desc()).all()
+    with serializing('admin.manage_referrals'):
+        return render_template('admin/referrals.html', referrals=referrals)
 
 @bp.route('/referral/<int:id>/status', methods=['POST'])
 @login_required
@@ -694,6 +729,39 @@ def update_referral_status(id):
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+@bp.route('/referrals/status', methods=['POST'])
+@login_required
+@admin_required
+def bulk_update_referral_status():
+    ids, new_status, error = referral_service.parse_transition_request(request.get_json(silent=True))
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    
+    try:
+        results, transitions = referral_service.bulk_transition_referrals(ids, new_status)
+    except Exception as e:
+        logging.error(f"Error in bulk referral status update: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)})
+    
+    # Trigger webhooks for every referral that actually changed
+    affiliate_users = dict(db.session.query(Affiliate.id, Affiliate.user_id).filter(
+        Affiliate.id.in_({transition['affiliate_id'] for transition in transitions})
+    ))
+    events = []
+    for transition in transitions:
+        webhook_data = {
+            'id': transition['id'],
+            'old_status': transition['old_status'],
+            'new_status': transition['new_status'],
+            'affiliate_id': transition['affiliate_id'],
+            'treatment_id': transition['treatment_id']
+        }
+        event_type = 'referral.completed' if transition['new_status'] == 'completed' else 'referral.updated'
+        events.append((event_type, webhook_data, affiliate_users.get(transition['affiliate_id'])))
+    trigger_webhook_events(events)
+    
+    return jsonify({'success': True, 'updated': len(transitions), 'results': results})
+
 @bp.route('/referral/<int:id>/notes', methods=['POST'])
 @login_required
 @admin_required
@@ -718,20 +786,23 @@ def update_referral_notes(id):
 @login_required
 @admin_required
 def get_affiliate_referrals(affiliate_id):
-    referrals = Referral.query.filter_by(affiliate_id=affiliate_id).order_by(Referral.created_at.desc()).all()
-    return jsonify([{
-        'id': r.id,
-        'created_at': r.created_at.strftime('%Y-%m-%d'),
-        'name': r.name,
-        'surname': r.surname,
-        'email': r.email,
-        'phone': r.phone,
-        'treatment_name': r.treatment.name,
-        'status': r.status,
-        'country': r.country,
-        'city': r.city,
-        'notes': r.treatment_status.notes if r.treatment_status else ''
-    } for r in referrals])
+    referrals = Referral.query.filter_by(affiliate_id=affiliate_id).options(
+        *loader_profile('affiliate_referrals')
+    ).order_by(Referral.created_at.desc()).all()
+    with serializing('admin.get_affiliate_referrals'):
+        return jsonify([{
+            'id': r.id,
+            'created_at': r.created_at.strftime('%Y-%m-%d'),
+            'name': r.name,
+            'surname': r.surname,
+            'email': r.email,
+            'phone': r.phone,
+            'treatment_name': r.treatment.name,
+            'status': r.status,
+            'country': r.country,
+            'city': r.city,
+            'notes': r.treatment_status.notes if r.treatment_status else ''
+        } for r in referrals])
 
 @bp.route('/webhooks')
 @login_required
@@ -825,6 +896,7 @@ def create_treatment_mapping():
     try:
         db.session.add(mapping)
         db.session.commit()
+        treatment_name_resolver.invalidate()
         flash('Mapping created successfully', 'success')
     except Exception as e:
         db.session.rollback()
@@ -843,6 +915,7 @@ def edit_treatment_mapping(id):
     
     try:
         db.session.commit()
+        treatment_name_resolver.invalidate()
         flash('Mapping updated successfully', 'success')
     except Exception as e:
         db.session.rollback()
@@ -859,6 +932,7 @@ def delete_treatment_mapping(id):
     try:
         db.session.delete(mapping)
         db.session.commit()
+        treatment_name_resolver.invalidate()
         flash('Mapping deleted successfully', 'success')
     except Exception as e:
         db.session.rollback()
@@ -879,7 +953,8 @@ def download_template(type):
     templates = {
         'treatment_groups': 'name,description,commission_amount\nGroup 1,Description 1,100.00',
         'treatments': 'name,description,group_name,active,average_duration\nTreatment 1,Description 1,Group 1,true,30',
-        'mappings': 'external_name,treatment_group_name\nExternal Treatment 1,Group 1'
+        'mappings': 'external_name,treatment_group_name\nExternal Treatment 1,Group 1',
+        'crm_completions': 'email,full_name,treatment_name\npatient@example.com,John Doe,External Treatment 1'
     }
     
     if type not in templates:
@@ -1040,6 +1115,7 @@ def bulk_upload_mappings():
                 error_details.append(f"Error with row {row['external_name']}: {str(e)}")
         
         db.session.commit()
+        treatment_name_resolver.invalidate()
         
         results = {
             'success': True,
@@ -1056,9 +1132,67 @@ def bulk_upload_mappings():
     
     return render_template('admin/bulk_upload.html', results=results)
 
+@bp.route('/bulk-upload/crm-completions', methods=['POST'])
+@login_required
+@admin_required
+def bulk_upload_crm_completions():
+    """Import historical CRM treatment completions from JSON, CSV or NDJSON"""
+    dry_run = request.values.get('dry_run') in ('1', 'true', 'on')
+    
+    if request.is_json:
+        data = request.get_json(silent=True)
+        rows = data.get('rows') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            return jsonify({'error': 'Invalid request', 'details': 'Send a JSON array of rows or {"rows": [...]}'}), 400
+        try:
+            return jsonify(crm_import.import_treatment_completions(rows, dry_run=dry_run))
+        except Exception as e:
+            logging.error(f"Error importing CRM completions: {str(e)}")
+            return jsonify({'error': 'Import failed', 'details': str(e)}), 500
+    
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        flash('No file selected', 'danger')
+        return redirect(url_for('admin.bulk_upload'))
+    
+    try:
+        import_format = crm_import.detect_format(file.filename)
+        report = crm_import.import_treatment_completions(
+            crm_import.read_import_rows(file.stream, import_format), dry_run=dry_run
+        )
+        details = [f"{count} {crm_import.UNMATCHED_REASONS[reason].lower()}" for reason, count in report['unmatched'].items() if count]
+        details += [f"Row {sample['row']} ({sample['email']}, {sample['treatment_name']}): {sample['reason']}" for sample in report['samples']]
+        results = {
+            'success': True,
+            'message': f"{'Dry run: ' if dry_run else ''}{report['completed']} of {report['total']} rows completed a referral, "
+                       f"{report['already_completed']} were already completed",
+            'details': details or None
+        }
+    except Exception as e:
+        logging.error(f"Error importing CRM completions: {str(e)}")
+        results = {
+            'success': False,
+            'message': 'Error processing file',
+            'details': [str(e)]
+        }
+    
+    return render_template('admin/bulk_upload.html', results=results)
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus metrics for admins or scrapers holding METRICS_TOKEN"""
+    token = current_app.config.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    scraper = bool(token) and hmac.compare_digest(authorization, f'Bearer {token}')
+    if not scraper and not (current_user.is_authenticated and current_user.role == 'admin'):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
 @bp.route('/country-stats')
 @login_required
 @admin_required
+@read_only
 def country_stats():
     stats = get_country_stats()
     return render_template('admin/country_stats.html', country_stats=stats)
@@ -1066,24 +1200,10 @@ def country_stats():
 @bp.route('/api/country-stats/<country>')
 @login_required
 @admin_required
+@read_only
 def get_country_details(country):
     # Get detailed stats for specific country
-    referrals = Referral.query.filter_by(country=country).all()
-    completed = [r for r in referrals if r.status == 'completed']
-    
-    # Calculate monthly trends
-    monthly_trends = {}
-    for referral in referrals:
-        month = referral.created_at.strftime('%Y-%m')
-        monthly_trends[month] = monthly_trends.get(month, 0) + 1
-    
-    return jsonify({
-        'total_referrals': len(referrals),
-        'completed_referrals': len(completed),
-        'completion_rate': (len(completed) / len(referrals) * 100) if referrals else 0,
-        'total_commission': sum(float(r.commission_amount or 0) for r in completed),
-        'monthly_trends': monthly_trends
-    })
+    return jsonify(get_country_summary(country))
 
 @bp.route('/system-status')
 @login_required
@@ -5,6 +5,7 @@ from extensions import db
 from datetime import datetime
 from utils import generate_unique_slug, get_ip_location, get_client_ip, format_phone_number, create_notification
 from countries import COUNTRIES
+from loader_profiles import loader_profile, serializing
 
 bp = Blueprint('affiliate', __name__, url_prefix='/affiliate')
 
@@ -21,22 +22,25 @@ def dashboard():
     else:
         affiliate = current_user.affiliate
         
-    referrals = Referral.query.filter_by(affiliate_id=affiliate.id).order_by(Referral.created_at.desc()).all()
+    referrals = Referral.query.filter_by(affiliate_id=affiliate.id).options(
+        *loader_profile('affiliate_dashboard')
+    ).order_by(Referral.created_at.desc()).all()
     
     # Serialize referrals for template
     serialized_referrals = []
-    for r in referrals:
-        referral_data = {
-            'created_at': r.created_at.strftime('%Y-%m-%d'),
-            'name': r.name,
-            'surname': r.surname,
-            'treatment_group': r.treatment.group.name if r.treatment and r.treatment.group else 'No Group',
-            'email': r.email,
-            'phone': r.phone,
-            'status': r.status,
-            'commission_amount': str(r.commission_amount) if r.commission_amount else '0.00'
-        }
-        serialized_referrals.append(referral_data)
+    with serializing('affiliate.dashboard'):
+        for r in referrals:
+            referral_data = {
+                'created_at': r.created_at.strftime('%Y-%m-%d'),
+                'name': r.name,
+                'surname': r.surname,
+                'treatment_group': r.treatment.group.name if r.treatment and r.treatment.group else 'No Group',
+                'email': r.email,
+                'phone': r.phone,
+                'status': r.status,
+                'commission_amount': str(r.commission_amount) if r.commission_amount else '0.00'
+            }
+            serialized_referrals.append(referral_data)
     
     # Calculate earnings data
     earnings_data = {}
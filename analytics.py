@@ -1,28 +1,25 @@
-from datetime import datetime, timedelta
-from sqlalchemy import func, case, extract, text, and_
-from models import User, Referral, Treatment, Affiliate, Treatment_Status, TreatmentGroup
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, case, extract, text
+from models import User, Treatment, Affiliate, Treatment_Status, TreatmentGroup, ReferralDailyStats
 from extensions import db
+from daily_stats_service import NO_COUNTRY
+
+def _completed(column):
+    return func.sum(case((ReferralDailyStats.status == 'completed', column), else_=0))
 
 def get_conversion_metrics(start_date=None, end_date=None):
-    """Get conversion metrics and analytics data with optional date filtering"""
-    from models import Referral, Treatment
-    from sqlalchemy import func, case, extract
-    from datetime import datetime
-    
-    # Base query
-    query = Referral.query
-    
-    # Apply date filters if provided
+    """Get conversion metrics and analytics data with optional date filtering.
+
+    Reads the referral_daily_stats rollup; the date range covers whole days,
+    ``end_date`` included.
+    """
+    # Base filter
+    criteria = []
     if start_date and end_date:
-        query = query.filter(
-            and_(
-                Referral.created_at >= start_date,
-                Referral.created_at <= end_date
-            )
-        )
-    
-    # Get total referrals
-    total_referrals = query.count()
+        criteria = [
+            ReferralDailyStats.day >= start_date.date(),
+            ReferralDailyStats.day <= end_date.date()
+        ]
     
     # Get status counts with proper initialization
     status_counts = {
@@ -31,43 +28,34 @@ def get_conversion_metrics(start_date=None, end_date=None):
         'completed': 0
     }
     
-    # Update with actual counts
+    # Counts and completed commission per status in one pass over the rollup
     status_query = db.session.query(
-        Referral.status,
-        func.count(Referral.id).label('count')
-    ).filter(
-        query.whereclause if query.whereclause is not None else True
-    ).group_by(Referral.status).all()
-    
-    for status, count in status_query:
-        status_counts[status] = count
+        ReferralDailyStats.status,
+        func.sum(ReferralDailyStats.referral_count),
+        func.sum(ReferralDailyStats.commission_amount)
+    ).filter(*criteria).group_by(ReferralDailyStats.status).all()
     
-    # Calculate total commission from completed referrals
-    total_commission = db.session.query(
-        func.sum(case(
-            (Referral.status == 'completed', Referral.commission_amount),
-            else_=0
-        ))
-    ).filter(
-        query.whereclause if query.whereclause is not None else True
-    ).scalar() or 0.0
+    total_referrals = 0
+    total_commission = 0.0
+    for status, count, commission in status_query:
+        count = int(count or 0)
+        if count:
+            status_counts[status] = count
+        total_referrals += count
+        if status == 'completed':
+            total_commission = float(commission or 0)
     
     # Get monthly commission distribution
     current_year = datetime.utcnow().year
-    commission_query = db.session.query(
-        extract('month', Referral.created_at).label('month'),
-        func.sum(case(
-            (Referral.status == 'completed', Referral.commission_amount),
-            else_=0
-        )).label('commission')
-    )
-    
-    if query.whereclause is not None:
-        commission_query = commission_query.filter(query.whereclause)
-    
-    commission_by_month = commission_query.filter(
-        extract('year', Referral.created_at) == current_year
-    ).group_by('month').all()
+    month = extract('month', ReferralDailyStats.day).label('month')
+    commission_by_month = db.session.query(
+        month,
+        _completed(ReferralDailyStats.commission_amount).label('commission')
+    ).filter(
+        *criteria,
+        ReferralDailyStats.day >= date(current_year, 1, 1),
+        ReferralDailyStats.day < date(current_year + 1, 1, 1)
+    ).group_by(month).all()
     
     commission_distribution = {}
     for month, commission in commission_by_month:
@@ -86,46 +74,79 @@ def get_conversion_metrics(start_date=None, end_date=None):
         'conversion_rate': round(conversion_rate, 1)
     }
 
+def count_referrals(start=None, end=None):
+    """Referrals created on days in [start, end), from the rollup"""
+    query = db.session.query(func.coalesce(func.sum(ReferralDailyStats.referral_count), 0))
+    if start is not None:
+        query = query.filter(ReferralDailyStats.day >= start)
+    if end is not None:
+        query = query.filter(ReferralDailyStats.day < end)
+    return int(query.scalar())
+
 def get_top_affiliates(limit=5):
     """Get top performing affiliates based on completed referrals and earnings"""
+    from loader_profiles import loader_profile
+    totals = db.session.query(
+        ReferralDailyStats.affiliate_id,
+        func.sum(ReferralDailyStats.referral_count).label('total_referrals'),
+        _completed(ReferralDailyStats.referral_count).label('completed_referrals'),
+        func.sum(ReferralDailyStats.commission_amount).label('commission')
+    ).group_by(ReferralDailyStats.affiliate_id).subquery()
+    
     return db.session.query(
         Affiliate,
-        func.count(Referral.id).label('total_referrals'),
-        func.sum(case((Referral.status == 'completed', 1), else_=0)).label('completed_referrals')
-    ).outerjoin(
-        Referral, Affiliate.id == Referral.affiliate_id
-    ).group_by(Affiliate.id).order_by(
-        func.sum(Referral.commission_amount).desc()
+        func.coalesce(totals.c.total_referrals, 0),
+        func.coalesce(totals.c.completed_referrals, 0)
+    ).options(*loader_profile('top_affiliates')).outerjoin(
+        totals, totals.c.affiliate_id == Affiliate.id
+    ).order_by(
+        func.coalesce(totals.c.commission, 0).desc(), Affiliate.id
     ).limit(limit).all()
 
 def get_country_stats():
     """Get referral statistics by country"""
-    from models import Referral
-    from sqlalchemy import func, case
-    
     country_stats = db.session.query(
-        Referral.country,
-        func.count(Referral.id).label('total_referrals'),
-        func.count(case(
-            (Referral.status == 'completed', 1),
-            else_=None
-        )).label('completed_referrals'),
-        func.sum(case(
-            (Referral.status == 'completed', Referral.commission_amount),
-            else_=0
-        )).label('total_commission')
+        ReferralDailyStats.country,
+        func.sum(ReferralDailyStats.referral_count).label('total_referrals'),
+        _completed(ReferralDailyStats.referral_count).label('completed_referrals'),
+        _completed(ReferralDailyStats.commission_amount).label('total_commission')
     ).filter(
-        Referral.country.isnot(None)
+        ReferralDailyStats.country != NO_COUNTRY
     ).group_by(
-        Referral.country
+        ReferralDailyStats.country
+    ).having(
+        func.sum(ReferralDailyStats.referral_count) > 0
     ).order_by(
-        func.count(Referral.id).desc()
+        func.sum(ReferralDailyStats.referral_count).desc()
     ).all()
     
     return [{
         'country': stat.country,
-        'total_referrals': stat.total_referrals,
-        'completed_referrals': stat.completed_referrals,
+        'total_referrals': int(stat.total_referrals),
+        'completed_referrals': int(stat.completed_referrals or 0),
         'completion_rate': (stat.completed_referrals / stat.total_referrals * 100) if stat.total_referrals > 0 else 0,
         'total_commission': float(stat.total_commission or 0)
     } for stat in country_stats]
+
+def get_country_summary(country):
+    """Totals and monthly referral counts for one country"""
+    year = extract('year', ReferralDailyStats.day).label('year')
+    month = extract('month', ReferralDailyStats.day).label('month')
+    rows = db.session.query(
+        year, month,
+        func.sum(ReferralDailyStats.referral_count),
+        _completed(ReferralDailyStats.referral_count),
+        _completed(ReferralDailyStats.commission_amount)
+    ).filter(
+        ReferralDailyStats.country == country
+    ).group_by(year, month).order_by(year, month).all()
+    
+    total = sum(int(row[2] or 0) for row in rows)
+    completed = sum(int(row[3] or 0) for row in rows)
+    return {
+        'total_referrals': total,
+        'completed_referrals': completed,
+        'completion_rate': (completed / total * 100) if total else 0,
+        'total_commission': sum(float(row[4] or 0) for row in rows),
+        'monthly_trends': {f"{int(y)}-{int(m):02d}": int(count) for y, m, count, _, _ in rows if count}
+    }
@@ -1,46 +1,43 @@
-from flask import Blueprint, jsonify, request, g, current_app
+from flask import Blueprint, jsonify, request, g, current_app, Response, stream_with_context, url_for
 from flask_login import current_user
 from functools import wraps
-from models import User, APIKey, Affiliate, Referral, Treatment, TreatmentGroup, TreatmentNameMapping
+from models import User, APIKey, Affiliate, Referral, Treatment, TreatmentGroup, CrmEvent
 from extensions import db
 from datetime import datetime, timedelta
 import logging
 import time
-from collections import defaultdict
 from utils import get_client_ip, get_ip_location
+from pagination import parse_limit, parse_datetime, parse_datetime_end, parse_sync_position, keyset_page, change_feed, InvalidCursor
+from fieldsets import referral_fieldset, treatment_fieldset, referral_loader_options, treatment_loader_options
+from loader_profiles import serializing
+from rate_limit import get_rate_limiter, add_rate_limit_headers
+from api_auth import authenticate_api_key, key_cache
+from werkzeug.local import LocalProxy
+import referral_service
+from referral_service import MAX_BATCH_SIZE, EXPORT_FORMATS
+from stats_service import ensure_affiliate_stats
+from idempotency import idempotent
+import crm_service
+from compression import compress_response
+from usage_service import check_quota, record_request
 
 bp = Blueprint('api', __name__, url_prefix='/api/v1')
 
-# Rate limiting implementation
-RATE_LIMIT = 100  # requests per window
-RATE_WINDOW = 3600  # window in seconds (1 hour)
-request_counts = defaultdict(list)
+VALID_STATUSES = ['new', 'in-progress', 'completed']
+
+# Changes younger than this are held back from the sync feed so that
+# transactions still in flight cannot commit behind a client's cursor
+CHANGE_FEED_SETTLE_SECONDS = 2
 
 def add_cors_headers(response):
     """Add CORS headers to the response"""
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-API-Key'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-API-Key, Idempotency-Key'
+    response.headers['Access-Control-Expose-Headers'] = 'X-RateLimit-Limit, X-RateLimit-Remaining, X-RateLimit-Reset, Retry-After, Idempotent-Replayed'
     response.headers['Access-Control-Max-Age'] = '3600'
     return response
 
-def check_rate_limit(api_key):
-    """Check if the request is within rate limits"""
-    now = time.time()
-    requests = request_counts[api_key]
-    
-    # Remove old requests outside the window
-    while requests and requests[0] < now - RATE_WINDOW:
-        requests.pop(0)
-    
-    # Check if within limit
-    if len(requests) >= RATE_LIMIT:
-        return False
-    
-    # Add current request
-    requests.append(now)
-    return True
-
 @bp.before_request
 def handle_preflight():
     """Handle OPTIONS requests"""
@@ -63,8 +60,8 @@ def require_api_key(f):
                 'details': 'Include X-API-Key header in your request'
             }), 401
 
-        key = APIKey.query.filter_by(key=api_key, is_active=True).first()
-        if not key:
+        identity = authenticate_api_key(api_key)
+        if not identity:
             return jsonify({
                 'error': 'Authentication failed',
                 'message': 'Invalid or inactive API key',
@@ -72,19 +69,28 @@ def require_api_key(f):
             }), 401
 
         # Check rate limit
-        if not check_rate_limit(api_key):
+        result = get_rate_limiter().hit(f"api_key:{identity.key_id}", identity.rate_limit_tier)
+        g.rate_limit = result
+        if not result.allowed:
             return jsonify({
                 'error': 'Rate limit exceeded',
-                'message': f'Maximum {RATE_LIMIT} requests per {RATE_WINDOW} seconds',
-                'details': 'Please wait before making more requests'
+                'message': f'Maximum {result.limit} requests per {result.window} seconds',
+                'details': f'Please wait {result.retry_after} seconds before making more requests'
             }), 429
 
-        # Update last used timestamp
-        key.last_used_at = datetime.utcnow()
-        db.session.commit()
+        quota = check_quota(identity)
+        if not quota.allowed:
+            response = jsonify({
+                'error': 'Quota exceeded',
+                'message': f'Maximum {quota.limit} requests {quota.period} for this API key',
+                'details': f'The {quota.period} quota resets in {quota.retry_after} seconds'
+            })
+            response.headers['Retry-After'] = str(quota.retry_after)
+            return response, 429
 
-        # Store the authenticated user in g
-        g.current_user = key.user
+        # Store the authenticated key in g; the User row is only loaded if a view needs it
+        g.api_key = identity
+        g.current_user = LocalProxy(lambda: db.session.get(User, identity.user_id))
         g.start_time = time.time()
         return f(*args, **kwargs)
     return decorated_function
@@ -98,7 +104,14 @@ def after_request(response):
         logging.info(f"API Request: {request.method} {request.path} - {response.status_code} - {duration}ms")
         response.headers['X-Response-Time'] = f"{duration}ms"
     
-    return add_cors_headers(response)
+    if hasattr(g, 'rate_limit'):
+        add_rate_limit_headers(response, g.rate_limit)
+    
+    # Only requests that passed authentication, rate limit and quota are counted
+    if hasattr(g, 'api_key'):
+        record_request(g.api_key, request.endpoint, response.status_code)
+    
+    return compress_response(add_cors_headers(response))
 
 @bp.errorhandler(405)
 def method_not_allowed_error(e):
@@ -123,22 +136,22 @@ def handle_error(e):
 @bp.route('/referrals/<int:id>/status', methods=['PUT', 'OPTIONS'])
 @require_api_key
 def update_referral_status(id):
-    user = g.current_user
-    logging.info(f"User {user.username} attempting to update referral {id} status")
+    identity = g.api_key
+    logging.info(f"User {identity.username} attempting to update referral {id} status")
     
-    if user.role != 'affiliate':
-        logging.warning(f"User {user.username} with role {user.role} attempted to update referral status")
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to update referral status")
         return jsonify({'error': 'Access denied. User must have affiliate role'}), 403
     
-    if not user.affiliate:
-        logging.error(f"User {user.username} has affiliate role but no affiliate record")
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
         return jsonify({'error': 'No affiliate record found. Please contact support'}), 403
     
     referral = Referral.query.get(id)
     if not referral:
         return jsonify({'error': 'Referral not found'}), 404
     
-    if referral.affiliate_id != user.affiliate.id:
+    if referral.affiliate_id != identity.affiliate_id:
         return jsonify({'error': 'Access denied. Not authorized to update this referral'}), 403
     
     data = request.json
@@ -146,11 +159,10 @@ def update_referral_status(id):
         return jsonify({'error': 'Status field is required'}), 400
     
     new_status = data['status']
-    valid_statuses = ['new', 'in-progress', 'completed']
-    if new_status not in valid_statuses:
+    if new_status not in VALID_STATUSES:
         return jsonify({
             'error': 'Invalid status value',
-            'details': f"Status must be one of: {', '.join(valid_statuses)}"
+            'details': f"Status must be one of: {', '.join(VALID_STATUSES)}"
         }), 400
     
     try:
@@ -180,6 +192,41 @@ def update_referral_status(id):
             'details': 'Could not update referral status. Please try again later'
         }), 500
 
+@bp.route('/referrals/status', methods=['PUT', 'OPTIONS'])
+@require_api_key
+def bulk_update_referral_status():
+    identity = g.api_key
+    logging.info(f"User {identity.username} attempting a bulk referral status update")
+    
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to update referral status")
+        return jsonify({'error': 'Access denied. User must have affiliate role'}), 403
+    
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
+        return jsonify({'error': 'No affiliate record found. Please contact support'}), 403
+    
+    ids, new_status, error = referral_service.parse_transition_request(request.get_json(silent=True))
+    if error:
+        return jsonify({'error': 'Invalid request body', 'details': error}), 400
+    
+    try:
+        results, transitions = referral_service.bulk_transition_referrals(
+            ids, new_status, affiliate_id=identity.affiliate_id
+        )
+    except Exception as e:
+        logging.error(f"Error in bulk referral status update: {str(e)}")
+        return jsonify({
+            'error': 'Internal server error',
+            'details': 'Could not update referral status. Please try again later'
+        }), 500
+    
+    return jsonify({
+        'updated': len(transitions),
+        'failed': sum(1 for result in results if result['status'] == 'error'),
+        'results': results
+    })
+
 # API Key Management Endpoints
 @bp.route('/keys', methods=['POST'])
 @require_api_key
@@ -198,18 +245,19 @@ def create_api_key():
 @bp.route('/keys', methods=['GET'])
 @require_api_key
 def list_api_keys():
-    keys = APIKey.query.filter_by(user_id=g.current_user.id).all()
+    keys = APIKey.query.filter_by(user_id=g.api_key.user_id).all()
     return jsonify([key.to_dict() for key in keys])
 
 @bp.route('/keys/<int:key_id>', methods=['DELETE'])
 @require_api_key
 def revoke_api_key(key_id):
-    key = APIKey.query.filter_by(id=key_id, user_id=g.current_user.id).first()
+    key = APIKey.query.filter_by(id=key_id, user_id=g.api_key.user_id).first()
     if not key:
         return jsonify({'error': 'API key not found'}), 404
     
     key.is_active = False
     db.session.commit()
+    key_cache.invalidate_key(key.id)
     return '', 204
 
 # Profile endpoint
@@ -238,32 +286,100 @@ def get_profile():
 @bp.route('/referrals', methods=['GET'])
 @require_api_key
 def get_referrals():
-    user = g.current_user
-    logging.info(f"User {user.username} accessing referrals endpoint")
+    identity = g.api_key
+    logging.info(f"User {identity.username} accessing referrals endpoint")
     
-    if user.role != 'affiliate':
-        logging.warning(f"User {user.username} with role {user.role} attempted to access referrals")
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to access referrals")
         return jsonify({'error': 'Access denied. User must have affiliate role'}), 403
     
-    if not user.affiliate:
-        logging.error(f"User {user.username} has affiliate role but no affiliate record")
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
         return jsonify({'error': 'No affiliate record found. Please contact support'}), 403
     
-    referrals = Referral.query.filter_by(affiliate_id=user.affiliate.id).all()
-    return jsonify([referral.to_dict() for referral in referrals])
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        created_from = parse_datetime(request.args.get('created_from'))
+        created_before = parse_datetime_end(request.args.get('created_to'))
+        fields, include = referral_fieldset(request.args)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid query parameter', 'details': str(e)}), 400
+    
+    query = Referral.query.filter_by(affiliate_id=identity.affiliate_id).options(
+        *referral_loader_options(fields, include)
+    )
+    
+    status = request.args.get('status')
+    if status:
+        if status not in VALID_STATUSES:
+            return jsonify({
+                'error': 'Invalid status value',
+                'details': f"Status must be one of: {', '.join(VALID_STATUSES)}"
+            }), 400
+        query = query.filter(Referral.status == status)
+    
+    treatment_id = request.args.get('treatment_id', type=int)
+    if treatment_id:
+        query = query.filter(Referral.treatment_id == treatment_id)
+    if created_from:
+        query = query.filter(Referral.created_at >= created_from)
+    if created_before:
+        query = query.filter(Referral.created_at < created_before)
+    
+    # Incremental sync: only rows changed since the client's last cursor
+    updated_since = request.args.get('updated_since')
+    if updated_since:
+        try:
+            position = parse_sync_position(updated_since)
+        except InvalidCursor:
+            return jsonify({
+                'error': 'Invalid updated_since value',
+                'details': 'Use an ISO 8601 timestamp or a sync_cursor from a previous response'
+            }), 400
+        
+        settled_before = datetime.utcnow() - timedelta(seconds=CHANGE_FEED_SETTLE_SECONDS)
+        referrals, sync_cursor, has_more = change_feed(
+            query, Referral.updated_at, Referral.id, position, limit,
+            settled_before=settled_before
+        )
+        with serializing('api.get_referrals'):
+            serialized = [referral.to_dict(fields, include) for referral in referrals]
+        return jsonify({
+            'referrals': serialized,
+            'sync_cursor': sync_cursor,
+            'has_more': has_more,
+            'limit': limit
+        })
+    
+    try:
+        referrals, next_cursor = keyset_page(
+            query, Referral.created_at, Referral.id, limit,
+            cursor=request.args.get('cursor')
+        )
+    except InvalidCursor as e:
+        return jsonify({'error': 'Invalid cursor', 'details': str(e)}), 400
+    
+    with serializing('api.get_referrals'):
+        serialized = [referral.to_dict(fields, include) for referral in referrals]
+    return jsonify({
+        'referrals': serialized,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
 
 @bp.route('/referrals', methods=['POST'])
 @require_api_key
+@idempotent(lambda: f"api_key:{g.api_key.key_id}")
 def create_referral():
-    user = g.current_user
-    logging.info(f"User {user.username} attempting to create referral")
+    identity = g.api_key
+    logging.info(f"User {identity.username} attempting to create referral")
     
-    if user.role != 'affiliate':
-        logging.warning(f"User {user.username} with role {user.role} attempted to create referral")
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to create referral")
         return jsonify({'error': 'Access denied. User must have affiliate role'}), 403
     
-    if not user.affiliate:
-        logging.error(f"User {user.username} has affiliate role but no affiliate record")
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
         return jsonify({'error': 'No affiliate record found. Please contact support'}), 403
     
     data = request.json
@@ -278,7 +394,7 @@ def create_referral():
     
     try:
         referral = Referral(
-            affiliate_id=user.affiliate.id,
+            affiliate_id=identity.affiliate_id,
             treatment_id=treatment.id,
             name=data['name'],
             surname=data['surname'],
@@ -293,51 +409,149 @@ def create_referral():
         db.session.rollback()
         return jsonify({'error': 'Could not create referral'}), 500
 
+@bp.route('/referrals/batch', methods=['POST'])
+@require_api_key
+def create_referrals_batch():
+    identity = g.api_key
+    logging.info(f"User {identity.username} attempting to create a referral batch")
+    
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to create referrals")
+        return jsonify({'error': 'Access denied. User must have affiliate role'}), 403
+    
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
+        return jsonify({'error': 'No affiliate record found. Please contact support'}), 403
+    
+    data = request.get_json(silent=True)
+    items = data.get('referrals') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({
+            'error': 'Invalid request body',
+            'details': 'Send a non-empty "referrals" array'
+        }), 400
+    
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({
+            'error': 'Batch too large',
+            'details': f'A batch may contain at most {MAX_BATCH_SIZE} referrals'
+        }), 413
+    
+    try:
+        results = referral_service.create_referrals_batch(identity.affiliate_id, items)
+    except Exception as e:
+        logging.error(f"Error creating referral batch: {str(e)}")
+        return jsonify({'error': 'Could not create referrals'}), 500
+    
+    created = sum(1 for result in results if result['status'] == 'created')
+    failed = len(results) - created
+    if failed == 0:
+        status_code = 201
+    elif created == 0:
+        status_code = 400
+    else:
+        status_code = 207
+    
+    return jsonify({
+        'created': created,
+        'failed': failed,
+        'results': results
+    }), status_code
+
+@bp.route('/referrals/export', methods=['GET'])
+@require_api_key
+def export_referrals():
+    identity = g.api_key
+    logging.info(f"User {identity.username} exporting referrals")
+    
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to export referrals")
+        return jsonify({'error': 'Access denied. User must have affiliate role'}), 403
+    
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
+        return jsonify({'error': 'No affiliate record found. Please contact support'}), 403
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({
+            'error': 'Invalid export format',
+            'details': f"Format must be one of: {', '.join(EXPORT_FORMATS)}"
+        }), 400
+    
+    status = request.args.get('status')
+    if status and status not in VALID_STATUSES:
+        return jsonify({
+            'error': 'Invalid status value',
+            'details': f"Status must be one of: {', '.join(VALID_STATUSES)}"
+        }), 400
+    
+    try:
+        created_from = parse_datetime(request.args.get('created_from'))
+        created_before = parse_datetime_end(request.args.get('created_to'))
+    except ValueError as e:
+        return jsonify({'error': 'Invalid query parameter', 'details': str(e)}), 400
+    
+    chunks = referral_service.iter_referral_export(
+        identity.affiliate_id,
+        export_format,
+        status=status,
+        created_from=created_from,
+        created_before=created_before
+    )
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f"referrals.{export_format}"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
 # Treatments endpoint
 @bp.route('/treatments', methods=['GET'])
 @require_api_key
 def get_treatments():
-    treatments = Treatment.query.filter_by(active=True).all()
-    return jsonify([treatment.to_dict() for treatment in treatments])
+    try:
+        fields, include = treatment_fieldset(request.args)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid query parameter', 'details': str(e)}), 400
+    
+    treatments = Treatment.query.filter_by(active=True).options(
+        *treatment_loader_options(fields, include)
+    ).all()
+    with serializing('api.get_treatments'):
+        return jsonify([treatment.to_dict(fields, include) for treatment in treatments])
 
 # Statistics endpoint
 @bp.route('/stats', methods=['GET'])
 @require_api_key
 def get_stats():
-    user = g.current_user
-    logging.info(f"User {user.username} accessing stats endpoint")
+    identity = g.api_key
+    logging.info(f"User {identity.username} accessing stats endpoint")
     
-    if user.role != 'affiliate':
-        logging.warning(f"User {user.username} with role {user.role} attempted to access stats")
+    if identity.role != 'affiliate':
+        logging.warning(f"User {identity.username} with role {identity.role} attempted to access stats")
         return jsonify({
             'error': 'Access denied',
             'details': 'User must have affiliate role to access statistics'
         }), 403
     
-    if not user.affiliate:
-        logging.error(f"User {user.username} has affiliate role but no affiliate record")
+    if not identity.affiliate_id:
+        logging.error(f"User {identity.username} has affiliate role but no affiliate record")
         return jsonify({
             'error': 'No affiliate record found',
             'details': 'User has affiliate role but no associated affiliate record. Please contact support'
         }), 403
     
     try:
-        referrals = Referral.query.filter_by(affiliate_id=user.affiliate.id).all()
-        total_referrals = len(referrals)
-        completed_referrals = len([r for r in referrals if r.status == 'completed'])
+        stats = ensure_affiliate_stats(identity.affiliate_id).to_dict()
+        stats['total_earnings'] = float(db.session.get(Affiliate, identity.affiliate_id).total_earnings or 0)
         
-        stats = {
-            'total_referrals': total_referrals,
-            'completed_referrals': completed_referrals,
-            'conversion_rate': (completed_referrals / total_referrals * 100) if total_referrals > 0 else 0,
-            'total_earnings': float(user.affiliate.total_earnings or 0)
-        }
-        
-        logging.info(f"Successfully retrieved stats for affiliate {user.affiliate.id}")
+        logging.info(f"Successfully retrieved stats for affiliate {identity.affiliate_id}")
         return jsonify(stats)
         
     except Exception as e:
-        logging.error(f"Error retrieving stats for user {user.username}: {str(e)}")
+        logging.error(f"Error retrieving stats for user {identity.username}: {str(e)}")
         return jsonify({
             'error': 'Internal server error',
             'details': 'Could not retrieve statistics. Please try again later'
@@ -355,103 +569,64 @@ def get_location():
         'country_code': 'TR'  # Default to Turkey
     })
 
+def crm_event_id():
+    """Event id sent by the CRM, used as the idempotency key when no header is given"""
+    data = request.get_json(silent=True)
+    return data.get('event_id') if isinstance(data, dict) else None
+
 @bp.route('/webhook/treatment-completed', methods=['POST'])
+@idempotent('crm:treatment-completed', key_from=crm_event_id)
 def treatment_completed_webhook():
-    data = request.get_json()
+    data = request.get_json(silent=True)
     
     # Validate required fields
-    required_fields = ['email', 'full_name', 'treatment_name']
-    if not all(field in data for field in required_fields):
+    error = crm_service.validate_treatment_completed(data)
+    if error:
         return jsonify({
             'success': False,
             'error': 'Missing required fields',
-            'required': required_fields
+            'details': error,
+            'required': crm_service.REQUIRED_TREATMENT_FIELDS
         }), 400
     
     try:
-        # Find referral by email
-        referral = Referral.query.filter_by(
-            email=data['email'].lower().strip()
-        ).first()
-        
-        if not referral:
-            return jsonify({
-                'success': False,
-                'error': 'No matching referral found',
-                'details': f"No referral found with email: {data['email']}"
-            }), 404
-        
-        # Find treatment mapping by external name
-        mapping = TreatmentNameMapping.query.filter(
-            TreatmentNameMapping.external_name.ilike(data['treatment_name'].strip())
-        ).first()
-        
-        if not mapping:
-            return jsonify({
-                'success': False,
-                'error': 'No matching treatment mapping found',
-                'details': f"No mapping found for treatment: {data['treatment_name']}"
-            }), 404
-            
-        # Update referral's treatment group and commission
-        treatment = Treatment.query.filter_by(
-            group_id=mapping.treatment_group_id,
-            active=True
-        ).first()
-        
-        if not treatment:
-            return jsonify({
-                'success': False,
-                'error': 'No active treatment found in mapped group',
-                'details': 'The mapped treatment group has no active treatments'
-            }), 400
-        
-        # Update referral
-        referral.treatment_id = treatment.id
-        referral.status = 'completed'
-        
-        # Calculate commission based on treatment group
-        commission = float(mapping.treatment_group.commission_amount or 0)
-        referral.commission_amount = commission
-        
-        # Update affiliate earnings
-        referral.affiliate.total_earnings = float(referral.affiliate.total_earnings or 0) + commission
-        
-        # Create/update treatment status
-        if not referral.treatment_status:
-            treatment_status = Treatment_Status(
-                referral_id=referral.id,
-                notes=f"Treatment completed: {data['treatment_name']}"
-            )
-            db.session.add(treatment_status)
-        
-        referral.treatment_status.end_date = datetime.utcnow()
-        referral.treatment_status.outcome = 'success'
-        
-        # Trigger webhook notifications
-        webhook_data = {
-            'id': referral.id,
-            'email': referral.email,
-            'treatment': treatment.name,
-            'commission_amount': commission,
-            'affiliate_id': referral.affiliate_id
-        }
-        trigger_webhook_event('referral.completed', webhook_data, referral.affiliate.user_id)
-        
-        db.session.commit()
-        
+        # Matching and earnings updates happen in the CRM worker (flask crm-worker)
+        event = crm_service.enqueue_crm_event(
+            crm_service.TREATMENT_COMPLETED, data, external_id=data.get('event_id')
+        )
         return jsonify({
             'success': True,
-            'message': 'Referral updated successfully',
-            'referral_id': referral.id,
-            'commission_amount': commission
-        })
+            'message': 'Event queued for processing',
+            'queue_id': event.id,
+            'status_url': url_for('api.crm_event_status', event_id=event.id)
+        }), 202
         
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Error processing treatment completion: {str(e)}")
+        logging.error(f"Error queueing treatment completion: {str(e)}")
         return jsonify({
             'success': False,
             'error': 'Internal server error',
             'details': str(e) if current_app.debug else None
-        }), 500
\ No newline at end of file
+        }), 500
+
+@bp.route('/webhook/events/<int:event_id>')
+@require_api_key
+def crm_event_status(event_id):
+    """Processing status of a queued CRM event.
+
+    Admin keys (the CRM integration) see every event; an affiliate key only
+    sees events matched to one of its own referrals.
+    """
+    identity = g.api_key
+    event = db.session.get(CrmEvent, event_id)
+    if event and identity.role != 'admin':
+        referral_affiliate_id = db.session.query(Referral.affiliate_id).filter_by(
+            id=event.referral_id
+        ).scalar() if event.referral_id else None
+        if not identity.affiliate_id or referral_affiliate_id != identity.affiliate_id:
+            # Same answer as a missing event so ids cannot be probed
+            event = None
+    if not event:
+        return jsonify({'error': 'Event not found'}), 404
+    return jsonify(event.to_dict())
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from sqlalchemy import bindparam, update
+from sqlalchemy.exc import SQLAlchemyError
+from extensions import db
+from models import APIKey, User, Affiliate
+from api_keys import api_key_prefix, verify_api_key
+
+API_KEY_CACHE_TTL = 60  # seconds a verified key is trusted without a DB lookup
+API_KEY_CACHE_SIZE = 1024  # most recently used keys kept per worker
+LAST_USED_FLUSH_INTERVAL = 60  # seconds between bulk last_used_at writes
+
+ApiKeyIdentity = namedtuple('ApiKeyIdentity', [
+    'key_id', 'user_id', 'username', 'role', 'affiliate_id', 'rate_limit_tier'
+])
+
+
+class ApiKeyCache:
+    """TTL + LRU cache of verified API key -> ApiKeyIdentity.
+
+    A hit skips both the database lookup and the hash comparison. Only keys
+    that passed verification are stored. The cache is per worker process.
+    Revocations made through the API or the admin panel are invalidated
+    immediately in the worker that handles them; other workers pick the
+    change up once the entry's TTL runs out.
+    """
+
+    def __init__(self, ttl=API_KEY_CACHE_TTL, max_size=API_KEY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is None:
+                return None
+            identity, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[api_key]
+                return None
+            self._entries.move_to_end(api_key)
+            return identity
+
+    def set(self, api_key, identity):
+        with self._lock:
+            self._entries[api_key] = (identity, time.monotonic() + self.ttl)
+            self._entries.move_to_end(api_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_key(self, key_id):
+        """Drop the cached entry for the API key row ``key_id`` (revocation)"""
+        with self._lock:
+            stale = [k for k, (identity, _) in self._entries.items() if identity.key_id == key_id]
+            for api_key in stale:
+                del self._entries[api_key]
+
+    def invalidate_user(self, user_id):
+        """Drop every cached key belonging to ``user_id`` (role change, deletion)"""
+        with self._lock:
+            stale = [k for k, (identity, _) in self._entries.items() if identity.user_id == user_id]
+            for api_key in stale:
+                del self._entries[api_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LastUsedBuffer:
+    """Collect last_used_at timestamps in memory and write them in bulk"""
+
+    def __init__(self, interval=LAST_USED_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def touch(self, key_id, used_at=None):
+        with self._lock:
+            self._pending[key_id] = used_at or datetime.utcnow()
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered timestamps with one executemany UPDATE"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+
+        table = APIKey.__table__
+        statement = update(table).where(table.c.id == bindparam('key_id')).values(last_used_at=bindparam('used_at'))
+        rows = [{'key_id': key_id, 'used_at': used_at} for key_id, used_at in pending.items()]
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(statement, rows)
+        except SQLAlchemyError as e:
+            logging.error(f"Could not flush API key usage timestamps: {str(e)}")
+            # Keep the timestamps for the next attempt unless newer ones arrived
+            with self._lock:
+                for key_id, used_at in pending.items():
+                    self._pending.setdefault(key_id, used_at)
+
+
+key_cache = ApiKeyCache()
+last_used_buffer = LastUsedBuffer()
+
+
+def load_api_key_identity(api_key):
+    """Resolve an active API key to its identity with a single prefix lookup"""
+    prefix = api_key_prefix(api_key)
+    if prefix is None:
+        return None
+
+    row = db.session.query(
+        APIKey.id, APIKey.user_id, APIKey.rate_limit_tier, APIKey.key_hash,
+        User.username, User.role, Affiliate.id.label('affiliate_id')
+    ).join(
+        User, APIKey.user_id == User.id
+    ).outerjoin(
+        Affiliate, Affiliate.user_id == User.id
+    ).filter(
+        APIKey.prefix == prefix,
+        APIKey.is_active == True
+    ).first()
+
+    if not row or not verify_api_key(api_key, row.key_hash):
+        return None
+    return ApiKeyIdentity(
+        key_id=row.id,
+        user_id=row.user_id,
+        username=row.username,
+        role=row.role,
+        affiliate_id=row.affiliate_id,
+        rate_limit_tier=row.rate_limit_tier
+    )
+
+
+def authenticate_api_key(api_key):
+    """Return the ApiKeyIdentity for ``api_key``, or None if it is not valid"""
+    identity = key_cache.get(api_key)
+    if identity is None:
+        identity = load_api_key_identity(api_key)
+        if identity is None:
+            return None
+        key_cache.set(api_key, identity)
+
+    last_used_buffer.touch(identity.key_id)
+    last_used_buffer.flush_if_due()
+    return identity
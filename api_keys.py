@@ -0,0 +1,40 @@
+"""API key format, hashing and verification.
+
+A key reads ``<prefix>.<secret>``. Only the prefix, which is unique and
+indexed, and a SHA-256 hash of the whole key are stored. The secret is 256
+random bits, so a fast hash is enough and the lookup is one index probe on
+the prefix followed by a constant-time digest comparison. Keys issued before
+this format had no separator; their first characters serve as the prefix.
+"""
+import hashlib
+import hmac
+import secrets
+
+KEY_PREFIX_LENGTH = 12
+KEY_SEPARATOR = '.'
+
+
+def hash_api_key(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def new_api_key():
+    """Return (key, prefix, key_hash) for a freshly generated key"""
+    prefix = secrets.token_hex(KEY_PREFIX_LENGTH // 2)
+    key = f"{prefix}{KEY_SEPARATOR}{secrets.token_urlsafe(32)}"
+    return key, prefix, hash_api_key(key)
+
+
+def api_key_prefix(key):
+    """The stored lookup prefix of ``key``, or None if it cannot be a valid key"""
+    prefix, separator, secret = key.partition(KEY_SEPARATOR)
+    if not separator:
+        prefix, secret = key[:KEY_PREFIX_LENGTH], key[KEY_PREFIX_LENGTH:]
+    if len(prefix) != KEY_PREFIX_LENGTH or not secret:
+        return None
+    return prefix
+
+
+def verify_api_key(key, key_hash):
+    """Compare ``key`` with a stored hash in constant time"""
+    return hmac.compare_digest(hash_api_key(key), key_hash)
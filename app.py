@@ -6,14 +6,23 @@ from sqlalchemy import text
 from extensions import db, login_manager, toolbar
 import requests
 from filters import nl2br, flag
+from commands import register_commands
+from json_provider import configure_json_provider
+from metrics import configure_metrics, registry as metrics_registry
+from instrumentation import init_instrumentation
+from db_routing import REPLICA_BIND, init_db_routing
 from flask_migrate import Migrate
-from datetime import datetime
+from datetime import datetime, timedelta
+import atexit
 import logging
 from logging.handlers import RotatingFileHandler
 
 # Load environment variables first
 load_dotenv()
 
+# How stale User.last_seen may get before a request writes it again
+LAST_SEEN_INTERVAL = timedelta(minutes=1)
+
 def create_app():
     app = Flask(__name__, static_url_path='/static')
     
@@ -51,12 +60,44 @@ def create_app():
         "pool_recycle": 300,
         "pool_pre_ping": True,
     }
+    # Optional read replica for @read_only views (analytics, dashboards)
+    if os.environ.get("DATABASE_REPLICA_URL"):
+        app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: os.environ["DATABASE_REPLICA_URL"]}
+    # Seconds a browser session keeps reading from the primary after it writes
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
     app.config['MANDRILL_API_KEY'] = os.environ.get('MANDRILL_API_KEY')
     app.config['RECAPTCHA_SITE_KEY'] = os.getenv('RECAPTCHA_SITE_KEY')
     app.config['RECAPTCHA_SECRET_KEY'] = os.getenv('RECAPTCHA_SECRET_KEY')
+    # ISO code (e.g. 'TR') whose dial code completes national phone numbers
+    # that come without a country; unset, such numbers are not matched by phone
+    app.config['DEFAULT_PHONE_COUNTRY'] = os.getenv('DEFAULT_PHONE_COUNTRY')
+    # 'memory' keeps buckets per worker, 'database' shares them across workers
+    app.config['RATE_LIMIT_BACKEND'] = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    # Seconds a response stored under an Idempotency-Key is replayed
+    app.config['IDEMPOTENCY_TTL'] = int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+    # 'fast' encodes JSON with orjson when installed (same values, non-ASCII
+    # unescaped), 'default' uses the stdlib
+    app.config['JSON_PROVIDER'] = os.getenv('JSON_PROVIDER', 'fast')
+    # Responses smaller than this many bytes are sent uncompressed
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+    # Shared directory for per-worker metric snapshots; unset keeps metrics per process
+    app.config['METRICS_MULTIPROC_DIR'] = os.getenv('METRICS_MULTIPROC_DIR')
+    # Bearer token that lets a Prometheus scraper read /admin/metrics
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    # 'raise' fails list views that lazy-load per row (use in development and tests), 'warn' logs them
+    app.config['LAZY_LOAD_GUARD'] = os.getenv('LAZY_LOAD_GUARD', 'off')
+    # Per-request Server-Timing and X-Query-Count headers; 'off' hides them from clients
+    app.config['SERVER_TIMING_HEADERS'] = os.getenv('SERVER_TIMING_HEADERS', 'on') == 'on'
+    # Requests slower or chattier than these are logged as warnings with their slowest query
+    app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', 1000))
+    app.config['SLOW_REQUEST_QUERIES'] = int(os.getenv('SLOW_REQUEST_QUERIES', 50))
+    configure_json_provider(app)
+    configure_metrics(app)
     
     # Initialize extensions with the app
     db.init_app(app)
+    init_instrumentation(app)
+    init_db_routing(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
     toolbar.init_app(app)
@@ -82,6 +123,9 @@ def create_app():
     app.register_blueprint(affiliate_bp)
     app.register_blueprint(api_bp, url_prefix='/api/v1')
 
+    # Maintenance commands (flask rebuild-affiliate-stats, ...)
+    register_commands(app)
+
     # Root route handler
     @app.route('/')
     def index():
@@ -95,6 +139,9 @@ def create_app():
     with app.app_context():
         # Import models
         from models import User, Affiliate, Treatment, TreatmentGroup, Referral, Treatment_Status, Ticket, TicketResponse
+        # Register ORM listeners that maintain derived referral data
+        import referral_events
+        referral_events.register()
         # Drop and recreate all tables
         # db.drop_all()
         db.create_all()
@@ -119,9 +166,12 @@ def create_app():
             
     @app.before_request
     def before_request():
+        # Only write last_seen once it is stale, not on every request
         if current_user.is_authenticated:
-            current_user.last_seen = datetime.utcnow()
-            db.session.commit()
+            now = datetime.utcnow()
+            if current_user.last_seen is None or now - current_user.last_seen >= LAST_SEEN_INTERVAL:
+                current_user.last_seen = now
+                db.session.commit()
             
     # Log all requests
     @app.after_request
@@ -142,6 +192,18 @@ def create_app():
             'pending_affiliates_count': get_pending_affiliates_count()
         }
 
+    # Write buffered API key timestamps and usage counts before the worker exits
+    def flush_api_key_usage():
+        from api_auth import last_used_buffer
+        from usage_service import usage_recorder
+        with app.app_context():
+            last_used_buffer.flush()
+            usage_recorder.flush()
+
+    atexit.register(flush_api_key_usage)
+    # Leave this worker's final metric values for the other workers to report
+    atexit.register(metrics_registry.write_snapshot)
+
     return app
 
 app = create_app()
@@ -0,0 +1,157 @@
+import click
+from extensions import db
+
+
+def register_commands(app):
+    """Attach the project's maintenance commands to ``flask``"""
+
+    @app.cli.command('rebuild-affiliate-stats')
+    @click.option('--verify', is_flag=True, help='Only report affiliates whose counters are out of date.')
+    def rebuild_affiliate_stats_command(verify):
+        """Rebuild per-affiliate referral counters from the referral table."""
+        from stats_service import rebuild_affiliate_stats, verify_affiliate_stats
+
+        if verify:
+            mismatches = verify_affiliate_stats()
+            for mismatch in mismatches:
+                click.echo(f"Affiliate {mismatch['affiliate_id']}: stored {mismatch['stored']}, expected {mismatch['expected']}")
+            click.echo(f"{len(mismatches)} affiliate(s) with stale counters")
+            if mismatches:
+                raise SystemExit(1)
+            return
+
+        rebuild_affiliate_stats()
+        db.session.commit()
+        click.echo('Affiliate counters rebuilt')
+
+    @app.cli.command('rebuild-referral-daily-stats')
+    @click.option('--verify', is_flag=True, help='Only report rollup rows that disagree with the referral table.')
+    def rebuild_referral_daily_stats_command(verify):
+        """Rebuild the daily referral rollup behind analytics from the referral table."""
+        from daily_stats_service import rebuild_daily_stats, verify_daily_stats
+
+        if verify:
+            mismatches = verify_daily_stats()
+            for mismatch in mismatches:
+                click.echo(f"{tuple(mismatch['key'])}: stored {mismatch['stored']}, expected {mismatch['expected']}")
+            click.echo(f"{len(mismatches)} stale rollup row(s)")
+            if mismatches:
+                raise SystemExit(1)
+            return
+
+        rebuild_daily_stats()
+        db.session.commit()
+        click.echo('Referral daily stats rebuilt')
+
+    @app.cli.command('reconcile-earnings')
+    @click.option('--verify', is_flag=True, help='Only report affiliates whose earnings disagree with the ledger.')
+    def reconcile_earnings_command(verify):
+        """Reset affiliate total earnings to their commission ledger sums."""
+        from ledger_service import reconcile_earnings, verify_earnings
+
+        if verify:
+            mismatches = verify_earnings()
+            for mismatch in mismatches:
+                click.echo(
+                    f"Affiliate {mismatch['affiliate_id']}: stored {mismatch['stored']}, "
+                    f"ledger {mismatch['ledger']}, completed referrals {mismatch['referrals']}"
+                )
+            click.echo(f"{len(mismatches)} affiliate(s) with inconsistent earnings")
+            if mismatches:
+                raise SystemExit(1)
+            return
+
+        corrected = reconcile_earnings()
+        db.session.commit()
+        click.echo(f'{corrected} affiliate total(s) reconciled with the ledger')
+
+    @app.cli.command('purge-idempotency-keys')
+    def purge_idempotency_keys_command():
+        """Delete stored idempotent responses whose TTL has passed."""
+        from idempotency import purge_expired_idempotency_records
+
+        removed = purge_expired_idempotency_records()
+        click.echo(f'Removed {removed} expired idempotency record(s)')
+
+    @app.cli.command('purge-api-usage')
+    @click.option('--days', default=35, show_default=True, help='Keep this many days of hourly usage.')
+    def purge_api_usage_command(days):
+        """Delete old hourly API usage rollups; daily rollups are kept."""
+        from usage_service import purge_hourly_usage
+
+        removed = purge_hourly_usage(days)
+        click.echo(f'Removed {removed} hourly API usage row(s)')
+
+    @app.cli.command('check-query-plans')
+    @click.option('--seed', default=0, show_default=True, help='Insert this many synthetic referrals (rolled back) before explaining.')
+    def check_query_plans_command(seed):
+        """EXPLAIN the hot queries and fail if any falls back to a sequential scan."""
+        from query_plans import check_query_plans
+
+        try:
+            results = check_query_plans(seed)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+
+        for result in results:
+            status = 'ok  ' if result.passed else 'FAIL'
+            click.echo(f'{status} {result.name}: {result.summary}')
+        failed = [result for result in results if not result.passed]
+        click.echo(f'{len(results) - len(failed)}/{len(results)} query plans use indexes')
+        if failed:
+            raise SystemExit(1)
+
+    @app.cli.command('crm-worker')
+    @click.option('--workers', default=2, show_default=True, help='Number of worker threads.')
+    @click.option('--batch-size', default=100, show_default=True, help='Events claimed per batch.')
+    @click.option('--poll-interval', default=1.0, show_default=True, help='Seconds an idle worker waits between polls.')
+    @click.option('--once', is_flag=True, help='Drain the queue in this process and exit.')
+    def crm_worker_command(workers, batch_size, poll_interval, once):
+        """Process queued CRM webhook events."""
+        import crm_service
+
+        if once:
+            worker_id = crm_service.worker_id('once')
+            total = 0
+            while True:
+                processed = crm_service.process_next_batch(worker_id, batch_size)
+                if not processed:
+                    break
+                total += processed
+            click.echo(f'Processed {total} CRM event(s)')
+            return
+
+        threads, stop = crm_service.start_crm_workers(app, workers, batch_size, poll_interval)
+        click.echo(f'Started {workers} CRM worker(s); press Ctrl+C to stop')
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            click.echo('Stopping CRM workers...')
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    @app.cli.command('import-crm-completions')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'import_format', type=click.Choice(['json', 'ndjson', 'csv']), help='Defaults to the file extension.')
+    @click.option('--dry-run', is_flag=True, help='Report what would change, then roll back.')
+    def import_crm_completions_command(path, import_format, dry_run):
+        """Import historical CRM treatment completions from a file."""
+        import crm_import
+
+        import_format = import_format or crm_import.detect_format(path)
+        with open(path, 'rb') as stream:
+            report = crm_import.import_treatment_completions(
+                crm_import.read_import_rows(stream, import_format), dry_run=dry_run
+            )
+
+        click.echo(f"{'Dry run: ' if dry_run else ''}{report['total']} rows read")
+        click.echo(f"  completed:         {report['completed']}")
+        click.echo(f"  already completed: {report['already_completed']}")
+        for reason, count in report['unmatched'].items():
+            click.echo(f"  {reason + ':':<19}{count}")
+        click.echo(f"  affiliates updated: {report['affiliates_updated']}")
+        for sample in report['samples']:
+            click.echo(f"Row {sample['row']} ({sample['email']}, {sample['treatment_name']}): {sample['reason']}")
@@ -0,0 +1,114 @@
+"""Set-based commission recalculation for completed referrals.
+
+When a treatment group's commission, a treatment's group or an affiliate's
+rate changes, every affected completed referral is repriced with a single
+``UPDATE referral ... FROM treatment, treatment_group`` rather than one
+commit per referral. The per-affiliate differences then go through the
+commission ledger, the stats counters and the daily rollup in one pass
+each. Referrals keep their commission when their group has no positive
+commission set, as Referral.calculate_and_update_commission does.
+"""
+from collections import defaultdict
+from decimal import Decimal
+import logging
+from sqlalchemy import select, update
+from extensions import db
+from models import Referral, Treatment, TreatmentGroup
+from referral_events import ReferralState
+import daily_stats_service
+import ledger_service
+import stats_service
+
+
+def _stale_criteria(group_ids=None, treatment_ids=None, affiliate_ids=None):
+    """Completed referrals whose commission differs from their group's"""
+    criteria = [
+        Referral.status == 'completed',
+        Referral.treatment_id == Treatment.id,
+        Treatment.group_id == TreatmentGroup.id,
+        TreatmentGroup.commission_amount > 0,
+        Referral.commission_amount.is_distinct_from(TreatmentGroup.commission_amount),
+    ]
+    if group_ids is not None:
+        criteria.append(TreatmentGroup.id.in_(group_ids))
+    if treatment_ids is not None:
+        criteria.append(Treatment.id.in_(treatment_ids))
+    if affiliate_ids is not None:
+        criteria.append(Referral.affiliate_id.in_(affiliate_ids))
+    return criteria
+
+
+def recalculate_commissions(group_ids=None, treatment_ids=None, affiliate_ids=None):
+    """Reprice completed referrals from their treatment group's commission.
+
+    Limited to the given groups, treatments and/or affiliates; with none of
+    them every completed referral is checked. Runs in the current session
+    transaction and flushes pending changes first; the caller commits.
+    Returns a summary of what changed:
+    {'referrals_updated', 'affiliates_updated', 'total_delta', 'affiliates': [
+    {'affiliate_id', 'referrals', 'delta'}, ...]}
+    """
+    db.session.flush()
+    connection = db.session.connection()
+    criteria = _stale_criteria(group_ids, treatment_ids, affiliate_ids)
+
+    # Lock the rows being repriced so the ledger matches what the UPDATE writes
+    stale = connection.execute(
+        select(
+            Referral.id, Referral.affiliate_id, Referral.commission_amount, TreatmentGroup.commission_amount,
+            TreatmentGroup.id, Referral.country, Referral.created_at
+        )
+        .where(*criteria)
+        .order_by(Referral.id)
+        .with_for_update(of=Referral.__table__)
+    ).all()
+
+    entries = []
+    stats_deltas = stats_service.StatsDeltas()
+    rollup = daily_stats_service.RollupDeltas()
+    per_affiliate = defaultdict(lambda: {'referrals': 0, 'delta': Decimal('0')})
+    for referral_id, affiliate_id, old_amount, new_amount, group_id, country, created_at in stale:
+        entries.extend(ledger_service.referral_entries(
+            referral_id,
+            ReferralState(affiliate_id, 'completed', old_amount),
+            ReferralState(affiliate_id, 'completed', new_amount)
+        ))
+        stats_deltas.add(affiliate_id, stats_service.referral_contribution('completed', old_amount), sign=-1)
+        stats_deltas.add(affiliate_id, stats_service.referral_contribution('completed', new_amount))
+        # Same rollup row before and after; only its commission sum moves
+        key = daily_stats_service.RollupKey(
+            created_at.date(), affiliate_id, group_id, country or daily_stats_service.NO_COUNTRY, 'completed'
+        )
+        rollup.add(key, old_amount, sign=-1)
+        rollup.add(key, new_amount)
+        summary = per_affiliate[affiliate_id]
+        summary['referrals'] += 1
+        summary['delta'] += Decimal(str(new_amount)) - Decimal(str(old_amount or 0))
+
+    if stale:
+        connection.execute(
+            update(Referral.__table__)
+            .where(Referral.__table__.c.id.in_([row[0] for row in stale]), *criteria[1:4])
+            .values(commission_amount=TreatmentGroup.commission_amount)
+        )
+        ledger_service.append_entries(connection, entries)
+        stats_service.apply_stats_deltas(connection, stats_deltas)
+        daily_stats_service.apply_rollup_deltas(connection, rollup)
+        # The rows changed behind the ORM; reload them on next access
+        db.session.expire_all()
+
+    affiliates = [
+        {'affiliate_id': affiliate_id, 'referrals': summary['referrals'], 'delta': summary['delta']}
+        for affiliate_id, summary in sorted(per_affiliate.items())
+    ]
+    total_delta = sum((summary['delta'] for summary in affiliates), Decimal('0'))
+    logging.info(
+        f"Recalculated commissions: {len(stale)} referral(s) across {len(affiliates)} affiliate(s), "
+        f"earnings delta {total_delta}"
+    )
+    return {
+        'referrals_updated': len(stale),
+        'affiliates_updated': len(affiliates),
+        'total_delta': total_delta,
+        'affiliates': affiliates,
+    }
@@ -0,0 +1,67 @@
+import gzip
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # Optional; responses fall back to gzip without it
+    brotli = None
+
+COMPRESSION_MIN_SIZE = 1024  # bytes; smaller bodies are not worth the CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # good ratio at a cost close to gzip level 6 for dynamic content
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'image/svg+xml',
+}
+
+
+def _is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def _negotiate_encoding():
+    """Pick the client's preferred encoding we support, honouring q-values"""
+    supported = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(supported)
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response):
+    """Compress a finished response according to the request's Accept-Encoding.
+
+    Used as an ``after_request`` hook. Streamed responses, error responses and
+    bodies under COMPRESSION_MIN_SIZE are left untouched.
+    """
+    response.vary.add('Accept-Encoding')
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or not 200 <= response.status_code < 300
+        or response.status_code == 204
+        or 'Content-Encoding' in response.headers
+        or not _is_compressible(response.mimetype)
+    ):
+        return response
+
+    min_size = current_app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE)
+    if response.content_length is not None and response.content_length < min_size:
+        return response
+
+    encoding = _negotiate_encoding()
+    if not encoding:
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    response.set_data(_compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
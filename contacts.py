@@ -0,0 +1,62 @@
+from flask import current_app, has_app_context
+from countries import COUNTRIES
+
+# ISO country code -> dial code digits, e.g. 'TR' -> '90'
+DIAL_CODES = {country['code']: country['dial_code'].lstrip('+') for country in COUNTRIES}
+
+E164_MIN_DIGITS = 7
+E164_MAX_DIGITS = 15
+
+
+def normalize_email(email):
+    """Lower-cased, trimmed email used for matching, or None"""
+    if not email:
+        return None
+    normalized = email.strip().lower()
+    return normalized or None
+
+
+def _default_country():
+    return current_app.config.get('DEFAULT_PHONE_COUNTRY') if has_app_context() else None
+
+
+def normalize_phone(phone, country=None):
+    """Best-effort E.164 form (+905551234567) of a phone number, or None.
+
+    Numbers written with a leading + or 00 are taken as international.
+    Otherwise ``country``, or the DEFAULT_PHONE_COUNTRY setting when there is
+    none, supplies the dial code and a national trunk 0 is dropped. Without
+    either the number cannot be made E.164 and None is returned, so it never
+    matches on phone.
+    """
+    if not phone:
+        return None
+    raw = phone.strip()
+    digits = ''.join(ch for ch in raw if ch.isdigit())
+    if not digits:
+        return None
+
+    country = (country or _default_country() or '').upper()
+    if raw.startswith('+'):
+        number = digits
+    elif digits.startswith('00'):
+        number = digits[2:]
+    elif country in DIAL_CODES:
+        dial_code = DIAL_CODES[country]
+        national = digits.lstrip('0')
+        # Long numbers that already begin with the dial code were stored with it
+        number = national if national.startswith(dial_code) and len(digits) > 10 else dial_code + national
+    else:
+        return None
+
+    if not E164_MIN_DIGITS <= len(number) <= E164_MAX_DIGITS:
+        return None
+    return f'+{number}'
+
+
+def contact_fields(email, phone, country=None):
+    """Values for Referral.email_normalized and Referral.phone_e164"""
+    return {
+        'email_normalized': normalize_email(email),
+        'phone_e164': normalize_phone(phone, country),
+    }
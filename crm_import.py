@@ -0,0 +1,346 @@
+"""Set-based import of historical CRM treatment completions.
+
+Rows are validated and their treatment names resolved in Python, then
+staged in a temporary table. Matching to referrals, commission and status
+updates, treatment status upserts and counter rebuilds each run as a single
+SQL statement over the whole import, however many rows it has. Outbound
+referral.completed webhooks are not sent for imported history.
+"""
+import csv
+import io
+import json
+import logging
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import (
+    Boolean, Column, Integer, MetaData, Numeric, String, Table,
+    and_, case, exists, func, insert, literal, not_, select, update
+)
+from extensions import db
+from models import Referral, Treatment, TreatmentGroup, Treatment_Status
+from contacts import normalize_email
+from crm_service import validate_treatment_completed
+from mapping_resolver import treatment_name_resolver
+from referral_events import ReferralState
+import daily_stats_service
+import ledger_service
+import stats_service
+
+IMPORT_FORMATS = ('json', 'ndjson', 'csv')
+STAGING_CHUNK_SIZE = 5000
+SAMPLE_LIMIT = 100  # unmatched rows listed in the report
+UNMATCHED_REASONS = {
+    'invalid': 'Missing or invalid fields',
+    'no_mapping': 'No treatment mapping for this name',
+    'no_referral': 'No referral with this email',
+    'no_active_treatment': 'Mapped treatment group has no active treatments',
+    'duplicate': 'Another row in this import already completes the same referral',
+}
+
+_metadata = MetaData()
+_staged_rows = Table(
+    'crm_import_row', _metadata,
+    Column('row_no', Integer, primary_key=True),
+    Column('email_normalized', String(120), nullable=False),
+    Column('treatment_group_id', Integer, nullable=False),
+    Column('treatment_name', String(200), nullable=False),
+    prefixes=['TEMPORARY']
+)
+_matches = Table(
+    'crm_import_match', _metadata,
+    Column('row_no', Integer, primary_key=True),
+    Column('referral_id', Integer, nullable=False),
+    Column('occurrence', Integer, nullable=False),
+    Column('treatment_id', Integer),
+    Column('commission', Numeric(10, 2)),
+    Column('applied', Boolean, nullable=False, default=False),
+    prefixes=['TEMPORARY']
+)
+
+
+def detect_format(filename, default='csv'):
+    """Guess the import format from a file name"""
+    extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    if extension in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    if extension in IMPORT_FORMATS:
+        return extension
+    return default
+
+
+def read_import_rows(stream, import_format):
+    """Yield row dicts from a binary stream of CSV, NDJSON or a JSON array"""
+    if import_format == 'json':
+        rows = json.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError('JSON imports must be an array of objects')
+        yield from rows
+        return
+
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if import_format == 'csv':
+        yield from csv.DictReader(text)
+        return
+
+    for line_no, line in enumerate(text, start=1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise ValueError(f'Invalid JSON on line {line_no}')
+
+
+def _sample(row_no, row, reason):
+    row = row if isinstance(row, dict) else {}
+    return {
+        'row': row_no,
+        'email': row.get('email'),
+        'treatment_name': row.get('treatment_name'),
+        'reason': reason,
+    }
+
+
+def _stage(connection, rows, outcomes, samples):
+    """Validate rows, resolve treatment names and insert them in chunks"""
+    total = 0
+    iterator = enumerate(rows, start=1)
+    while True:
+        chunk = list(islice(iterator, STAGING_CHUNK_SIZE))
+        if not chunk:
+            break
+        total += len(chunk)
+
+        valid = [(row_no, row) for row_no, row in chunk if validate_treatment_completed(row) is None]
+        if len(valid) < len(chunk):
+            valid_numbers = {row_no for row_no, _ in valid}
+            for row_no, row in chunk:
+                if row_no not in valid_numbers:
+                    outcomes['invalid'] += 1
+                    if len(samples) < SAMPLE_LIMIT:
+                        samples.append(_sample(row_no, row, 'invalid'))
+
+        mappings = treatment_name_resolver.resolve_many({row['treatment_name'] for _, row in valid})
+        staged = []
+        for row_no, row in valid:
+            mapping = mappings[row['treatment_name']]
+            if not mapping:
+                outcomes['no_mapping'] += 1
+                if len(samples) < SAMPLE_LIMIT:
+                    samples.append(_sample(row_no, row, 'no_mapping'))
+                continue
+            staged.append({
+                'row_no': row_no,
+                'email_normalized': normalize_email(row['email']),
+                'treatment_group_id': mapping.treatment_group_id,
+                'treatment_name': row['treatment_name'].strip()[:200],
+            })
+        if staged:
+            connection.execute(insert(_staged_rows), staged)
+    return total
+
+
+def _match(connection):
+    """Pick one referral and treatment per staged row with a single INSERT ... SELECT"""
+    referral = Referral.__table__
+    ranked = select(
+        _staged_rows.c.row_no,
+        _staged_rows.c.treatment_group_id,
+        referral.c.id.label('referral_id'),
+        # Same rule as the webhook: latest non-completed referral, then latest completed
+        func.row_number().over(
+            partition_by=_staged_rows.c.row_no,
+            order_by=(
+                case((referral.c.status == 'completed', 1), else_=0),
+                referral.c.created_at.desc(),
+                referral.c.id.desc()
+            )
+        ).label('choice')
+    ).join(referral, referral.c.email_normalized == _staged_rows.c.email_normalized).subquery()
+
+    chosen = select(
+        ranked.c.row_no,
+        ranked.c.treatment_group_id,
+        ranked.c.referral_id,
+        func.row_number().over(partition_by=ranked.c.referral_id, order_by=ranked.c.row_no).label('occurrence')
+    ).where(ranked.c.choice == 1).subquery()
+
+    first_treatment = select(
+        Treatment.group_id,
+        func.min(Treatment.id).label('treatment_id')
+    ).where(Treatment.active == True).group_by(Treatment.group_id).subquery()
+
+    connection.execute(insert(_matches).from_select(
+        ['row_no', 'referral_id', 'occurrence', 'treatment_id', 'commission', 'applied'],
+        select(
+            chosen.c.row_no,
+            chosen.c.referral_id,
+            chosen.c.occurrence,
+            first_treatment.c.treatment_id,
+            TreatmentGroup.commission_amount,
+            literal(False)
+        ).select_from(chosen).join(
+            TreatmentGroup, TreatmentGroup.id == chosen.c.treatment_group_id
+        ).outerjoin(
+            first_treatment, first_treatment.c.group_id == chosen.c.treatment_group_id
+        )
+    ))
+
+    # Flag the rows that will change a referral before any referral is touched
+    already_completed = and_(referral.c.status == 'completed', referral.c.treatment_id == _matches.c.treatment_id)
+    connection.execute(update(_matches).where(
+        referral.c.id == _matches.c.referral_id,
+        _matches.c.occurrence == 1,
+        _matches.c.treatment_id.isnot(None),
+        not_(already_completed)
+    ).values(applied=True))
+
+
+def _outcome_column():
+    return case(
+        (_matches.c.row_no.is_(None), 'no_referral'),
+        (_matches.c.occurrence > 1, 'duplicate'),
+        (_matches.c.treatment_id.is_(None), 'no_active_treatment'),
+        (_matches.c.applied == True, 'completed'),
+        else_='already_completed'
+    )
+
+
+def _summarize(connection, outcomes, samples):
+    outcome = _outcome_column().label('outcome')
+    joined = _staged_rows.outerjoin(_matches, _matches.c.row_no == _staged_rows.c.row_no)
+    for name, count in connection.execute(select(outcome, func.count()).select_from(joined).group_by(outcome)):
+        outcomes[name] += count
+
+    if len(samples) < SAMPLE_LIMIT:
+        unmatched = connection.execute(select(
+            _staged_rows.c.row_no, _staged_rows.c.email_normalized, _staged_rows.c.treatment_name, outcome
+        ).select_from(joined).where(
+            outcome.in_(['no_referral', 'duplicate', 'no_active_treatment'])
+        ).order_by(_staged_rows.c.row_no).limit(SAMPLE_LIMIT - len(samples)))
+        for row in unmatched:
+            samples.append({
+                'row': row.row_no,
+                'email': row.email_normalized,
+                'treatment_name': row.treatment_name,
+                'reason': row.outcome,
+            })
+
+
+def _apply(connection, now):
+    """Complete matched referrals and upsert their treatment status; return affected affiliates"""
+    referral = Referral.__table__
+    treatment_status = Treatment_Status.__table__
+    applied = select(_matches.c.referral_id).where(_matches.c.applied == True)
+
+    # Core updates bypass the ORM listeners, so record earnings and rollup changes here
+    rows = connection.execute(select(
+        referral.c.id, referral.c.affiliate_id, referral.c.status, referral.c.commission_amount,
+        referral.c.treatment_id, referral.c.country, referral.c.created_at,
+        _matches.c.commission, _matches.c.treatment_id.label('new_treatment_id')
+    ).where(referral.c.id == _matches.c.referral_id, _matches.c.applied == True)).all()
+    groups = daily_stats_service.treatment_groups(
+        connection, {row.treatment_id for row in rows} | {row.new_treatment_id for row in rows}
+    )
+    entries = []
+    rollup = daily_stats_service.RollupDeltas()
+    affiliate_ids = set()
+    for row in rows:
+        affiliate_ids.add(row.affiliate_id)
+        old = ReferralState(row.affiliate_id, row.status, row.commission_amount,
+                            row.treatment_id, row.country, row.created_at)
+        new = old._replace(status='completed', commission_amount=row.commission, treatment_id=row.new_treatment_id)
+        entries.extend(ledger_service.referral_entries(row.id, old, new, now))
+        rollup.add(daily_stats_service.rollup_key(old, groups), old.commission_amount, -1)
+        rollup.add(daily_stats_service.rollup_key(new, groups), new.commission_amount)
+    ledger_service.append_entries(connection, entries)
+    daily_stats_service.apply_rollup_deltas(connection, rollup)
+
+    connection.execute(update(referral).where(
+        referral.c.id == _matches.c.referral_id,
+        _matches.c.applied == True
+    ).values(
+        status='completed',
+        treatment_id=_matches.c.treatment_id,
+        commission_amount=_matches.c.commission,
+        updated_at=now
+    ))
+
+    connection.execute(update(treatment_status).where(
+        treatment_status.c.referral_id.in_(applied)
+    ).values(end_date=now, outcome='success', updated_at=now))
+
+    connection.execute(insert(treatment_status).from_select(
+        ['referral_id', 'notes', 'end_date', 'outcome', 'created_at', 'updated_at'],
+        select(
+            _matches.c.referral_id,
+            literal('Treatment completed: ') + _staged_rows.c.treatment_name,
+            literal(now),
+            literal('success'),
+            literal(now),
+            literal(now)
+        ).join(
+            _staged_rows, _staged_rows.c.row_no == _matches.c.row_no
+        ).where(
+            _matches.c.applied == True,
+            not_(exists().where(treatment_status.c.referral_id == _matches.c.referral_id))
+        )
+    ))
+    return affiliate_ids
+
+
+def import_treatment_completions(rows, dry_run=False):
+    """Import an iterable of {email, full_name, treatment_name} rows; return a report.
+
+    Everything runs in one transaction. With ``dry_run`` the report is
+    produced and the transaction rolled back.
+    """
+    outcomes = Counter()
+    samples = []
+    now = datetime.utcnow()
+    connection = db.session.connection()
+    _metadata.create_all(connection)
+    try:
+        total = _stage(connection, rows, outcomes, samples)
+        _match(connection)
+        _summarize(connection, outcomes, samples)
+        affiliate_ids = _apply(connection, now)
+
+        # Core updates bypass the ORM listeners, so rebuild derived data here
+        if affiliate_ids:
+            stats_service.rebuild_affiliate_stats(affiliate_ids)
+        _metadata.drop_all(connection)
+
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        _drop_staging_tables()
+        raise
+
+    report = {
+        'total': total,
+        'completed': outcomes['completed'],
+        'already_completed': outcomes['already_completed'],
+        'unmatched': {reason: outcomes[reason] for reason in UNMATCHED_REASONS},
+        'affiliates_updated': len(affiliate_ids),
+        'samples': samples,
+        'dry_run': dry_run,
+    }
+    logging.info(
+        f"CRM import{' (dry run)' if dry_run else ''}: {total} rows, {report['completed']} completed, "
+        f"{report['already_completed']} already completed, {sum(report['unmatched'].values())} unmatched"
+    )
+    return report
+
+
+def _drop_staging_tables():
+    """Drop leftovers on databases where DDL is not rolled back with the transaction"""
+    try:
+        _metadata.drop_all(db.session.connection(), checkfirst=True)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Could not drop CRM import staging tables: {str(e)}")
@@ -0,0 +1,300 @@
+"""Durable intake queue for CRM events and the worker that drains it.
+
+The webhook only stores the event and returns 202. Workers (``flask
+crm-worker``) claim pending events in batches, resolve every lookup for the
+batch with a handful of queries, apply each event inside its own savepoint
+and record a per-event status, so one bad event never blocks the rest.
+"""
+import logging
+import os
+import socket
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import or_, select, update
+from sqlalchemy.orm import selectinload
+from extensions import db
+from models import Affiliate, CrmEvent, Referral, Treatment, TreatmentGroup, Treatment_Status
+from mapping_resolver import treatment_name_resolver
+from contacts import normalize_email, normalize_phone
+from webhook_service import trigger_webhook_events
+
+TREATMENT_COMPLETED = 'treatment.completed'
+REQUIRED_TREATMENT_FIELDS = ['email', 'full_name', 'treatment_name']
+CRM_BATCH_SIZE = 100
+CRM_POLL_INTERVAL = 1.0  # seconds an idle worker waits before polling again
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 30  # seconds, multiplied by the attempt number
+PROCESSING_TIMEOUT = 300  # seconds before an event claimed by a dead worker is retried
+
+
+class CrmEventError(Exception):
+    """A permanent problem with an event; it is marked failed without retrying"""
+
+
+def validate_treatment_completed(data):
+    """Return an error message for an invalid treatment-completed payload, or None"""
+    if not isinstance(data, dict):
+        return 'Request body must be a JSON object'
+    missing = [field for field in REQUIRED_TREATMENT_FIELDS if not isinstance(data.get(field), str) or not data[field].strip()]
+    if missing:
+        return f"Missing required fields: {', '.join(missing)}"
+    return None
+
+
+def enqueue_crm_event(event_type, payload, external_id=None):
+    """Store an inbound event for the workers and return it"""
+    event = CrmEvent(
+        event_type=event_type,
+        payload=payload,
+        external_id=str(external_id) if external_id is not None else None
+    )
+    db.session.add(event)
+    db.session.commit()
+    return event
+
+
+def claim_crm_events(worker_id, batch_size=CRM_BATCH_SIZE):
+    """Mark up to ``batch_size`` due events as processing by ``worker_id``; return their ids"""
+    now = datetime.utcnow()
+    no_sync = {'synchronize_session': False}
+
+    # Put events back whose worker died mid-batch
+    db.session.execute(update(CrmEvent).where(
+        CrmEvent.status == 'processing',
+        CrmEvent.locked_at <= now - timedelta(seconds=PROCESSING_TIMEOUT)
+    ).values(status='pending', locked_at=None, locked_by=None), execution_options=no_sync)
+
+    candidates = db.session.scalars(select(CrmEvent.id).where(
+        CrmEvent.status == 'pending',
+        CrmEvent.available_at <= now
+    ).order_by(CrmEvent.id).limit(batch_size).with_for_update(skip_locked=True)).all()
+
+    claimed = []
+    if candidates:
+        # The status check keeps the claim safe on databases without SKIP LOCKED
+        claimed = db.session.scalars(update(CrmEvent).where(
+            CrmEvent.id.in_(candidates),
+            CrmEvent.status == 'pending'
+        ).values(
+            status='processing',
+            locked_at=now,
+            locked_by=worker_id,
+            attempts=CrmEvent.attempts + 1
+        ).returning(CrmEvent.id), execution_options=no_sync).all()
+    db.session.commit()
+    return claimed
+
+
+def _match_priority(referral):
+    """Latest non-completed referral first, then the latest completed one"""
+    return (referral.status != 'completed', referral.created_at or datetime.min, referral.id)
+
+
+def match_referrals(contacts):
+    """Pick the referral for each (email, phone) pair using the indexed contact columns.
+
+    All candidates are loaded with one query. A normalized email match wins
+    over a phone match, and among several matches _match_priority decides.
+    Returns {(email, phone): Referral or None}.
+    """
+    keys = {contact: (normalize_email(contact[0]), normalize_phone(contact[1])) for contact in contacts}
+    emails = {email for email, _ in keys.values() if email}
+    phones = {phone for _, phone in keys.values() if phone}
+
+    conditions = []
+    if emails:
+        conditions.append(Referral.email_normalized.in_(emails))
+    if phones:
+        conditions.append(Referral.phone_e164.in_(phones))
+
+    by_email = defaultdict(list)
+    by_phone = defaultdict(list)
+    if conditions:
+        for referral in Referral.query.options(
+            selectinload(Referral.treatment_status)
+        ).filter(or_(*conditions)):
+            by_email[referral.email_normalized].append(referral)
+            by_phone[referral.phone_e164].append(referral)
+
+    matches = {}
+    for contact, (email, phone) in keys.items():
+        candidates = (email and by_email.get(email)) or (phone and by_phone.get(phone)) or []
+        matches[contact] = max(candidates, key=_match_priority, default=None)
+    return matches
+
+
+def _contact(payload):
+    phone = payload.get('phone')
+    return payload['email'], str(phone) if phone is not None else None
+
+
+def _prefetch_completion_lookups(payloads):
+    """Resolve mappings and load the referrals, groups and treatments a batch needs"""
+    referrals = match_referrals({_contact(payload) for payload in payloads})
+    mappings = treatment_name_resolver.resolve_many({payload['treatment_name'] for payload in payloads})
+    group_ids = {mapping.treatment_group_id for mapping in mappings.values() if mapping}
+
+    groups = {}
+    treatments = {}
+    if group_ids:
+        groups = {group.id: group for group in TreatmentGroup.query.filter(TreatmentGroup.id.in_(group_ids))}
+        for treatment in Treatment.query.filter(
+            Treatment.group_id.in_(group_ids),
+            Treatment.active == True
+        ).order_by(Treatment.id):
+            treatments.setdefault(treatment.group_id, treatment)
+
+    return referrals, mappings, groups, treatments
+
+
+def complete_treatment(payload, referrals, mappings, groups, treatments):
+    """Apply one treatment-completed event; return (referral, treatment, commission, changed)"""
+    error = validate_treatment_completed(payload)
+    if error:
+        raise CrmEventError(error)
+
+    referral = referrals.get(_contact(payload))
+    if not referral:
+        raise CrmEventError('No referral matches the contact details in the event')
+
+    mapping = mappings.get(payload['treatment_name'])
+    if not mapping:
+        raise CrmEventError(f"No mapping found for treatment: {payload['treatment_name']}")
+
+    treatment = treatments.get(mapping.treatment_group_id)
+    if not treatment:
+        raise CrmEventError('The mapped treatment group has no active treatments')
+
+    commission = float(groups[mapping.treatment_group_id].commission_amount or 0)
+
+    # A repeat of a completion we already recorded changes nothing
+    if referral.status == 'completed' and referral.treatment_id == treatment.id:
+        return referral, treatment, float(referral.commission_amount or 0), False
+
+    referral.treatment_id = treatment.id
+    referral.status = 'completed'
+    referral.commission_amount = commission
+
+    if not referral.treatment_status:
+        referral.treatment_status = Treatment_Status(
+            notes=f"Treatment completed: {payload['treatment_name']}"
+        )
+    referral.treatment_status.end_date = datetime.utcnow()
+    referral.treatment_status.outcome = 'success'
+    return referral, treatment, commission, True
+
+
+def _schedule_retry(event, error, now):
+    # Driver errors can echo bound parameters; the full text is only logged
+    event.last_error = f"{type(error).__name__} while processing event {event.id}; see the worker log"
+    event.locked_at = None
+    event.locked_by = None
+    if event.attempts >= MAX_ATTEMPTS:
+        event.status = 'failed'
+        event.processed_at = now
+    else:
+        event.status = 'pending'
+        event.available_at = now + timedelta(seconds=RETRY_BACKOFF * event.attempts)
+
+
+def process_crm_events(event_ids):
+    """Apply claimed events, recording a status on each, and commit once"""
+    events = CrmEvent.query.filter(CrmEvent.id.in_(event_ids)).order_by(CrmEvent.id).all()
+    completions = [
+        event.payload for event in events
+        if event.event_type == TREATMENT_COMPLETED and validate_treatment_completed(event.payload) is None
+    ]
+    lookups = _prefetch_completion_lookups(completions) if completions else ({}, {}, {}, {})
+
+    now = datetime.utcnow()
+    completed = []
+    for event in events:
+        try:
+            with db.session.begin_nested():
+                if event.event_type != TREATMENT_COMPLETED:
+                    raise CrmEventError(f"Unsupported event type: {event.event_type}")
+                referral, treatment, commission, changed = complete_treatment(event.payload, *lookups)
+        except CrmEventError as e:
+            event.status = 'failed'
+            event.last_error = str(e)
+            event.processed_at = now
+            continue
+        except Exception as e:
+            logging.error(f"Error processing CRM event {event.id}: {str(e)}")
+            _schedule_retry(event, e, now)
+            continue
+
+        event.status = 'done'
+        event.last_error = None
+        event.referral_id = referral.id
+        event.processed_at = now
+        if changed:
+            completed.append((referral, treatment, commission))
+
+    db.session.flush()
+
+    # Capture webhook payloads before commit expires the referrals
+    affiliate_users = dict(db.session.query(Affiliate.id, Affiliate.user_id).filter(
+        Affiliate.id.in_({referral.affiliate_id for referral, _, _ in completed})
+    )) if completed else {}
+    outbound = [(
+        'referral.completed',
+        {
+            'id': referral.id,
+            'email': referral.email,
+            'treatment': treatment.name,
+            'commission_amount': commission,
+            'affiliate_id': referral.affiliate_id
+        },
+        affiliate_users.get(referral.affiliate_id)
+    ) for referral, treatment, commission in completed]
+
+    db.session.commit()
+    if outbound:
+        trigger_webhook_events(outbound)
+
+    logging.info(f"Processed {len(events)} CRM events, {len(completed)} referral(s) completed")
+    return len(events)
+
+
+def process_next_batch(worker_id, batch_size=CRM_BATCH_SIZE):
+    """Claim and process one batch; return how many events it held"""
+    event_ids = claim_crm_events(worker_id, batch_size)
+    if not event_ids:
+        return 0
+    return process_crm_events(event_ids)
+
+
+def worker_id(suffix):
+    """Identify a worker in locked_by as host:pid:suffix"""
+    return f"{socket.gethostname()}:{os.getpid()}:{suffix}"
+
+
+def _worker_loop(app, worker_id, stop, batch_size, poll_interval):
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                processed = process_next_batch(worker_id, batch_size)
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"CRM worker {worker_id} failed a batch: {str(e)}")
+                processed = 0
+            if not processed:
+                stop.wait(poll_interval)
+
+
+def start_crm_workers(app, workers=1, batch_size=CRM_BATCH_SIZE, poll_interval=CRM_POLL_INTERVAL):
+    """Start ``workers`` polling threads; return (threads, stop_event)"""
+    stop = threading.Event()
+    threads = []
+    for number in range(workers):
+        thread = threading.Thread(
+            target=_worker_loop,
+            args=(app, worker_id(number), stop, batch_size, poll_interval),
+            name=f"crm-worker-{number}",
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    return threads, stop
@@ -0,0 +1,148 @@
+"""Daily referral rollup (referral_daily_stats) behind analytics and the dashboards.
+
+One row per (creation day, affiliate, treatment group, country, status)
+holds a referral count and a commission sum. Rows are kept current with
+additive upserts from every referral write, so analytics read a table that
+grows with days x dimensions instead of scanning every referral. ORM writes
+are recorded by the flush listener in referral_events.py; bulk Core
+statements must call ``apply_rollup_deltas`` themselves.
+"""
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from decimal import Decimal
+import logging
+from sqlalchemy import Date, delete, func, select
+from extensions import db
+from models import Referral, ReferralDailyStats, Treatment
+from db_helpers import dialect_insert
+
+NO_GROUP = 0      # treatment_group_id of referrals whose treatment has no group
+NO_COUNTRY = ''   # country of referrals without one
+
+RollupKey = namedtuple('RollupKey', ['day', 'affiliate_id', 'treatment_group_id', 'country', 'status'])
+
+
+def rollup_key(state, treatment_groups):
+    """The rollup row a referral in ``state`` is counted in"""
+    created_at = state.created_at or datetime.utcnow()
+    return RollupKey(
+        day=created_at.date(),
+        affiliate_id=state.affiliate_id,
+        treatment_group_id=treatment_groups.get(state.treatment_id) or NO_GROUP,
+        country=state.country or NO_COUNTRY,
+        status=state.status or 'new'
+    )
+
+
+def treatment_groups(connection, treatment_ids):
+    """Map treatment id -> group id with one query"""
+    treatment_ids = {treatment_id for treatment_id in treatment_ids if treatment_id is not None}
+    if not treatment_ids:
+        return {}
+    return dict(connection.execute(
+        select(Treatment.id, Treatment.group_id).where(Treatment.id.in_(treatment_ids))
+    ).all())
+
+
+class RollupDeltas:
+    """Accumulate count and commission changes per rollup row before writing them"""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0, Decimal('0')])
+
+    def add(self, key, commission_amount, sign=1):
+        delta = self._deltas[key]
+        delta[0] += sign
+        delta[1] += sign * Decimal(str(commission_amount or 0))
+
+    def items(self):
+        for key, (count, commission) in sorted(self._deltas.items()):
+            if count or commission:
+                yield key, count, commission
+
+
+def apply_rollup_deltas(connection, deltas):
+    """Add accumulated changes to the rollup in the caller's transaction"""
+    rows = [
+        dict(key._asdict(), referral_count=count, commission_amount=commission)
+        for key, count, commission in deltas.items()
+    ]
+    if not rows:
+        return
+    table = ReferralDailyStats.__table__
+    statement = dialect_insert(connection, table)
+    # Rows arrive sorted by key so concurrent writers lock them in the same order
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[table.c[column] for column in RollupKey._fields],
+        set_={
+            'referral_count': table.c.referral_count + statement.excluded.referral_count,
+            'commission_amount': table.c.commission_amount + statement.excluded.commission_amount,
+        }
+    ), rows)
+
+
+def _referral_day():
+    return func.date(Referral.created_at, type_=Date)
+
+
+def _aggregate_query(days=None):
+    day = _referral_day()
+    group_id = func.coalesce(Treatment.group_id, NO_GROUP)
+    country = func.coalesce(Referral.country, NO_COUNTRY)
+    status = func.coalesce(Referral.status, 'new')
+    query = select(
+        day, Referral.affiliate_id, group_id, country, status,
+        func.count(Referral.id), func.coalesce(func.sum(Referral.commission_amount), 0)
+    ).select_from(Referral).outerjoin(
+        Treatment, Treatment.id == Referral.treatment_id
+    ).group_by(day, Referral.affiliate_id, group_id, country, status)
+    if days is not None:
+        query = query.where(day.in_(days))
+    return query
+
+
+def referral_days(connection, treatment_ids):
+    """Creation days of the referrals of ``treatment_ids``"""
+    day = _referral_day()
+    return set(connection.scalars(
+        select(day).distinct().where(Referral.treatment_id.in_(treatment_ids))
+    ))
+
+
+def rebuild_daily_stats(days=None, connection=None):
+    """Recompute rollup rows from the referral table with one aggregate query.
+
+    Rebuilds every day, or only ``days`` when given. Runs in the current
+    session transaction (or on ``connection``); the caller commits.
+    """
+    connection = connection or db.session.connection()
+    table = ReferralDailyStats.__table__
+    clear = delete(table)
+    if days is not None:
+        if not days:
+            return
+        clear = clear.where(table.c.day.in_(days))
+    connection.execute(clear)
+    connection.execute(table.insert().from_select(
+        list(RollupKey._fields) + ['referral_count', 'commission_amount'], _aggregate_query(days)
+    ))
+    logging.info(f"Rebuilt referral daily stats for {'all days' if days is None else f'{len(days)} day(s)'}")
+
+
+def verify_daily_stats():
+    """Compare stored rollup rows with a fresh aggregate; return mismatching keys"""
+    stored = {
+        RollupKey(*(row._mapping[field] for field in RollupKey._fields)):
+            (row.referral_count, Decimal(str(row.commission_amount or 0)))
+        for row in db.session.execute(select(ReferralDailyStats.__table__))
+        if row.referral_count or row.commission_amount
+    }
+    mismatches = []
+    for row in db.session.execute(_aggregate_query()):
+        key = RollupKey(*row[:5])
+        expected = (row[5], Decimal(str(row[6] or 0)))
+        actual = stored.pop(key, None)
+        if actual != expected:
+            mismatches.append({'key': key, 'expected': expected, 'stored': actual})
+    mismatches.extend({'key': key, 'expected': None, 'stored': actual} for key, actual in stored.items())
+    return mismatches
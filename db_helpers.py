@@ -0,0 +1,11 @@
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def dialect_insert(connection, table):
+    """Return an INSERT construct with ON CONFLICT support for the connection's dialect"""
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    raise NotImplementedError(f"Upserts are not supported on the {dialect} dialect")
@@ -0,0 +1,134 @@
+"""Send read-only views to a replica database.
+
+With DATABASE_REPLICA_URL set, the replica is registered as the 'replica'
+bind and db.session becomes a RoutingSession. Views decorated with
+``@read_only`` run their queries against the replica; everything else, and
+any flush, uses the primary. The replica is probed at most every
+REPLICA_HEALTH_INTERVAL seconds and skipped while it is unreachable.
+After a request writes to the primary, the browser session reads from the
+primary for REPLICA_STICKY_SECONDS, so a redirect back to a read-only view
+shows the change even if the replica has not replayed it yet.
+
+Locally, point DATABASE_REPLICA_URL at a second Postgres instance or at a
+copy of the SQLite file.
+"""
+from contextvars import ContextVar
+from functools import wraps
+import logging
+import time
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+REPLICA_BIND = 'replica'
+REPLICA_HEALTH_INTERVAL = 30  # seconds between replica reachability probes
+STICKY_SESSION_KEY = '_read_primary_until'
+
+_route = ContextVar('db_route', default=None)
+
+
+class _ReplicaHealth:
+    """Cache the outcome of a cheap replica probe for REPLICA_HEALTH_INTERVAL"""
+
+    def __init__(self):
+        self._checked_at = None
+        self._available = False
+
+    def available(self, engine):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < REPLICA_HEALTH_INTERVAL:
+            return self._available
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            available = True
+        except Exception as e:
+            available = False
+            logging.warning(f"Read replica unreachable, reading from the primary: {str(e)}")
+        if available and self._checked_at is not None and not self._available:
+            logging.info("Read replica reachable again")
+        self._checked_at = now
+        self._available = available
+        return available
+
+    def mark_down(self):
+        self._checked_at = time.monotonic()
+        self._available = False
+
+
+replica_health = _ReplicaHealth()
+
+
+class RoutingSession(Session):
+    """db.session that binds reads to the replica inside ``read_only`` views"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _route.get() == REPLICA_BIND and not self._flushing:
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _mark_primary_write():
+    if has_request_context():
+        g.wrote_primary = True
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    _mark_primary_write()
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        _mark_primary_write()
+
+
+def replica_configured():
+    return REPLICA_BIND in current_app.config.get('SQLALCHEMY_BINDS', {})
+
+
+def _use_replica(db):
+    if not replica_configured():
+        return False
+    if session.get(STICKY_SESSION_KEY, 0) > time.time():
+        return False
+    return replica_health.available(db.engines[REPLICA_BIND])
+
+
+def read_only(view):
+    """Run ``view``'s queries on the read replica when one is configured and healthy.
+
+    If the replica fails mid-request the view is run again on the primary;
+    it is read-only, so repeating it is safe.
+    """
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        from extensions import db
+        if not _use_replica(db):
+            return view(*args, **kwargs)
+        token = _route.set(REPLICA_BIND)
+        try:
+            return view(*args, **kwargs)
+        except OperationalError as e:
+            logging.warning(f"Read replica query failed, retrying {view.__name__} on the primary: {str(e)}")
+            replica_health.mark_down()
+            db.session.rollback()
+        finally:
+            _route.reset(token)
+        return view(*args, **kwargs)
+    return decorated_function
+
+
+def init_db_routing(app):
+    """Keep a logged-in browser session on the primary for a while after it writes"""
+
+    @app.after_request
+    def stick_to_primary(response):
+        sticky = app.config.get('REPLICA_STICKY_SECONDS', 0)
+        if sticky and g.get('wrote_primary') and replica_configured() and '_user_id' in session:
+            session[STICKY_SESSION_KEY] = time.time() + sticky
+        return response
@@ -4,6 +4,7 @@ import mandrill
 from jinja2 import Template
 from datetime import datetime
 import hashlib
+from instrumentation import track_http
 
 def get_mandrill_client():
     api_key = current_app.config['MANDRILL_API_KEY']
@@ -118,7 +119,8 @@ def send_email(to_email, subject, html_content):
             'tags': ['transactional']
         }
         
-        result = client.messages.send(message=message)
+        with track_http('mandrill'):
+            result = client.messages.send(message=message)
         return True
     except Exception as e:
         current_app.logger.error(f"Error sending email: {str(e)}")
@@ -0,0 +1,99 @@
+"""Benchmark JSON encoding and response compression for API-sized payloads.
+
+Builds a synthetic GET /api/v1/referrals page in the shape produced by
+Referral.to_dict() and reports encode CPU time per provider and bytes/CPU
+per compression encoding. No database is needed:
+
+    python examples/bench_serialization.py --rows 1000 --repeat 50
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_provider import FastJSONProvider  # noqa: E402
+from compression import GZIP_LEVEL, BROTLI_QUALITY, brotli  # noqa: E402
+
+STATUSES = ['new', 'in-progress', 'completed']
+COUNTRIES = ['TR', 'DE', 'GB', 'NL', 'US', 'FR']
+
+
+def build_page(rows):
+    """A referral list response like the API returns it"""
+    start = datetime(2024, 1, 1)
+    referrals = []
+    for i in range(rows):
+        created = start + timedelta(minutes=17 * i)
+        status = random.choice(STATUSES)
+        referrals.append({
+            'id': i + 1,
+            'name': f'Name{i}',
+            'surname': f'Surname{i}',
+            'email': f'patient{i}@example.com',
+            'phone': f'+90555{i:07d}',
+            'treatment': {
+                'id': i % 40 + 1,
+                'name': f'Treatment {i % 40 + 1}',
+                'group': {'id': i % 8 + 1, 'name': f'Group {i % 8 + 1}'}
+            },
+            'status': status,
+            'commission_amount': 150.0 if status == 'completed' else 0.0,
+            'country': random.choice(COUNTRIES),
+            'city': 'Istanbul',
+            'created_at': created.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': created.strftime('%Y-%m-%d %H:%M:%S')
+        })
+    return {'referrals': referrals, 'next_cursor': 'MjAyNC0wMS0wMVQwMDowMDowMHwxMjM', 'limit': rows}
+
+
+def cpu_time(func, repeat):
+    """Average process CPU time of ``func`` in milliseconds"""
+    start = time.process_time()
+    for _ in range(repeat):
+        result = func()
+    return (time.process_time() - start) * 1000 / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(42)
+    app = Flask(__name__)
+    page = build_page(args.rows)
+
+    print(f"Payload: {args.rows} referrals, averaged over {args.repeat} runs\n")
+    print(f"{'JSON provider':<16}{'encode ms':>12}{'bytes':>12}")
+    body = None
+    for name, provider in (('stdlib', DefaultJSONProvider(app)), ('fast', FastJSONProvider(app))):
+        if name == 'fast' and not provider.enabled:
+            print(f"{name:<16}{'orjson not installed':>24}")
+            continue
+        elapsed, encoded = cpu_time(lambda: provider.dumps(page, separators=(',', ':')), args.repeat)
+        body = encoded.encode('utf-8')
+        print(f"{name:<16}{elapsed:>12.2f}{len(body):>12,}")
+
+    encoders = [('identity', lambda: body), (f'gzip-{GZIP_LEVEL}', lambda: gzip.compress(body, compresslevel=GZIP_LEVEL))]
+    if brotli is not None:
+        encoders.append((f'br-{BROTLI_QUALITY}', lambda: brotli.compress(body, quality=BROTLI_QUALITY)))
+    else:
+        print('\nBrotli not installed; skipping br')
+
+    print(f"\n{'Encoding':<16}{'compress ms':>12}{'bytes':>12}{'saved':>10}")
+    for name, encode in encoders:
+        elapsed, compressed = cpu_time(encode, args.repeat)
+        saved = 100 * (1 - len(compressed) / len(body))
+        print(f"{name:<16}{elapsed:>12.2f}{len(compressed):>12,}{saved:>9.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_debugtoolbar import DebugToolbarExtension
+from db_routing import RoutingSession
 
-# Initialize extensions
-db = SQLAlchemy()
+# Initialize extensions; the routing session sends @read_only views to the replica
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 toolbar = DebugToolbarExtension()
@@ -0,0 +1,103 @@
+"""Sparse fieldsets (``fields=``) and compound includes (``include=``) for API resources.
+
+``fields=id,status`` limits the attributes serialized for the primary
+resource and ``include=treatment,group`` picks the related resources that
+are embedded. The same selection decides what is loaded: unrequested columns
+are left out of the SELECT and only the included relationships are
+eager-loaded, all many-to-one and joined into the one query. Without
+``include`` every related resource is embedded, unless ``fields`` is given:
+a sparse request embeds nothing it did not ask for.
+"""
+from sqlalchemy.orm import joinedload, load_only
+from models import Affiliate, Referral, Treatment
+
+# Included resources that are only reachable through another one
+REFERRAL_INCLUDE_PARENTS = {'group': 'treatment'}
+
+
+def _parse_list(value, allowed, kind):
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ValueError(
+            f"Unknown {kind}: {', '.join(unknown)}. Allowed values: {', '.join(allowed)}"
+        )
+    # Canonical order, whatever order the client listed them in
+    return tuple(name for name in allowed if name in names)
+
+
+def parse_fields(value, allowed):
+    """Parse a ``fields`` query parameter; None when absent means every field.
+
+    ``id`` is always returned so that rows stay identifiable.
+    """
+    if value is None:
+        return None
+    fields = _parse_list(value, allowed, 'field')
+    return ('id',) + tuple(field for field in fields if field != 'id')
+
+
+def parse_include(value, allowed, default, parents=None):
+    """Parse an ``include`` query parameter; ``default`` when absent"""
+    if value is None:
+        return default
+    include = set(_parse_list(value, allowed, 'include'))
+    for name, parent in (parents or {}).items():
+        if name in include:
+            include.add(parent)
+    return tuple(name for name in allowed if name in include)
+
+
+def _default_include(fields, allowed):
+    return allowed if fields is None else ()
+
+
+def referral_fieldset(args):
+    """(fields, include) requested for referrals in ``args``"""
+    fields = parse_fields(args.get('fields'), Referral.API_FIELDS)
+    include = parse_include(
+        args.get('include'), Referral.API_INCLUDES,
+        _default_include(fields, Referral.API_INCLUDES), REFERRAL_INCLUDE_PARENTS
+    )
+    return fields, include
+
+
+def treatment_fieldset(args):
+    """(fields, include) requested for treatments in ``args``"""
+    fields = parse_fields(args.get('fields'), Treatment.API_FIELDS)
+    include = parse_include(
+        args.get('include'), Treatment.API_INCLUDES, _default_include(fields, Treatment.API_INCLUDES)
+    )
+    return fields, include
+
+
+def referral_loader_options(fields, include):
+    """Loader options that fetch exactly what ``Referral.to_dict(fields, include)`` reads"""
+    options = []
+    if fields is not None:
+        # Pagination cursors read created_at/updated_at from the last row
+        columns = set(fields) | {'created_at', 'updated_at'}
+        if 'treatment' in include:
+            columns.add('treatment_id')
+        if 'affiliate' in include:
+            columns.add('affiliate_id')
+        options.append(load_only(*(getattr(Referral, column) for column in sorted(columns))))
+    if 'treatment' in include:
+        treatment = joinedload(Referral.treatment)
+        if 'group' in include:
+            treatment = treatment.joinedload(Treatment.group)
+        options.append(treatment)
+    if 'affiliate' in include:
+        options.append(joinedload(Referral.affiliate).joinedload(Affiliate.user))
+    return options
+
+
+def treatment_loader_options(fields, include):
+    """Loader options that fetch exactly what ``Treatment.to_dict(fields, include)`` reads"""
+    options = []
+    if fields is not None:
+        columns = set(fields) | ({'group_id'} if 'group' in include else set())
+        options.append(load_only(*(getattr(Treatment, column) for column in sorted(columns))))
+    if 'group' in include:
+        options.append(joinedload(Treatment.group))
+    return options
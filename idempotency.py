@@ -0,0 +1,159 @@
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, jsonify, request
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from extensions import db
+from models import IdempotencyRecord
+from db_helpers import dialect_insert
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAY_HEADER = 'Idempotent-Replayed'
+DEFAULT_IDEMPOTENCY_TTL = 24 * 3600  # seconds a stored response is replayed
+IN_PROGRESS_TIMEOUT = 60  # seconds before an unfinished claim is considered abandoned
+MAX_KEY_LENGTH = 255
+
+
+def _ttl():
+    return int(current_app.config.get('IDEMPOTENCY_TTL', DEFAULT_IDEMPOTENCY_TTL))
+
+
+def _request_hash():
+    """Fingerprint of the request so a reused key with a different body is caught"""
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.path}\n".encode('utf-8'))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _record_filter(table, scope, key):
+    return and_(table.c.scope == scope, table.c.key == key)
+
+
+def _claim(scope, key, request_hash):
+    """Reserve ``key`` for this request; return None on success or the existing record"""
+    table = IdempotencyRecord.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        # Free the key if it has expired or its first request died before finishing
+        conn.execute(delete(table).where(
+            _record_filter(table, scope, key),
+            or_(
+                table.c.expires_at <= now,
+                and_(
+                    table.c.status_code.is_(None),
+                    table.c.created_at <= now - timedelta(seconds=IN_PROGRESS_TIMEOUT)
+                )
+            )
+        ))
+        claimed = conn.execute(dialect_insert(conn, table).values(
+            scope=scope,
+            key=key,
+            request_hash=request_hash,
+            created_at=now,
+            expires_at=now + timedelta(seconds=_ttl())
+        ).on_conflict_do_nothing(index_elements=['scope', 'key'])).rowcount
+        if claimed:
+            return None
+        return conn.execute(select(table).where(_record_filter(table, scope, key))).first()
+
+
+def _store(scope, key, response):
+    table = IdempotencyRecord.__table__
+    with db.engine.begin() as conn:
+        conn.execute(update(table).where(_record_filter(table, scope, key)).values(
+            status_code=response.status_code,
+            response_body=response.get_data(as_text=True),
+            content_type=response.content_type
+        ))
+
+
+def _release(scope, key):
+    table = IdempotencyRecord.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(_record_filter(table, scope, key)))
+    except SQLAlchemyError as e:
+        logging.error(f"Could not release idempotency key {key}: {str(e)}")
+
+
+def _replay(record, request_hash):
+    if record.request_hash != request_hash:
+        return jsonify({
+            'error': 'Idempotency key reused',
+            'details': 'This key was already used for a different request'
+        }), 422
+    if record.status_code is None:
+        response = jsonify({
+            'error': 'Request in progress',
+            'details': 'A request with this idempotency key is still being processed'
+        })
+        response.status_code = 409
+        response.headers['Retry-After'] = '1'
+        return response
+
+    response = current_app.response_class(
+        record.response_body,
+        status=record.status_code,
+        content_type=record.content_type
+    )
+    response.headers[REPLAY_HEADER] = 'true'
+    return response
+
+
+def idempotent(scope, key_from=None):
+    """Replay the stored response when a request repeats an idempotency key.
+
+    The key comes from the ``Idempotency-Key`` header, or from ``key_from()``
+    (e.g. an event id in the body) when the header is missing. ``scope`` is a
+    string or a callable returning one, so keys from different clients never
+    collide. Requests without a key run normally. Responses with a 5xx status
+    are not stored, so the client can retry them.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER) or (key_from() if key_from else None)
+            if not key:
+                return f(*args, **kwargs)
+            key = str(key).strip()
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({
+                    'error': 'Invalid idempotency key',
+                    'details': f'Keys must be 1 to {MAX_KEY_LENGTH} characters'
+                }), 400
+
+            record_scope = scope() if callable(scope) else scope
+            request_hash = _request_hash()
+            existing = _claim(record_scope, key, request_hash)
+            if existing is not None:
+                return _replay(existing, request_hash)
+
+            try:
+                response = current_app.make_response(f(*args, **kwargs))
+            except Exception:
+                _release(record_scope, key)
+                raise
+
+            if response.status_code >= 500 or response.is_streamed:
+                _release(record_scope, key)
+            else:
+                try:
+                    _store(record_scope, key, response)
+                except SQLAlchemyError as e:
+                    logging.error(f"Could not store response for idempotency key {key}: {str(e)}")
+                    _release(record_scope, key)
+            return response
+        return decorated_function
+    return decorator
+
+
+def purge_expired_idempotency_records():
+    """Delete stored responses past their TTL; returns the number removed"""
+    table = IdempotencyRecord.__table__
+    with db.engine.begin() as conn:
+        removed = conn.execute(delete(table).where(table.c.expires_at <= datetime.utcnow())).rowcount
+    logging.info(f"Purged {removed} expired idempotency records")
+    return removed
@@ -0,0 +1,167 @@
+"""Request, database and outbound HTTP timing recorded into the metrics registry.
+
+Each request also counts its SQL statements, sums their time and keeps the
+slowest one. The totals are sent back as Server-Timing and X-Query-Count
+headers and logged with structured fields; requests over the
+SLOW_REQUEST_MS or SLOW_REQUEST_QUERIES thresholds are logged as warnings.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import registry
+
+DB_QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SLOWEST_STATEMENT_LENGTH = 300  # characters of the slowest statement kept for the log
+
+logger = logging.getLogger(__name__)
+
+REQUEST_LATENCY = registry.histogram(
+    'http_request_duration_seconds', 'Time to handle a request, by endpoint and status',
+    ['blueprint', 'endpoint', 'method', 'status']
+)
+REQUEST_DB_TIME = registry.histogram(
+    'http_request_db_seconds', 'Database time spent in a request, by endpoint',
+    ['blueprint', 'endpoint']
+)
+REQUEST_QUERY_COUNT = registry.histogram(
+    'http_request_db_queries', 'SQL statements executed in a request, by endpoint',
+    ['blueprint', 'endpoint'], buckets=QUERY_COUNT_BUCKETS
+)
+REQUESTS_IN_PROGRESS = registry.gauge(
+    'http_requests_in_progress', 'Requests currently being handled', ['blueprint']
+)
+# Labelled by tier, not key: per-key series would grow with every key ever
+# issued. Per-key request and error counts come from the usage rollups.
+API_KEY_LATENCY = registry.histogram(
+    'api_request_duration_seconds', 'Time to handle an API request, by API key tier and status',
+    ['tier', 'status']
+)
+DB_QUERY_LATENCY = registry.histogram(
+    'db_query_duration_seconds', 'Duration of individual SQL statements', buckets=DB_QUERY_BUCKETS
+)
+HTTP_CLIENT_LATENCY = registry.histogram(
+    'http_client_duration_seconds', 'Duration of outbound HTTP calls, by target and outcome',
+    ['target', 'outcome']
+)
+
+
+@contextmanager
+def track_http(target):
+    """Time an outbound HTTP call: ``with track_http('webhook'): requests.post(...)``"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        HTTP_CLIENT_LATENCY.observe(time.perf_counter() - start, target=target, outcome=outcome)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start_time')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    DB_QUERY_LATENCY.observe(elapsed)
+    if has_request_context():
+        g.db_time = g.get('db_time', 0.0) + elapsed
+        g.query_count = g.get('query_count', 0) + 1
+        slowest = g.get('slowest_query')
+        if slowest is None or elapsed > slowest[0]:
+            g.slowest_query = (elapsed, statement)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _discard_query_timer(context):
+    starts = context.connection.info.get('query_start_time') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def _labels():
+    return request.blueprint or 'app', request.endpoint or 'unmatched'
+
+
+def server_timing(elapsed, db_time, query_count):
+    """Server-Timing header value: DB time over ``query_count`` statements and total time"""
+    return f'db;dur={db_time * 1000:.1f};desc="{query_count} queries", total;dur={elapsed * 1000:.1f}'
+
+
+def _log_request(status, elapsed, db_time, query_count, slowest):
+    slowest_time, slowest_statement = slowest or (0.0, None)
+    if slowest_statement:
+        slowest_statement = ' '.join(slowest_statement.split())[:SLOWEST_STATEMENT_LENGTH]
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': status,
+        'duration_ms': round(elapsed * 1000, 1),
+        'db_ms': round(db_time * 1000, 1),
+        'query_count': query_count,
+        'slowest_query_ms': round(slowest_time * 1000, 1),
+        'slowest_query': slowest_statement,
+    }
+    slow_ms = current_app.config.get('SLOW_REQUEST_MS')
+    max_queries = current_app.config.get('SLOW_REQUEST_QUERIES')
+    outlier = (slow_ms and fields['duration_ms'] >= slow_ms) or (max_queries and query_count >= max_queries)
+
+    message = (f"{request.method} {request.path} {status} in {fields['duration_ms']}ms, "
+               f"{query_count} queries in {fields['db_ms']}ms")
+    if outlier:
+        logger.warning(f"Slow request: {message}; slowest query {fields['slowest_query_ms']}ms: {slowest_statement}",
+                       extra=fields)
+    else:
+        logger.debug(message, extra=fields)
+
+
+def init_instrumentation(app):
+    """Record latency, DB time and query counts for every request handled by ``app``"""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start_time = time.perf_counter()
+        g.db_time = 0.0
+        g.query_count = 0
+        g.slowest_query = None
+        REQUESTS_IN_PROGRESS.inc(blueprint=_labels()[0])
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.get('request_start_time')
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        blueprint, endpoint = _labels()
+        status = str(response.status_code)
+
+        REQUEST_LATENCY.observe(elapsed, blueprint=blueprint, endpoint=endpoint, method=request.method, status=status)
+        db_time = g.get('db_time', 0.0)
+        query_count = g.get('query_count', 0)
+        REQUEST_DB_TIME.observe(db_time, blueprint=blueprint, endpoint=endpoint)
+        REQUEST_QUERY_COUNT.observe(query_count, blueprint=blueprint, endpoint=endpoint)
+        identity = g.get('api_key')
+        if identity is not None:
+            API_KEY_LATENCY.observe(elapsed, tier=identity.rate_limit_tier, status=status)
+        registry.snapshot_if_due()
+
+        if app.config.get('SERVER_TIMING_HEADERS'):
+            response.headers['Server-Timing'] = server_timing(elapsed, db_time, query_count)
+            response.headers['X-Query-Count'] = str(query_count)
+        _log_request(response.status_code, elapsed, db_time, query_count, g.get('slowest_query'))
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        if g.get('request_start_time') is not None:
+            REQUESTS_IN_PROGRESS.dec(blueprint=_labels()[0])
@@ -0,0 +1,63 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional speedup; the stdlib encoder is used without it
+    orjson = None
+
+# What Flask passes to dumps() for compact (non-debug) responses
+COMPACT_ARGS = {'separators': (',', ':')}
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson when it is installed.
+
+    Values are encoded as Flask's default provider encodes them: datetimes
+    are HTTP dates and Decimals become strings, both handled through
+    ``default``. The bytes differ, intentionally: non-ASCII text is written
+    as UTF-8 rather than ``\\uXXXX`` escapes (the response is still declared
+    application/json, which is UTF-8), large floats use ``1e16`` rather than
+    ``1e+16``, and NaN/Infinity become ``null`` instead of invalid JSON. Apart from
+    NaN/Infinity, a JSON parser reads the same values back. Calls that need stdlib-only options
+    (such as ``indent`` for pretty debug output) fall back to the default
+    encoder.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.enabled = orjson is not None
+
+    def _options(self):
+        # orjson serializes datetimes as ISO 8601 natively; pass them through
+        # so they keep the stdlib provider's HTTP date format
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj, **kwargs):
+        # orjson output is always compact; other formatting goes to the stdlib
+        if not self.enabled or (kwargs and kwargs != COMPACT_ARGS):
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if not self.enabled or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+JSON_PROVIDERS = {
+    'default': DefaultJSONProvider,
+    'fast': FastJSONProvider,
+}
+
+
+def configure_json_provider(app):
+    """Install the provider named by the JSON_PROVIDER setting"""
+    name = app.config.get('JSON_PROVIDER', 'fast')
+    try:
+        provider_class = JSON_PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown JSON_PROVIDER '{name}'. Use one of: {', '.join(JSON_PROVIDERS)}")
+    app.json = provider_class(app)
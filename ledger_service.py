@@ -0,0 +1,133 @@
+"""Append-only commission ledger behind Affiliate.total_earnings.
+
+Every change to what a referral earns is recorded as ledger entries: a
+credit when it completes, a reversal (negative amount) when it stops
+counting, and a reversal plus a new credit when its commission or affiliate
+changes. The same transaction moves ``total_earnings`` by the entries' sum
+with ``total_earnings = total_earnings + :delta``, so completing a referral
+costs the same however long the affiliate's history is. ORM writes are
+recorded by the flush listener in referral_events.py; bulk Core statements
+must call ``append_entries`` themselves (see crm_import).
+"""
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+import logging
+from sqlalchemy import bindparam, case, func, insert, or_, select, update
+from extensions import db
+from models import Affiliate, CommissionLedgerEntry, Referral
+
+CREDIT = 'credit'
+REVERSAL = 'reversal'
+
+
+def earned_amount(state):
+    """What a referral in ``state`` contributes to its affiliate's earnings"""
+    if state is None or state.status != 'completed' or state.affiliate_id is None:
+        return Decimal('0')
+    return Decimal(str(state.commission_amount or 0))
+
+
+def _reason(old, new, old_amount, new_amount):
+    if new is None:
+        return 'referral_deleted'
+    if not old_amount:
+        return 'completed'
+    if not new_amount:
+        return 'reopened'
+    if old.affiliate_id != new.affiliate_id:
+        return 'affiliate_changed'
+    return 'commission_changed'
+
+
+def referral_entries(referral_id, old, new, now=None):
+    """Ledger entries for a referral moving from state ``old`` to ``new``.
+
+    States carry affiliate_id, status and commission_amount; None stands for
+    a referral that did not exist yet or was deleted.
+    """
+    old_amount = earned_amount(old)
+    new_amount = earned_amount(new)
+    if old_amount == new_amount and (not old_amount or old.affiliate_id == new.affiliate_id):
+        return []
+
+    now = now or datetime.utcnow()
+    reason = _reason(old, new, old_amount, new_amount)
+    entries = []
+    if old_amount:
+        entries.append({
+            'affiliate_id': old.affiliate_id, 'referral_id': referral_id, 'entry_type': REVERSAL,
+            'amount': -old_amount, 'reason': reason, 'created_at': now
+        })
+    if new_amount:
+        entries.append({
+            'affiliate_id': new.affiliate_id, 'referral_id': referral_id, 'entry_type': CREDIT,
+            'amount': new_amount, 'reason': reason, 'created_at': now
+        })
+    return entries
+
+
+def append_entries(connection, entries):
+    """Insert ledger entries and apply their sums to total_earnings; return the affiliate ids"""
+    if not entries:
+        return set()
+    connection.execute(insert(CommissionLedgerEntry.__table__), entries)
+
+    deltas = defaultdict(Decimal)
+    for entry in entries:
+        deltas[entry['affiliate_id']] += entry['amount']
+
+    table = Affiliate.__table__
+    statement = update(table).where(table.c.id == bindparam('target_id')).values(
+        total_earnings=func.coalesce(table.c.total_earnings, 0) + bindparam('delta')
+    )
+    # Affiliate order keeps concurrent writers from deadlocking on each other
+    rows = [{'target_id': affiliate_id, 'delta': delta} for affiliate_id, delta in sorted(deltas.items()) if delta]
+    if rows:
+        connection.execute(statement, rows)
+    return set(deltas)
+
+
+def _ledger_total():
+    return select(
+        func.coalesce(func.sum(CommissionLedgerEntry.amount), 0)
+    ).where(CommissionLedgerEntry.affiliate_id == Affiliate.id).scalar_subquery()
+
+
+def reconcile_earnings(affiliate_ids=None):
+    """Reset total_earnings to the ledger sum where they differ, with one UPDATE.
+
+    Covers every affiliate, or only ``affiliate_ids``. Runs in the current
+    session transaction; the caller commits. Returns the number of affiliates
+    that were corrected.
+    """
+    ledger_total = _ledger_total()
+    statement = update(Affiliate).where(
+        or_(Affiliate.total_earnings.is_(None), Affiliate.total_earnings != ledger_total)
+    ).values(total_earnings=ledger_total)
+    if affiliate_ids is not None:
+        statement = statement.where(Affiliate.id.in_(affiliate_ids))
+    corrected = db.session.execute(statement, execution_options={'synchronize_session': False}).rowcount
+    logging.info(f"Reconciled earnings: {corrected} affiliate total(s) corrected from the ledger")
+    return corrected
+
+
+def verify_earnings():
+    """Affiliates whose stored total, ledger sum and completed referrals disagree"""
+    completed_total = select(
+        func.coalesce(func.sum(case((Referral.status == 'completed', Referral.commission_amount), else_=0)), 0)
+    ).where(Referral.affiliate_id == Affiliate.id).scalar_subquery()
+
+    rows = db.session.execute(select(
+        Affiliate.id, Affiliate.total_earnings, _ledger_total(), completed_total
+    ))
+    mismatches = []
+    for affiliate_id, stored, ledger, referrals in rows:
+        stored = Decimal(str(stored or 0))
+        ledger = Decimal(str(ledger or 0))
+        referrals = Decimal(str(referrals or 0))
+        if stored != ledger or ledger != referrals:
+            mismatches.append({
+                'affiliate_id': affiliate_id, 'stored': stored, 'ledger': ledger, 'referrals': referrals
+            })
+    return mismatches
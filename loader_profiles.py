@@ -0,0 +1,81 @@
+"""Named eager-loading profiles for list views, and a guard against N+1 loads.
+
+Each profile is the bundle of loader options a view needs so that rendering
+its rows never lazy-loads a relationship per row. Wrap the rendering or
+serialization of a list in ``serializing(label)``: with LAZY_LOAD_GUARD set
+to 'raise' (development and tests) a lazy load inside it raises
+LazyLoadError, with 'warn' it is logged, and with 'off' (the default) the
+guard costs nothing.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload, selectinload
+from models import Affiliate, Referral, Treatment
+
+# Built on use: backref relationships only exist once the mappers are configured
+PROFILES = {
+    # admin/referrals.html and the dashboard's recent referrals
+    'admin_referrals': lambda: (
+        joinedload(Referral.treatment).joinedload(Treatment.group),
+        joinedload(Referral.affiliate).joinedload(Affiliate.user),
+        joinedload(Referral.treatment_status),
+    ),
+    # admin.get_affiliate_referrals
+    'affiliate_referrals': lambda: (
+        joinedload(Referral.treatment),
+        joinedload(Referral.treatment_status),
+    ),
+    # affiliate/dashboard.html
+    'affiliate_dashboard': lambda: (
+        joinedload(Referral.treatment).joinedload(Treatment.group),
+    ),
+    # analytics.get_top_affiliates; selectin keeps user columns out of its GROUP BY
+    'top_affiliates': lambda: (
+        selectinload(Affiliate.user),
+    ),
+}
+
+_serializing = ContextVar('serializing', default=None)
+
+
+class LazyLoadError(RuntimeError):
+    """A relationship was lazy-loaded while a list was being serialized"""
+
+
+def loader_profile(name):
+    """The loader options of profile ``name``, for ``query.options(*...)``"""
+    return PROFILES[name]()
+
+
+@contextmanager
+def serializing(label):
+    """Mark a block that renders or serializes a list of ORM objects"""
+    mode = current_app.config.get('LAZY_LOAD_GUARD', 'off')
+    if mode == 'off':
+        yield
+        return
+    token = _serializing.set((label, mode))
+    try:
+        yield
+    finally:
+        _serializing.reset(token)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def guard_lazy_loads(orm_execute_state):
+    """Report lazy loads emitted inside a ``serializing`` block"""
+    active = _serializing.get()
+    if active is None or orm_execute_state.lazy_loaded_from is None:
+        return
+    label, mode = active
+    parent = orm_execute_state.lazy_loaded_from
+    path = orm_execute_state.loader_strategy_path
+    relationship = path[-1].key if path else '?'
+    message = (f"Lazy load of {parent.class_.__name__}.{relationship} while serializing {label}; "
+               f"add it to the view's loader profile")
+    if mode == 'raise':
+        raise LazyLoadError(message)
+    logging.warning(message)
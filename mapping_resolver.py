@@ -0,0 +1,84 @@
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from extensions import db
+from models import TreatmentNameMapping
+
+MAPPING_INDEX_TTL = 60  # seconds before changes made in another worker are picked up
+
+_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+ResolvedMapping = namedtuple('ResolvedMapping', ['mapping_id', 'external_name', 'treatment_group_id'])
+
+
+def normalize_treatment_name(name):
+    """Fold case, width and punctuation so "Hair-Transplant (FUE)" matches "hair transplant fue" """
+    if not name:
+        return ''
+    folded = unicodedata.normalize('NFKC', name).casefold()
+    return ' '.join(_SEPARATORS.sub(' ', folded).split())
+
+
+class TreatmentNameResolver:
+    """Process-local index of TreatmentNameMapping rows keyed by normalized name.
+
+    The whole table is loaded with one query and kept in a dict, so a lookup
+    is a normalization plus a hash probe. The admin mapping views call
+    ``invalidate()`` after every change; other workers rebuild once the index
+    is older than ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl=MAPPING_INDEX_TTL):
+        self.ttl = ttl
+        self._index = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _build(self):
+        index = {}
+        rows = db.session.query(
+            TreatmentNameMapping.id,
+            TreatmentNameMapping.external_name,
+            TreatmentNameMapping.treatment_group_id
+        ).order_by(TreatmentNameMapping.id)
+        for row in rows:
+            key = normalize_treatment_name(row.external_name)
+            existing = index.get(key)
+            if existing:
+                logging.warning(
+                    f"Treatment mappings '{existing.external_name}' and '{row.external_name}' "
+                    f"normalize to the same name; using mapping {existing.mapping_id}"
+                )
+                continue
+            index[key] = ResolvedMapping(row.id, row.external_name, row.treatment_group_id)
+        return index
+
+    def _current_index(self):
+        index = self._index
+        if index is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return index
+        with self._lock:
+            if self._index is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self._index = self._build()
+                self._loaded_at = time.monotonic()
+                logging.info(f"Loaded {len(self._index)} treatment name mappings")
+            return self._index
+
+    def resolve(self, name):
+        """Return the ResolvedMapping for an external treatment name, or None"""
+        return self._current_index().get(normalize_treatment_name(name))
+
+    def resolve_many(self, names):
+        """Resolve several names at once; returns {name: ResolvedMapping or None}"""
+        index = self._current_index()
+        return {name: index.get(normalize_treatment_name(name)) for name in names}
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+
+treatment_name_resolver = TreatmentNameResolver()
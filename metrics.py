@@ -0,0 +1,267 @@
+"""In-process metrics registry with Prometheus text output.
+
+Each process keeps its own counters, gauges and histograms in memory. With
+METRICS_MULTIPROC_DIR set (one directory shared by all gunicorn workers),
+every process periodically writes a JSON snapshot of its values there and
+``render()`` merges the snapshots of all workers, so a scrape hitting any
+one worker reports totals for the whole server.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SNAPSHOT_INTERVAL = 5  # seconds between multiprocess snapshot writes
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def items(self):
+        """(label values, value) pairs, copied under the lock"""
+        with self._lock:
+            return [(key, list(value) if isinstance(value, list) else value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @staticmethod
+    def merge(values):
+        return sum(values)
+
+    def samples(self, key, value):
+        yield self.name + '_total', key, (), value
+
+
+class Gauge(_Metric):
+    """Gauge; ``multiprocess_mode`` decides how workers are combined (sum, max, min)"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode='sum'):
+        super().__init__(name, documentation, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def merge(self, values):
+        return {'sum': sum, 'max': max, 'min': min}[self.multiprocess_mode](values)
+
+    def samples(self, key, value):
+        yield self.name, key, (), value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def merge(self, values):
+        return [sum(column) for column in zip(*values)]
+
+    def samples(self, key, state):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), state[:-2]):
+            cumulative += count
+            yield self.name + '_bucket', key, (('le', _format_value(bound)),), cumulative
+        yield self.name + '_sum', key, (), state[-2]
+        yield self.name + '_count', key, (), state[-1]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._last_snapshot = 0.0
+        self.multiproc_dir = None
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), multiprocess_mode='sum'):
+        return self._register(Gauge(name, documentation, labelnames, multiprocess_mode))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _after_fork(self):
+        """Start from zero in a forked worker instead of repeating the parent's values"""
+        self._pid = os.getpid()
+        self._last_snapshot = 0.0
+        for metric in self._metrics.values():
+            metric.reset()
+
+    # Multiprocess support
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.multiproc_dir, f'metrics-{pid}.json')
+
+    def write_snapshot(self):
+        """Write this process's values to the shared directory"""
+        if not self.multiproc_dir:
+            return
+        data = {name: metric.snapshot() for name, metric in self._metrics.items()}
+        path = self._snapshot_path(self._pid)
+        temporary = f'{path}.tmp'
+        try:
+            with open(temporary, 'w') as handle:
+                json.dump(data, handle)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.error(f"Could not write metrics snapshot: {str(e)}")
+        self._last_snapshot = time.monotonic()
+
+    def snapshot_if_due(self):
+        if self.multiproc_dir and time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL:
+            self.write_snapshot()
+
+    def _read_snapshots(self):
+        """Yield (pid, alive, data) for every worker snapshot in the shared directory"""
+        for filename in os.listdir(self.multiproc_dir):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                pid = int(filename[len('metrics-'):-len('.json')])
+                with open(os.path.join(self.multiproc_dir, filename)) as handle:
+                    data = json.load(handle)
+            except (OSError, ValueError):
+                continue
+            yield pid, _process_alive(pid), data
+
+    def _collect(self):
+        """Merged {metric name: {label key: value}} across processes"""
+        if not self.multiproc_dir:
+            return {name: dict(metric.items()) for name, metric in self._metrics.items()}
+
+        self.write_snapshot()
+        gathered = {name: {} for name in self._metrics}
+        for pid, alive, data in self._read_snapshots():
+            for name, entries in data.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                # Gauges describe live state; counters and histograms keep dead workers' totals
+                if metric.kind == 'gauge' and not alive:
+                    continue
+                for key, value in entries:
+                    gathered[name].setdefault(tuple(key), []).append(value)
+        return {
+            name: {key: self._metrics[name].merge(values) for key, values in entries.items()}
+            for name, entries in gathered.items()
+        }
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        collected = self._collect()
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(collected.get(name, {}).items()):
+                for sample_name, label_values, extra, sample in metric.samples(key, value):
+                    lines.append(f'{sample_name}{_format_labels(metric.labelnames, label_values, extra)} {_format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+registry = MetricsRegistry()
+os.register_at_fork(after_in_child=registry._after_fork)
+
+
+def configure_metrics(app):
+    """Enable multiprocess mode when METRICS_MULTIPROC_DIR is configured"""
+    directory = app.config.get('METRICS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        registry.multiproc_dir = directory
@@ -0,0 +1,46 @@
+"""add per-affiliate referral counters
+
+Revision ID: a1c3e5f70004
+Revises: a1c3e5f70003
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70004'
+down_revision = 'a1c3e5f70003'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'affiliate_stats',
+        sa.Column('affiliate_id', sa.Integer(), sa.ForeignKey('affiliate.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('total_referrals', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('new_referrals', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('in_progress_referrals', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('completed_referrals', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('completed_commission', sa.Numeric(12, 2), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime())
+    )
+
+    # Seed the counters from existing referrals in one aggregate pass
+    op.execute("""
+        INSERT INTO affiliate_stats (affiliate_id, total_referrals, new_referrals, in_progress_referrals,
+                                     completed_referrals, completed_commission, updated_at)
+        SELECT a.id,
+               COUNT(r.id),
+               COALESCE(SUM(CASE WHEN r.status = 'new' THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN r.status = 'in-progress' THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN r.status = 'completed' THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN r.status = 'completed' THEN COALESCE(r.commission_amount, 0) ELSE 0 END), 0),
+               CURRENT_TIMESTAMP
+        FROM affiliate a
+        LEFT JOIN referral r ON r.affiliate_id = a.id
+        GROUP BY a.id
+    """)
+
+def downgrade():
+    op.drop_table('affiliate_stats')
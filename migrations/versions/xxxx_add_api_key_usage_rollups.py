@@ -0,0 +1,37 @@
+"""add hourly and daily API key usage rollups
+
+Revision ID: a1c3e5f70009
+Revises: a1c3e5f70008
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70009'
+down_revision = 'a1c3e5f70008'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'api_key_usage_hourly',
+        sa.Column('api_key_id', sa.Integer(), sa.ForeignKey('api_key.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('endpoint', sa.String(length=100), primary_key=True),
+        sa.Column('period_start', sa.DateTime(), primary_key=True),
+        sa.Column('request_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('error_count', sa.Integer(), nullable=False, server_default='0')
+    )
+    op.create_table(
+        'api_key_usage_daily',
+        sa.Column('api_key_id', sa.Integer(), sa.ForeignKey('api_key.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('endpoint', sa.String(length=100), primary_key=True),
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('request_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('error_count', sa.Integer(), nullable=False, server_default='0')
+    )
+
+def downgrade():
+    op.drop_table('api_key_usage_daily')
+    op.drop_table('api_key_usage_hourly')
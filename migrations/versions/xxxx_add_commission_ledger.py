@@ -0,0 +1,54 @@
+"""add append-only commission ledger
+
+Revision ID: a1c3e5f70011
+Revises: a1c3e5f70010
+Create Date: 2026-10-18 21:00:00.000000
+
+Every completed referral gets an opening credit for its current commission,
+and affiliate total_earnings are reset to the ledger sums. Check the result
+with ``flask reconcile-earnings --verify``.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70011'
+down_revision = 'a1c3e5f70010'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'commission_ledger_entry',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('affiliate_id', sa.Integer(), sa.ForeignKey('affiliate.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('referral_id', sa.Integer(), nullable=True),
+        sa.Column('entry_type', sa.String(length=20), nullable=False),
+        sa.Column('amount', sa.Numeric(12, 2), nullable=False),
+        sa.Column('reason', sa.String(length=50), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False)
+    )
+    op.create_index('ix_commission_ledger_affiliate', 'commission_ledger_entry', ['affiliate_id', 'id'])
+    op.create_index(
+        op.f('ix_commission_ledger_entry_referral_id'), 'commission_ledger_entry', ['referral_id']
+    )
+
+    op.execute("""
+        INSERT INTO commission_ledger_entry (affiliate_id, referral_id, entry_type, amount, reason, created_at)
+        SELECT affiliate_id, id, 'credit', commission_amount, 'opening_balance', CURRENT_TIMESTAMP
+        FROM referral
+        WHERE status = 'completed' AND affiliate_id IS NOT NULL
+          AND commission_amount IS NOT NULL AND commission_amount <> 0
+        ORDER BY id
+    """)
+    op.execute("""
+        UPDATE affiliate SET total_earnings = (
+            SELECT coalesce(sum(amount), 0) FROM commission_ledger_entry
+            WHERE commission_ledger_entry.affiliate_id = affiliate.id
+        )
+    """)
+
+def downgrade():
+    op.drop_index(op.f('ix_commission_ledger_entry_referral_id'), table_name='commission_ledger_entry')
+    op.drop_index('ix_commission_ledger_affiliate', table_name='commission_ledger_entry')
+    op.drop_table('commission_ledger_entry')
@@ -0,0 +1,38 @@
+"""add queue table for inbound CRM events
+
+Revision ID: a1c3e5f70006
+Revises: a1c3e5f70005
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70006'
+down_revision = 'a1c3e5f70005'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'crm_event',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('event_type', sa.String(length=50), nullable=False),
+        sa.Column('external_id', sa.String(length=255)),
+        sa.Column('payload', sa.JSON(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('last_error', sa.Text()),
+        sa.Column('referral_id', sa.Integer(), sa.ForeignKey('referral.id')),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('available_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_at', sa.DateTime()),
+        sa.Column('locked_by', sa.String(length=100)),
+        sa.Column('processed_at', sa.DateTime())
+    )
+    op.create_index('ix_crm_event_status_available', 'crm_event', ['status', 'available_at', 'id'])
+
+def downgrade():
+    op.drop_index('ix_crm_event_status_available', table_name='crm_event')
+    op.drop_table('crm_event')
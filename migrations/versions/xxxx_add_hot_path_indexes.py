@@ -0,0 +1,50 @@
+"""add composite and partial indexes for hot query paths
+
+Revision ID: a1c3e5f70010
+Revises: a1c3e5f70009
+Create Date: 2026-10-18 20:00:00.000000
+
+Indexes are built CONCURRENTLY outside the migration transaction, so
+referral, ticket and notification writes are not blocked while they build.
+If a build is interrupted Postgres leaves an INVALID index behind; drop it
+(DROP INDEX CONCURRENTLY <name>) and run the upgrade again.
+Verify the resulting plans with ``flask check-query-plans --seed 50000``.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70010'
+down_revision = 'a1c3e5f70009'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns, partial index predicate)
+INDEXES = [
+    ('ix_referral_created_at', 'referral', ['created_at'], None),
+    ('ix_referral_status_created', 'referral', ['status', 'created_at'], None),
+    ('ix_referral_affiliate_completed', 'referral', ['affiliate_id', 'commission_amount'], "status = 'completed'"),
+    ('ix_referral_country', 'referral', ['country', 'status'], 'country IS NOT NULL'),
+    ('ix_treatment_group_active', 'treatment', ['group_id', 'id'], 'active'),
+    ('ix_ticket_affiliate_created', 'ticket', ['affiliate_id', 'created_at'], None),
+    ('ix_ticket_status', 'ticket', ['status'], None),
+    ('ix_notification_user_created', 'notification', ['user_id', 'created_at'], None),
+    ('ix_notification_user_unread', 'notification', ['user_id', 'created_at'], 'NOT read'),
+    ('ix_webhook_user_active', 'webhook', ['user_id'], 'is_active'),
+]
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None
+            )
+        for table in sorted({table for _, table, _, _ in INDEXES}):
+            op.execute(f'ANALYZE {table}')
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
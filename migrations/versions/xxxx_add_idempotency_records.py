@@ -0,0 +1,35 @@
+"""add stored responses for idempotency keys
+
+Revision ID: a1c3e5f70005
+Revises: a1c3e5f70004
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70005'
+down_revision = 'a1c3e5f70004'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'idempotency_record',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('scope', sa.String(length=100), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('request_hash', sa.String(length=64), nullable=False),
+        sa.Column('status_code', sa.Integer()),
+        sa.Column('response_body', sa.Text()),
+        sa.Column('content_type', sa.String(length=100)),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.UniqueConstraint('scope', 'key', name='uq_idempotency_scope_key')
+    )
+    op.create_index('ix_idempotency_record_expires_at', 'idempotency_record', ['expires_at'])
+
+def downgrade():
+    op.drop_index('ix_idempotency_record_expires_at', table_name='idempotency_record')
+    op.drop_table('idempotency_record')
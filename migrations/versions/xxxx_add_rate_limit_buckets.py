@@ -0,0 +1,29 @@
+"""add shared rate limit buckets and api key tiers
+
+Revision ID: a1c3e5f70002
+Revises: a1c3e5f70001
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70002'
+down_revision = 'a1c3e5f70001'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('api_key', sa.Column('rate_limit_tier', sa.String(length=20), nullable=False, server_default='standard'))
+    op.create_table(
+        'rate_limit_bucket',
+        sa.Column('bucket_key', sa.String(length=128), primary_key=True),
+        sa.Column('tokens', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.Float(), nullable=False),
+        sa.Column('allowed', sa.Boolean(), nullable=False, server_default=sa.true())
+    )
+
+def downgrade():
+    op.drop_table('rate_limit_bucket')
+    op.drop_column('api_key', 'rate_limit_tier')
@@ -0,0 +1,22 @@
+"""add change feed index to referral
+
+Revision ID: a1c3e5f70003
+Revises: a1c3e5f70002
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70003'
+down_revision = 'a1c3e5f70002'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Rows written before updated_at existed would otherwise never enter the feed
+    op.execute("UPDATE referral SET updated_at = created_at WHERE updated_at IS NULL")
+    op.create_index('ix_referral_affiliate_updated', 'referral', ['affiliate_id', 'updated_at', 'id'])
+
+def downgrade():
+    op.drop_index('ix_referral_affiliate_updated', table_name='referral')
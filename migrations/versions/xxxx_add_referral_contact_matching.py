@@ -0,0 +1,64 @@
+"""add normalized contact columns for CRM matching
+
+Revision ID: a1c3e5f70007
+Revises: a1c3e5f70006
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from contacts import contact_fields
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70007'
+down_revision = 'a1c3e5f70006'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 1000
+
+referral = sa.table(
+    'referral',
+    sa.column('id', sa.Integer),
+    sa.column('email', sa.String),
+    sa.column('phone', sa.String),
+    sa.column('country', sa.String),
+    sa.column('email_normalized', sa.String),
+    sa.column('phone_e164', sa.String)
+)
+
+def upgrade():
+    op.add_column('referral', sa.Column('email_normalized', sa.String(length=120)))
+    op.add_column('referral', sa.Column('phone_e164', sa.String(length=16)))
+
+    # Backfill in id order, one batch per round trip, so large tables never
+    # hold a full-table lock or load every row into memory
+    conn = op.get_bind()
+    update = referral.update().where(referral.c.id == sa.bindparam('row_id')).values(
+        email_normalized=sa.bindparam('email_normalized'),
+        phone_e164=sa.bindparam('phone_e164')
+    )
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(referral.c.id, referral.c.email, referral.c.phone, referral.c.country)
+            .where(referral.c.id > last_id)
+            .order_by(referral.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [
+            dict(row_id=row.id, **contact_fields(row.email, row.phone, row.country))
+            for row in rows
+        ])
+        last_id = rows[-1].id
+
+    op.create_index('ix_referral_email_normalized', 'referral', ['email_normalized'])
+    op.create_index('ix_referral_phone_e164', 'referral', ['phone_e164'])
+
+def downgrade():
+    op.drop_index('ix_referral_phone_e164', table_name='referral')
+    op.drop_index('ix_referral_email_normalized', table_name='referral')
+    op.drop_column('referral', 'phone_e164')
+    op.drop_column('referral', 'email_normalized')
@@ -0,0 +1,42 @@
+"""add referral_daily_stats rollup for analytics
+
+Revision ID: a1c3e5f70012
+Revises: a1c3e5f70011
+Create Date: 2026-10-18 22:00:00.000000
+
+The rollup is backfilled from the referral table; check it afterwards with
+``flask rebuild-referral-daily-stats --verify``.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70012'
+down_revision = 'a1c3e5f70011'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'referral_daily_stats',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('affiliate_id', sa.Integer(), sa.ForeignKey('affiliate.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('treatment_group_id', sa.Integer(), primary_key=True, server_default='0'),
+        sa.Column('country', sa.String(length=2), primary_key=True, server_default=''),
+        sa.Column('status', sa.String(length=20), primary_key=True),
+        sa.Column('referral_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('commission_amount', sa.Numeric(12, 2), nullable=False, server_default='0')
+    )
+
+    op.execute("""
+        INSERT INTO referral_daily_stats
+            (day, affiliate_id, treatment_group_id, country, status, referral_count, commission_amount)
+        SELECT date(r.created_at), r.affiliate_id, coalesce(t.group_id, 0), coalesce(r.country, ''),
+               coalesce(r.status, 'new'), count(r.id), coalesce(sum(r.commission_amount), 0)
+        FROM referral r
+        LEFT OUTER JOIN treatment t ON t.id = r.treatment_id
+        GROUP BY 1, 2, 3, 4, 5
+    """)
+
+def downgrade():
+    op.drop_table('referral_daily_stats')
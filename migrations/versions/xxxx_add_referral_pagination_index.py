@@ -0,0 +1,20 @@
+"""add keyset pagination index to referral
+
+Revision ID: a1c3e5f70001
+Revises: xxxx
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70001'
+down_revision = 'xxxx'  # replace with your last migration id
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_index('ix_referral_affiliate_created', 'referral', ['affiliate_id', 'created_at', 'id'])
+
+def downgrade():
+    op.drop_index('ix_referral_affiliate_created', table_name='referral')
@@ -0,0 +1,56 @@
+"""store API keys as prefix + SHA-256 hash instead of plaintext
+
+Revision ID: a1c3e5f70008
+Revises: a1c3e5f70007
+Create Date: 2026-10-18 18:00:00.000000
+
+Existing keys keep working: their first characters become the prefix and
+the hash covers the whole key. The plaintext column is dropped, so the
+downgrade cannot restore keys and every key has to be reissued after it.
+"""
+from alembic import op
+import sqlalchemy as sa
+from api_keys import api_key_prefix, hash_api_key
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70008'
+down_revision = 'a1c3e5f70007'
+branch_labels = None
+depends_on = None
+
+api_key = sa.table(
+    'api_key',
+    sa.column('id', sa.Integer),
+    sa.column('key', sa.String),
+    sa.column('prefix', sa.String),
+    sa.column('key_hash', sa.String)
+)
+
+def upgrade():
+    op.add_column('api_key', sa.Column('prefix', sa.String(length=16)))
+    op.add_column('api_key', sa.Column('key_hash', sa.String(length=64)))
+
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(api_key.c.id, api_key.c.key)).fetchall()
+    if rows:
+        conn.execute(
+            api_key.update().where(api_key.c.id == sa.bindparam('key_id')).values(
+                prefix=sa.bindparam('new_prefix'),
+                key_hash=sa.bindparam('new_hash')
+            ),
+            [
+                {'key_id': row.id, 'new_prefix': api_key_prefix(row.key), 'new_hash': hash_api_key(row.key)}
+                for row in rows
+            ]
+        )
+
+    op.alter_column('api_key', 'prefix', nullable=False)
+    op.alter_column('api_key', 'key_hash', nullable=False)
+    op.create_index('ix_api_key_prefix', 'api_key', ['prefix'], unique=True)
+    op.drop_column('api_key', 'key')
+
+def downgrade():
+    op.add_column('api_key', sa.Column('key', sa.String(length=64)))
+    op.drop_index('ix_api_key_prefix', table_name='api_key')
+    op.drop_column('api_key', 'key_hash')
+    op.drop_column('api_key', 'prefix')
@@ -0,0 +1,58 @@
+"""recompute referral phone_e164 with the dial-code rule
+
+Revision ID: a1c3e5f70013
+Revises: a1c3e5f70012
+Create Date: 2026-10-18 23:00:00.000000
+
+National numbers without a country used to be stored as '+' plus their
+digits, which is not E.164. They now get the DEFAULT_PHONE_COUNTRY dial
+code, or NULL when it is unset.
+"""
+from alembic import op
+import sqlalchemy as sa
+from contacts import normalize_phone
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70013'
+down_revision = 'a1c3e5f70012'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 1000
+
+referral = sa.table(
+    'referral',
+    sa.column('id', sa.Integer),
+    sa.column('phone', sa.String),
+    sa.column('country', sa.String),
+    sa.column('phone_e164', sa.String)
+)
+
+def upgrade():
+    conn = op.get_bind()
+    update = referral.update().where(referral.c.id == sa.bindparam('row_id')).values(
+        phone_e164=sa.bindparam('phone_e164')
+    )
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(referral.c.id, referral.c.phone, referral.c.country, referral.c.phone_e164)
+            .where(referral.c.id > last_id)
+            .order_by(referral.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        changed = [
+            dict(row_id=row.id, phone_e164=phone_e164)
+            for row in rows
+            for phone_e164 in [normalize_phone(row.phone, row.country)]
+            if phone_e164 != row.phone_e164
+        ]
+        if changed:
+            conn.execute(update, changed)
+        last_id = rows[-1].id
+
+def downgrade():
+    # The previous values were not E.164; there is nothing worth restoring
+    pass
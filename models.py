@@ -5,7 +5,7 @@ from extensions import db
 from decimal import Decimal, InvalidOperation
 import logging
 from sqlalchemy.exc import SQLAlchemyError
-import secrets
+from api_keys import new_api_key
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -30,14 +30,21 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def generate_api_key(self, name):
-        """Generate a new API key for the user"""
+        """Generate a new API key for the user.
+
+        The plaintext key is only available as ``api_key.plaintext`` on the
+        returned object; the database keeps its prefix and hash.
+        """
+        key, prefix, key_hash = new_api_key()
         api_key = APIKey(
             user=self,
             name=name,
-            key=secrets.token_urlsafe(32)
+            prefix=prefix,
+            key_hash=key_hash
         )
         db.session.add(api_key)
         db.session.commit()
+        api_key.plaintext = key
         return api_key
 
     def to_dict(self):
@@ -65,19 +72,101 @@ class APIKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name = db.Column(db.String(64), nullable=False)
-    key = db.Column(db.String(64), unique=True, nullable=False)
+    # Public lookup prefix and SHA-256 of the full key (see api_keys.py)
+    prefix = db.Column(db.String(16), unique=True, index=True, nullable=False)
+    key_hash = db.Column(db.String(64), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_used_at = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
+    rate_limit_tier = db.Column(db.String(20), nullable=False, default='standard')
 
     def to_dict(self):
-        return {
+        data = {
             'id': self.id,
             'name': self.name,
-            'key': self.key,
+            'prefix': self.prefix,
             'created_at': self.created_at.isoformat(),
             'last_used_at': self.last_used_at.isoformat() if self.last_used_at else None,
-            'is_active': self.is_active
+            'is_active': self.is_active,
+            'rate_limit_tier': self.rate_limit_tier
+        }
+        # The full key is returned once, by the request that created it
+        plaintext = getattr(self, 'plaintext', None)
+        if plaintext:
+            data['key'] = plaintext
+        return data
+
+class RateLimitBucket(db.Model):
+    """Shared token bucket state used by the database rate limit backend"""
+    bucket_key = db.Column(db.String(128), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # Unix timestamp of the last refill
+    allowed = db.Column(db.Boolean, nullable=False, default=True)
+
+class ApiKeyUsageHourly(db.Model):
+    """Requests per API key and endpoint for one hour, upserted by usage_service"""
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id', ondelete='CASCADE'), primary_key=True)
+    endpoint = db.Column(db.String(100), primary_key=True)
+    period_start = db.Column(db.DateTime, primary_key=True)  # UTC, truncated to the hour
+    request_count = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)  # 4xx and 5xx responses
+
+class ApiKeyUsageDaily(db.Model):
+    """Requests per API key and endpoint for one UTC day; quotas are checked against it"""
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id', ondelete='CASCADE'), primary_key=True)
+    endpoint = db.Column(db.String(100), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    request_count = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+
+class IdempotencyRecord(db.Model):
+    """Stored response for a request made with an idempotency key"""
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', name='uq_idempotency_scope_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(100), nullable=False)   # Who the key belongs to, e.g. api_key:12
+    key = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)                 # Null while the first request is still running
+    response_body = db.Column(db.Text)
+    content_type = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class CrmEvent(db.Model):
+    """Inbound CRM event waiting for, or processed by, the CRM worker"""
+    __table_args__ = (
+        # The worker claims the oldest due pending events
+        db.Index('ix_crm_event_status_available', 'status', 'available_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    external_id = db.Column(db.String(255))            # event_id sent by the CRM, if any
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processing, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    referral_id = db.Column(db.Integer, db.ForeignKey('referral.id'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Not retried before this
+    locked_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(100))
+    processed_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'event_type': self.event_type,
+            'event_id': self.external_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.last_error,
+            'referral_id': self.referral_id,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'processed_at': self.processed_at.strftime('%Y-%m-%d %H:%M:%S') if self.processed_at else None
         }
 
 class Affiliate(db.Model):
@@ -129,36 +218,6 @@ class Affiliate(db.Model):
             logging.error(f"Unexpected error calculating commission: {str(e)}")
             return 0.00
 
-    def update_earnings(self):
-        """Update total earnings based on completed referrals"""
-        logging.info(f"Starting earnings update for affiliate {self.id}")
-        
-        try:
-            total = Decimal('0.00')
-            for referral in self.referrals:
-                if referral.status == 'completed' and referral.commission_amount:
-                    try:
-                        commission = Decimal(str(referral.commission_amount))
-                        if commission > 0:
-                            total += commission
-                            logging.info(f"Added commission ${commission} from referral {referral.id}")
-                    except (InvalidOperation, TypeError) as e:
-                        logging.error(f"Error processing commission amount for referral {referral.id}: {str(e)}")
-                        continue
-                        
-            self.total_earnings = total
-            logging.info(f"Updated total earnings to ${total} for affiliate {self.id}")
-            db.session.commit()
-            
-        except SQLAlchemyError as e:
-            logging.error(f"Database error updating earnings: {str(e)}")
-            db.session.rollback()
-            raise
-        except Exception as e:
-            logging.error(f"Unexpected error updating earnings: {str(e)}")
-            db.session.rollback()
-            raise
-
     def to_dict(self):
         return {
             'id': self.id,
@@ -182,6 +241,11 @@ class TreatmentGroup(db.Model):
         }
 
 class Treatment(db.Model):
+    __table_args__ = (
+        # First active treatment of a group (landing page form, CRM completion)
+        db.Index('ix_treatment_group_active', 'group_id', 'id', postgresql_where=db.text('active')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
@@ -190,31 +254,61 @@ class Treatment(db.Model):
     referrals = db.relationship('Referral', backref='treatment', lazy=True)
     average_duration = db.Column(db.Integer)  # in days
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'active': self.active,
-            'group': self.group.to_dict() if self.group else None
-        }
+    # Attributes and related resources clients can select (see fieldsets.py)
+    API_FIELDS = ('id', 'name', 'description', 'active')
+    API_INCLUDES = ('group',)
+
+    def to_dict(self, fields=None, include=API_INCLUDES):
+        data = {field: getattr(self, field) for field in fields or self.API_FIELDS}
+        if 'group' in include:
+            data['group'] = self.group.to_dict() if self.group else None
+        return data
 
 class Referral(db.Model):
+    __table_args__ = (
+        # Keyset pagination of an affiliate's referrals (GET /api/v1/referrals)
+        db.Index('ix_referral_affiliate_created', 'affiliate_id', 'created_at', 'id'),
+        # Incremental change feed (GET /api/v1/referrals?updated_since=)
+        db.Index('ix_referral_affiliate_updated', 'affiliate_id', 'updated_at', 'id'),
+        # CRM contact matching (crm_service.match_referrals)
+        db.Index('ix_referral_email_normalized', 'email_normalized'),
+        db.Index('ix_referral_phone_e164', 'phone_e164'),
+        # Admin lists, heatmap and analytics date ranges, alone or per status
+        db.Index('ix_referral_created_at', 'created_at'),
+        db.Index('ix_referral_status_created', 'status', 'created_at'),
+        # Earnings and stats sums over an affiliate's completed referrals (index-only)
+        db.Index('ix_referral_affiliate_completed', 'affiliate_id', 'commission_amount',
+                 postgresql_where=db.text("status = 'completed'")),
+        # Country statistics and the per-country drill-down
+        db.Index('ix_referral_country', 'country', 'status',
+                 postgresql_where=db.text('country IS NOT NULL')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    affiliate_id = db.Column(db.Integer, db.ForeignKey('affiliate.id'), nullable=False)
-    treatment_id = db.Column(db.Integer, db.ForeignKey('treatment.id'), nullable=False)
+    # active_history keeps the previous value available to the flush listeners
+    # in referral_events.py even when the attribute was expired before being set
+    affiliate_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('affiliate.id'), nullable=False), active_history=True
+    )
+    treatment_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('treatment.id'), nullable=False), active_history=True
+    )
     name = db.Column(db.String(64), nullable=False)
     surname = db.Column(db.String(64), nullable=False)
     email = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(20), nullable=False)
-    status = db.Column(db.String(20), default='new')
-    commission_amount = db.Column(db.Numeric(10, 2), default=0.00)
+    # Matching keys derived from email/phone/country (see contacts.py), kept
+    # current by referral_events.normalize_referral_contacts
+    email_normalized = db.Column(db.String(120))
+    phone_e164 = db.Column(db.String(16))
+    status = db.column_property(db.Column(db.String(20), default='new'), active_history=True)
+    commission_amount = db.column_property(db.Column(db.Numeric(10, 2), default=0.00), active_history=True)
     treatment_value = db.Column(db.Numeric(10, 2), default=0.00)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     treatment_status = db.relationship('Treatment_Status', backref='referral', uselist=False)
     ip_address = db.Column(db.String(45))  # IPv6 can be up to 45 chars
-    country = db.Column(db.String(2))      # ISO country code
+    country = db.column_property(db.Column(db.String(2)), active_history=True)  # ISO country code
     city = db.Column(db.String(100))
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
@@ -271,14 +365,11 @@ class Referral(db.Model):
                     logging.warning(f"Zero or negative commission calculated for referral {self.id}")
                     return False, "Invalid commission amount calculated"
 
-                # Update commission amount
+                # Update commission amount; the flush records it in the commission
+                # ledger and moves the affiliate's total_earnings by the difference
                 self.commission_amount = Decimal(str(commission))
                 logging.info(f"Setting commission amount to ${commission}")
                 
-                # Update affiliate's total earnings
-                logging.info(f"Updating earnings for affiliate {self.affiliate.id}")
-                self.affiliate.update_earnings()
-                
                 # Commit transaction
                 db.session.commit()
                 logging.info(f"Successfully updated commission and earnings for referral {self.id}")
@@ -300,29 +391,90 @@ class Referral(db.Model):
             logging.error(f"Unexpected error in commission calculation: {str(e)}")
             return False, "Unexpected error occurred"
 
-    def to_dict(self):
-        """Convert referral to dictionary for JSON serialization"""
+    # Attributes and related resources clients can select (see fieldsets.py)
+    API_FIELDS = (
+        'id', 'name', 'surname', 'email', 'phone', 'status',
+        'commission_amount', 'treatment_value', 'created_at'
+    )
+    API_INCLUDES = ('treatment', 'group', 'affiliate')
+
+    def to_dict(self, fields=None, include=API_INCLUDES):
+        """Convert referral to dictionary for JSON serialization.
+
+        ``fields`` and ``include`` narrow the output; only the attributes
+        and relationships named are read, so nothing else is lazy-loaded.
+        """
         try:
-            return {
-                'id': self.id,
-                'name': self.name,
-                'surname': self.surname,
-                'email': self.email,
-                'phone': self.phone,
-                'status': self.status,
-                'commission_amount': float(self.commission_amount or 0),
-                'treatment_value': float(self.treatment_value or 0),
-                'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                'treatment': self.treatment.to_dict() if self.treatment else None,
-                'affiliate': {
+            data = {}
+            for field in fields or self.API_FIELDS:
+                value = getattr(self, field)
+                if field in ('commission_amount', 'treatment_value'):
+                    value = float(value or 0)
+                elif field == 'created_at':
+                    value = value.strftime('%Y-%m-%d %H:%M:%S')
+                data[field] = value
+            if 'treatment' in include:
+                treatment_include = ('group',) if 'group' in include else ()
+                data['treatment'] = self.treatment.to_dict(include=treatment_include) if self.treatment else None
+            if 'affiliate' in include:
+                data['affiliate'] = {
                     'id': self.affiliate.id,
                     'username': self.affiliate.user.username
                 } if self.affiliate else None
-            }
+            return data
         except Exception as e:
             logging.error(f"Error serializing referral {self.id}: {str(e)}")
             return None
 
+class CommissionLedgerEntry(db.Model):
+    """Append-only earnings history; an affiliate's entries sum to its total_earnings"""
+    __table_args__ = (
+        db.Index('ix_commission_ledger_affiliate', 'affiliate_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    affiliate_id = db.Column(db.Integer, db.ForeignKey('affiliate.id', ondelete='CASCADE'), nullable=False)
+    referral_id = db.Column(db.Integer, index=True)  # No FK: entries outlive deleted referrals
+    entry_type = db.Column(db.String(20), nullable=False)  # credit, reversal
+    amount = db.Column(db.Numeric(12, 2), nullable=False)  # Signed: reversals are negative
+    reason = db.Column(db.String(50), nullable=False)  # completed, commission_changed, reopened, ...
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class ReferralDailyStats(db.Model):
+    """Referral counts and commission per creation day and dimension, maintained alongside every referral write"""
+    day = db.Column(db.Date, primary_key=True)  # UTC day the referrals were created
+    affiliate_id = db.Column(db.Integer, db.ForeignKey('affiliate.id', ondelete='CASCADE'), primary_key=True)
+    treatment_group_id = db.Column(db.Integer, primary_key=True, default=0)  # 0: treatment without a group
+    country = db.Column(db.String(2), primary_key=True, default='')  # '': country unknown
+    status = db.Column(db.String(20), primary_key=True)
+    referral_count = db.Column(db.Integer, nullable=False, default=0)
+    commission_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0.00)
+
+class AffiliateStats(db.Model):
+    """Per-affiliate referral counters, maintained alongside every referral write"""
+    affiliate_id = db.Column(db.Integer, db.ForeignKey('affiliate.id', ondelete='CASCADE'), primary_key=True)
+    total_referrals = db.Column(db.Integer, nullable=False, default=0)
+    new_referrals = db.Column(db.Integer, nullable=False, default=0)
+    in_progress_referrals = db.Column(db.Integer, nullable=False, default=0)
+    completed_referrals = db.Column(db.Integer, nullable=False, default=0)
+    completed_commission = db.Column(db.Numeric(12, 2), nullable=False, default=0.00)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        total = self.total_referrals or 0
+        completed = self.completed_referrals or 0
+        return {
+            'total_referrals': total,
+            'completed_referrals': completed,
+            'status_counts': {
+                'new': self.new_referrals,
+                'in-progress': self.in_progress_referrals,
+                'completed': completed
+            },
+            'completed_commission': float(self.completed_commission or 0),
+            'conversion_rate': (completed / total * 100) if total > 0 else 0
+        }
+
 class Treatment_Status(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     referral_id = db.Column(db.Integer, db.ForeignKey('referral.id'), nullable=False)
@@ -343,6 +495,11 @@ class Treatment_Status(db.Model):
         }
 
 class Ticket(db.Model):
+    __table_args__ = (
+        db.Index('ix_ticket_affiliate_created', 'affiliate_id', 'created_at'),
+        db.Index('ix_ticket_status', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(200), nullable=False)
     message = db.Column(db.Text, nullable=False)
@@ -373,6 +530,12 @@ class TicketResponse(db.Model):
     user = db.relationship('User', backref='ticket_responses')
 
 class Notification(db.Model):
+    __table_args__ = (
+        db.Index('ix_notification_user_created', 'user_id', 'created_at'),
+        # The unread badge polls only unread rows
+        db.Index('ix_notification_user_unread', 'user_id', 'created_at', postgresql_where=db.text('NOT read')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     type = db.Column(db.String(50))  # 'new_ticket', 'pending_reply', etc.
@@ -394,6 +557,11 @@ class Notification(db.Model):
         }
 
 class Webhook(db.Model):
+    __table_args__ = (
+        # Webhook fan-out only looks at active hooks
+        db.Index('ix_webhook_user_active', 'user_id', postgresql_where=db.text('is_active')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
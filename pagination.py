@@ -0,0 +1,141 @@
+import base64
+import binascii
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Parse a ``limit`` query parameter, clamped to ``maximum``"""
+    if value in (None, ''):
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be greater than zero')
+    return min(limit, maximum)
+
+
+def parse_datetime(value):
+    """Parse an ISO 8601 date or datetime query parameter"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        raise ValueError(f'Invalid date: {value}')
+
+
+def parse_datetime_end(value):
+    """Parse an inclusive end-of-range query parameter into an exclusive bound.
+
+    A date without a time covers that whole day, so ``2026-10-18`` becomes
+    ``2026-10-19 00:00``; filter with ``column < bound``.
+    """
+    end = parse_datetime(value)
+    if end is None:
+        return None
+    if 'T' not in value and ' ' not in value.strip():
+        return end + timedelta(days=1)
+    # Timestamps are stored to the microsecond, so this keeps ``<= end``
+    return end + timedelta(microseconds=1)
+
+
+def encode_cursor(timestamp, row_id):
+    """Encode a (timestamp, id) keyset position as an opaque token"""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token produced by ``encode_cursor`` back into (timestamp, id)"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        timestamp, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor('Invalid or malformed cursor')
+
+
+def _seek(query, timestamp_column, id_column, position, descending):
+    """Restrict ``query`` to rows strictly after ``position`` in keyset order"""
+    timestamp, last_id = position
+    if descending:
+        return query.filter(or_(
+            timestamp_column < timestamp,
+            and_(timestamp_column == timestamp, id_column < last_id)
+        ))
+    return query.filter(or_(
+        timestamp_column > timestamp,
+        and_(timestamp_column == timestamp, id_column > last_id)
+    ))
+
+
+def keyset_page(query, timestamp_column, id_column, limit, cursor=None, descending=True):
+    """Return one page of ``query`` ordered by (timestamp, id) and the next cursor.
+
+    Rows are fetched with ``limit + 1`` so the presence of a following page is
+    known without a separate count query.
+    """
+    if cursor:
+        query = _seek(query, timestamp_column, id_column, decode_cursor(cursor), descending)
+
+    if descending:
+        query = query.order_by(timestamp_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(timestamp_column.asc(), id_column.asc())
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            getattr(last, timestamp_column.key),
+            getattr(last, id_column.key)
+        )
+    return rows, next_cursor
+
+
+def parse_sync_position(value):
+    """Accept either an ISO timestamp or a sync cursor and return (timestamp, id).
+
+    A plain timestamp starts the feed at that instant (inclusive); a cursor
+    resumes right after the last row a client has already seen.
+    """
+    try:
+        return parse_datetime(value), 0
+    except ValueError:
+        return decode_cursor(value)
+
+
+def change_feed(query, timestamp_column, id_column, position, limit, settled_before=None):
+    """Return rows changed after ``position`` in ascending order.
+
+    Returns (rows, sync_cursor, has_more). The cursor always points at the last
+    row delivered (or back at ``position`` when nothing changed), so clients
+    can store it and poll again. Rows newer than ``settled_before`` are held
+    back so that transactions still committing with an earlier timestamp are
+    not skipped by the cursor.
+    """
+    query = _seek(query, timestamp_column, id_column, position, descending=False)
+    if settled_before is not None:
+        query = query.filter(timestamp_column <= settled_before)
+    query = query.order_by(timestamp_column.asc(), id_column.asc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        last = rows[-1]
+        position = (getattr(last, timestamp_column.key), getattr(last, id_column.key))
+    return rows, encode_cursor(*position), has_more
@@ -166,7 +166,6 @@ def create_referrals(affiliates, treatments, num_referrals_per_affiliate=20):
             # Add commission for completed referrals
             if status == 'completed':
                 referral.commission_amount = float(treatment.group.commission_amount)
-                affiliate.total_earnings = float(affiliate.total_earnings or 0) + referral.commission_amount
             
             db.session.add(referral)
             
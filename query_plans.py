@@ -0,0 +1,205 @@
+"""EXPLAIN checks for the application's hot queries (flask check-query-plans).
+
+Each check mirrors a query the app runs on a hot path and names the tables
+that must be reached through an index. The plans are captured with EXPLAIN
+(FORMAT JSON) and a check fails when one of those tables is read with a
+sequential scan. With ``seed`` a synthetic dataset is inserted and analyzed
+first, inside a transaction that is rolled back afterwards, so the planner
+sees production-like table sizes without leaving data behind. Point it at a
+staging or CI database: seeding still takes row locks while it runs.
+"""
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, select
+from extensions import db
+from models import (
+    User, Affiliate, Referral, Treatment, TreatmentGroup, Ticket, Notification, Webhook
+)
+
+PlanCheck = namedtuple('PlanCheck', ['name', 'statement', 'indexed_tables'])
+PlanResult = namedtuple('PlanResult', ['name', 'passed', 'seq_scans', 'summary'])
+
+SEED_COUNTRIES = ['TR', 'DE', 'GB', 'NL', 'FR', 'US', 'SE', 'NO', 'DK', 'BE', 'AT', 'CH', 'IT', 'ES',
+                  'PL', 'RO', 'BG', 'GR', 'IE', 'FI', 'AZ', 'GE', 'UA', 'KZ', 'SA', 'AE', 'QA', 'KW', 'IL', 'EG']
+SEED_CHUNK_SIZE = 5000
+
+
+def _insert_chunks(connection, table, rows, returning=False):
+    ids = []
+    for start in range(0, len(rows), SEED_CHUNK_SIZE):
+        chunk = rows[start:start + SEED_CHUNK_SIZE]
+        if returning:
+            ids.extend(connection.execute(insert(table).returning(table.c.id), chunk).scalars())
+        else:
+            connection.execute(insert(table), chunk)
+    return ids
+
+
+def seed_dataset(connection, referrals):
+    """Insert a synthetic dataset sized around ``referrals`` referral rows"""
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    affiliate_count = max(referrals // 250, 10)
+    tag = now.strftime('%H%M%S')
+
+    user_ids = _insert_chunks(connection, User.__table__, [
+        {'username': f'plan{tag}_{n}', 'email': f'plan{tag}_{n}@example.invalid', 'role': 'affiliate',
+         'created_at': now, 'last_seen': now}
+        for n in range(affiliate_count)
+    ], returning=True)
+    affiliate_ids = _insert_chunks(connection, Affiliate.__table__, [
+        {'user_id': user_id, 'slug': f'p{tag}{n}', 'approved': True, 'total_earnings': 0}
+        for n, user_id in enumerate(user_ids)
+    ], returning=True)
+
+    group_ids = _insert_chunks(connection, TreatmentGroup.__table__, [
+        {'name': f'Plan group {n}', 'commission_amount': 100} for n in range(40)
+    ], returning=True)
+    treatment_ids = _insert_chunks(connection, Treatment.__table__, [
+        {'name': f'Plan treatment {n}', 'group_id': group_ids[n % len(group_ids)], 'active': rng.random() > 0.3}
+        for n in range(400)
+    ], returning=True)
+
+    rows = []
+    for n in range(referrals):
+        created_at = now - timedelta(minutes=rng.randrange(2 * 365 * 24 * 60))
+        status = rng.choices(['new', 'in-progress', 'completed'], weights=[3, 2, 5])[0]
+        rows.append({
+            'affiliate_id': rng.choice(affiliate_ids),
+            'treatment_id': rng.choice(treatment_ids),
+            'name': 'Plan', 'surname': 'Check',
+            'email': f'plan{tag}_{n}@example.invalid',
+            'email_normalized': f'plan{tag}_{n}@example.invalid',
+            'phone': '5550000000',
+            'status': status,
+            'commission_amount': 100 if status == 'completed' else 0,
+            'treatment_value': 0,
+            'country': rng.choice(SEED_COUNTRIES) if rng.random() > 0.2 else None,
+            'created_at': created_at,
+            'updated_at': created_at,
+        })
+    _insert_chunks(connection, Referral.__table__, rows)
+
+    _insert_chunks(connection, Notification.__table__, [
+        {'user_id': rng.choice(user_ids), 'type': 'new_ticket', 'message': 'Plan check',
+         'read': rng.random() > 0.1, 'created_at': now - timedelta(minutes=rng.randrange(525600))}
+        for _ in range(referrals // 5)
+    ])
+    _insert_chunks(connection, Ticket.__table__, [
+        {'affiliate_id': rng.choice(affiliate_ids), 'subject': 'Plan check', 'message': 'Plan check',
+         'status': rng.choices(['open', 'in-progress', 'closed'], weights=[5, 5, 90])[0],
+         'created_at': now - timedelta(minutes=rng.randrange(525600))}
+        for _ in range(referrals // 20)
+    ])
+    _insert_chunks(connection, Webhook.__table__, [
+        {'user_id': user_id, 'name': 'Plan check', 'url': 'https://example.invalid/hook', 'secret': 'x',
+         'events': ['referral.completed'], 'is_active': n == 0, 'created_at': now}
+        for user_id in user_ids for n in range(3)
+    ])
+
+    for table in ('user', 'affiliate', 'treatment_group', 'treatment', 'referral', 'notification', 'ticket', 'webhook'):
+        connection.exec_driver_sql(f'ANALYZE "{table}"')
+
+
+def _sample(connection, column, *criteria):
+    return connection.execute(select(column).where(*criteria).limit(1)).scalar()
+
+
+def plan_checks(connection):
+    """The hot queries, parameterized with values that exist in the database"""
+    now = datetime.utcnow()
+    affiliate_id = _sample(connection, Referral.affiliate_id)
+    user_id = _sample(connection, Notification.user_id)
+    group_id = _sample(connection, Treatment.group_id, Treatment.group_id.isnot(None))
+    country = _sample(connection, Referral.country, Referral.country.isnot(None))
+    email = _sample(connection, Referral.email_normalized, Referral.email_normalized.isnot(None))
+
+    return [
+        PlanCheck('api: referral page', select(Referral).where(
+            Referral.affiliate_id == affiliate_id
+        ).order_by(Referral.created_at.desc(), Referral.id.desc()).limit(101), {'referral'}),
+        PlanCheck('api: referral change feed', select(Referral).where(
+            Referral.affiliate_id == affiliate_id, Referral.updated_at > now - timedelta(days=1)
+        ).order_by(Referral.updated_at, Referral.id).limit(101), {'referral'}),
+        PlanCheck('earnings: completed commission', select(
+            func.coalesce(func.sum(Referral.commission_amount), 0)
+        ).where(Referral.affiliate_id == affiliate_id, Referral.status == 'completed'), {'referral'}),
+        PlanCheck('admin: recent referrals', select(Referral.id, Referral.status).where(
+            Referral.created_at >= now - timedelta(days=1)
+        ), {'referral'}),
+        PlanCheck('admin: referrals by status and date', select(Referral).where(
+            Referral.status == 'in-progress', Referral.created_at >= now - timedelta(days=7)
+        ).order_by(Referral.created_at.desc()).limit(50), {'referral'}),
+        PlanCheck('admin: country drill-down', select(Referral).where(Referral.country == country), {'referral'}),
+        PlanCheck('crm: contact match', select(Referral.id).where(Referral.email_normalized == email), {'referral'}),
+        PlanCheck('referral form: first active treatment', select(Treatment).where(
+            Treatment.group_id == group_id, Treatment.active == True
+        ).order_by(Treatment.id).limit(1), {'treatment'}),
+        PlanCheck('affiliate: tickets', select(Ticket).where(
+            Ticket.affiliate_id == affiliate_id
+        ).order_by(Ticket.created_at.desc()), {'ticket'}),
+        PlanCheck('admin: open ticket count', select(func.count()).select_from(Ticket).where(
+            Ticket.status == 'open'
+        ), {'ticket'}),
+        PlanCheck('admin: notifications', select(Notification).where(
+            Notification.user_id == user_id
+        ).order_by(Notification.created_at.desc()), {'notification'}),
+        PlanCheck('admin: unread notifications', select(Notification).where(
+            Notification.user_id == user_id, Notification.read == False
+        ).order_by(Notification.created_at.desc()), {'notification'}),
+        PlanCheck('webhooks: active hooks for users', select(Webhook).where(
+            Webhook.is_active == True, Webhook.user_id.in_([user_id])
+        ), {'webhook'}),
+    ]
+
+
+def _walk(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from _walk(child)
+
+
+def explain(connection, statement):
+    """Return the root plan node of ``statement`` from EXPLAIN (FORMAT JSON)"""
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    rows = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+    return rows[0]['Plan']
+
+
+def _describe(node):
+    index = node.get('Index Name')
+    relation = node.get('Relation Name')
+    if index:
+        return f"{node['Node Type']} using {index}"
+    if relation:
+        return f"{node['Node Type']} on {relation}"
+    return node['Node Type']
+
+
+def run_plan_checks(connection):
+    """Explain every check; return a PlanResult per check"""
+    results = []
+    for check in plan_checks(connection):
+        nodes = list(_walk(explain(connection, check.statement)))
+        seq_scans = sorted({
+            node['Relation Name'] for node in nodes
+            if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in check.indexed_tables
+        })
+        scans = [_describe(node) for node in nodes if node.get('Relation Name')]
+        results.append(PlanResult(check.name, not seq_scans, seq_scans, ', '.join(scans)))
+    return results
+
+
+def check_query_plans(seed=0):
+    """Optionally seed, then explain the hot queries; everything is rolled back"""
+    with db.engine.connect() as connection:
+        if connection.dialect.name != 'postgresql':
+            raise RuntimeError('Query plan checks need PostgreSQL')
+        transaction = connection.begin()
+        try:
+            if seed:
+                seed_dataset(connection, seed)
+            return run_plan_checks(connection)
+        finally:
+            transaction.rollback()
@@ -0,0 +1,159 @@
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from extensions import db
+
+# Requests allowed per window (in seconds) for each API key tier.
+# Override with the RATE_LIMIT_TIERS config value.
+DEFAULT_TIERS = {
+    'standard': (100, 3600),
+    'partner': (1000, 3600),
+    'internal': (10000, 3600),
+}
+DEFAULT_TIER = 'standard'
+
+RateLimitResult = namedtuple('RateLimitResult', ['allowed', 'limit', 'window', 'remaining', 'reset', 'retry_after'])
+
+
+class MemoryBackend:
+    """Token buckets held in process memory, suitable for a single worker"""
+
+    def __init__(self, sweep_interval=60):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._last_sweep = time.time()
+
+    def consume(self, key, capacity, rate, now):
+        """Take one token from ``key``'s bucket and return (allowed, tokens_left)"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = float(capacity)
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            # Remember when the bucket refills so idle keys can be dropped
+            full_at = now + (capacity - tokens) / rate
+            self._buckets[key] = (tokens, now, full_at)
+
+            if now - self._last_sweep >= self._sweep_interval:
+                self._sweep(now)
+        return allowed, tokens
+
+    def _sweep(self, now):
+        """Forget buckets that have refilled; they behave exactly like new ones"""
+        idle = [key for key, bucket in self._buckets.items() if bucket[2] <= now]
+        for key in idle:
+            del self._buckets[key]
+        self._last_sweep = now
+
+
+class DatabaseBackend:
+    """Token buckets stored in the ``rate_limit_bucket`` table.
+
+    Each request is a single atomic upsert, so every gunicorn worker (and every
+    host pointing at the same database) draws from the same bucket.
+    """
+
+    _refill = (
+        "CASE WHEN rate_limit_bucket.tokens + (:now - rate_limit_bucket.updated_at) * :rate > :capacity "
+        "THEN :capacity "
+        "ELSE rate_limit_bucket.tokens + (:now - rate_limit_bucket.updated_at) * :rate END"
+    )
+
+    _statement = text(
+        "INSERT INTO rate_limit_bucket (bucket_key, tokens, updated_at, allowed) "
+        "VALUES (:key, :capacity - 1, :now, true) "
+        "ON CONFLICT (bucket_key) DO UPDATE SET "
+        f"tokens = CASE WHEN {_refill} >= 1 THEN {_refill} - 1 ELSE {_refill} END, "
+        f"allowed = ({_refill} >= 1), "
+        "updated_at = :now "
+        "RETURNING tokens, allowed"
+    )
+
+    def consume(self, key, capacity, rate, now):
+        """Take one token from ``key``'s bucket and return (allowed, tokens_left)"""
+        with db.engine.begin() as conn:
+            row = conn.execute(self._statement, {
+                'key': key,
+                'capacity': float(capacity),
+                'rate': rate,
+                'now': now
+            }).one()
+        return bool(row.allowed), float(row.tokens)
+
+
+class RateLimiter:
+    """Apply per-tier token bucket limits on top of a storage backend"""
+
+    def __init__(self, backend, tiers=None, fallback=None):
+        self.backend = backend
+        self.tiers = tiers or DEFAULT_TIERS
+        self.fallback = fallback
+
+    def get_tier(self, tier):
+        return self.tiers.get(tier) or self.tiers[DEFAULT_TIER]
+
+    def hit(self, key, tier=None):
+        """Record one request for ``key`` and return a RateLimitResult"""
+        limit, window = self.get_tier(tier or DEFAULT_TIER)
+        rate = limit / window
+        now = time.time()
+
+        try:
+            allowed, tokens = self.backend.consume(key, limit, rate, now)
+        except SQLAlchemyError as e:
+            if self.fallback is None:
+                raise
+            logging.error(f"Rate limit backend unavailable, using in-memory buckets: {str(e)}")
+            allowed, tokens = self.fallback.consume(key, limit, rate, now)
+
+        return RateLimitResult(
+            allowed=allowed,
+            limit=limit,
+            window=window,
+            remaining=max(int(math.floor(tokens)), 0),
+            reset=int(math.ceil((limit - tokens) / rate)),
+            retry_after=0 if allowed else int(math.ceil((1 - tokens) / rate))
+        )
+
+
+def create_rate_limiter(config):
+    """Build the limiter selected by the RATE_LIMIT_BACKEND config value"""
+    backend_name = config.get('RATE_LIMIT_BACKEND', 'memory')
+    tiers = config.get('RATE_LIMIT_TIERS') or DEFAULT_TIERS
+
+    if backend_name == 'database':
+        return RateLimiter(DatabaseBackend(), tiers, fallback=MemoryBackend())
+    if backend_name != 'memory':
+        logging.warning(f"Unknown rate limit backend '{backend_name}', using in-memory buckets")
+    return RateLimiter(MemoryBackend(), tiers)
+
+
+def get_rate_limiter():
+    """Return the application's rate limiter, creating it on first use"""
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        limiter = create_rate_limiter(current_app.config)
+        current_app.extensions['rate_limiter'] = limiter
+    return limiter
+
+
+def add_rate_limit_headers(response, result):
+    """Describe the caller's current bucket in X-RateLimit-* headers"""
+    response.headers['X-RateLimit-Limit'] = str(result.limit)
+    response.headers['X-RateLimit-Remaining'] = str(result.remaining)
+    response.headers['X-RateLimit-Reset'] = str(result.reset)
+    if not result.allowed:
+        response.headers['Retry-After'] = str(result.retry_after)
+    return response
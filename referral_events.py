@@ -0,0 +1,151 @@
+"""ORM flush listeners that keep derived referral data in step with the referral table.
+
+Any referral created, updated or deleted through the ORM is picked up here,
+so views do not have to remember to maintain the derived tables themselves.
+Bulk Core statements bypass these listeners and must call the service
+functions directly (see referral_service.create_referrals_batch). The app
+installs the listeners with ``register()`` at startup.
+"""
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from models import Affiliate, Referral, Treatment
+from contacts import contact_fields
+import daily_stats_service
+import stats_service
+import ledger_service
+
+CONTACT_ATTRIBUTES = ('email', 'phone', 'country')
+
+# The rollup dimensions are optional so earnings-only callers can pass three fields
+ReferralState = namedtuple(
+    'ReferralState', ['affiliate_id', 'status', 'commission_amount', 'treatment_id', 'country', 'created_at'],
+    defaults=(None, None, None)
+)
+
+
+def _current_value(referral, attribute):
+    """The attribute's value after this flush, loading it if it was expired"""
+    if attribute in referral.__dict__:
+        return referral.__dict__[attribute]
+    return getattr(referral, attribute)
+
+
+def _previous_value(referral, attribute):
+    """The attribute's value before this flush"""
+    history = get_history(referral, attribute)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    if history.added:
+        return None
+    # Neither loaded nor changed in this flush, so it still holds the old value
+    return _current_value(referral, attribute)
+
+
+def _state(referral, value):
+    return ReferralState(
+        affiliate_id=value(referral, 'affiliate_id'),
+        status=value(referral, 'status') or 'new',
+        commission_amount=value(referral, 'commission_amount'),
+        treatment_id=value(referral, 'treatment_id'),
+        country=value(referral, 'country'),
+        created_at=value(referral, 'created_at')
+    )
+
+
+def referral_changes(session):
+    """Yield (referral, old_state, new_state) for every referral in the flush"""
+    for obj in session.new:
+        if isinstance(obj, Referral):
+            yield obj, None, _state(obj, _current_value)
+    for obj in session.dirty:
+        if isinstance(obj, Referral) and session.is_modified(obj):
+            old = _state(obj, _previous_value)
+            new = _state(obj, _current_value)
+            if old != new:
+                yield obj, old, new
+    for obj in session.deleted:
+        if isinstance(obj, Referral):
+            yield obj, _state(obj, _previous_value), None
+
+
+def normalize_referral_contacts(session, flush_context, instances):
+    """Derive the indexed matching columns whenever email, phone or country change"""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Referral):
+            continue
+        if obj in session.dirty and not any(
+            get_history(obj, attribute).has_changes() for attribute in CONTACT_ATTRIBUTES
+        ):
+            continue
+        for column, value in contact_fields(obj.email, obj.phone, obj.country).items():
+            setattr(obj, column, value)
+
+
+def maintain_referral_aggregates(session, flush_context):
+    changes = list(referral_changes(session))
+    if changes:
+        connection = session.connection()
+        deltas = stats_service.StatsDeltas()
+        rollup = daily_stats_service.RollupDeltas()
+        groups = daily_stats_service.treatment_groups(connection, {
+            state.treatment_id for _, old, new in changes for state in (old, new) if state is not None
+        })
+        entries = []
+        for referral, old, new in changes:
+            if old is not None:
+                deltas.add(old.affiliate_id, stats_service.referral_contribution(old.status, old.commission_amount), -1)
+                rollup.add(daily_stats_service.rollup_key(old, groups), old.commission_amount, -1)
+            if new is not None:
+                deltas.add(new.affiliate_id, stats_service.referral_contribution(new.status, new.commission_amount))
+                rollup.add(daily_stats_service.rollup_key(new, groups), new.commission_amount)
+            entries.extend(ledger_service.referral_entries(referral.id, old, new))
+
+        stats_service.apply_stats_deltas(connection, deltas)
+        daily_stats_service.apply_rollup_deltas(connection, rollup)
+        changed = ledger_service.append_entries(connection, entries)
+        if changed:
+            session.info.setdefault('earnings_changed', set()).update(changed)
+
+    # Moving a treatment to another group re-files its referrals under the new group
+    regrouped = [
+        obj.id for obj in session.dirty
+        if isinstance(obj, Treatment) and _group_changed(obj)
+    ]
+    if regrouped:
+        connection = session.connection()
+        days = daily_stats_service.referral_days(connection, regrouped)
+        daily_stats_service.rebuild_daily_stats(days, connection=connection)
+
+
+def _group_changed(treatment):
+    history = get_history(treatment, 'group_id')
+    if not history.has_changes():
+        return False
+    # Form values arrive as strings; '3' replacing 3 is not a move
+    return {str(value) for value in history.deleted} != {str(value) for value in history.added}
+
+
+def expire_changed_earnings(session, flush_context):
+    """Loaded affiliates would otherwise keep the total_earnings from before the ledger update"""
+    for affiliate_id in session.info.pop('earnings_changed', ()):
+        affiliate = session.identity_map.get(session.identity_key(Affiliate, affiliate_id))
+        if affiliate is not None:
+            session.expire(affiliate, ['total_earnings'])
+
+
+LISTENERS = (
+    ('before_flush', normalize_referral_contacts),
+    ('after_flush', maintain_referral_aggregates),
+    ('after_flush_postexec', expire_changed_earnings),
+)
+
+
+def register():
+    """Install the flush listeners on every ORM session; safe to call more than once"""
+    for identifier, listener in LISTENERS:
+        if not event.contains(Session, identifier, listener):
+            event.listen(Session, identifier, listener)
@@ -0,0 +1,284 @@
+from datetime import datetime
+from decimal import Decimal
+import csv
+import io
+import json
+import logging
+from sqlalchemy import insert, select
+from sqlalchemy.orm import selectinload
+from extensions import db
+from models import Referral, Treatment, TreatmentGroup
+import daily_stats_service
+import stats_service
+from contacts import contact_fields
+from referral_events import ReferralState
+
+MAX_BATCH_SIZE = 5000
+MAX_TRANSITION_BATCH = 1000
+REFERRAL_STATUSES = ['new', 'in-progress', 'completed']
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_FORMATS = ('ndjson', 'csv')
+REQUIRED_REFERRAL_FIELDS = ['name', 'surname', 'email', 'phone', 'treatment_id']
+
+
+def _validate_referral_item(item, active_treatment_ids):
+    """Return (row, None) for a valid batch item or (None, error message)"""
+    if not isinstance(item, dict):
+        return None, 'Each referral must be a JSON object'
+
+    missing = [field for field in REQUIRED_REFERRAL_FIELDS if item.get(field) in (None, '')]
+    if missing:
+        return None, f"Missing required fields: {', '.join(missing)}"
+
+    try:
+        treatment_id = int(item['treatment_id'])
+    except (TypeError, ValueError):
+        return None, 'treatment_id must be an integer'
+    if treatment_id not in active_treatment_ids:
+        return None, 'Invalid or inactive treatment'
+
+    row = {'treatment_id': treatment_id}
+    for field in ('name', 'surname', 'email', 'phone'):
+        value = str(item[field]).strip()
+        max_length = Referral.__table__.c[field].type.length
+        if len(value) > max_length:
+            return None, f'{field} must be at most {max_length} characters'
+        row[field] = value
+    return row, None
+
+
+def create_referrals_batch(affiliate_id, items):
+    """Validate and insert a batch of referrals for one affiliate.
+
+    Treatments are checked against one prefetched set, and all valid rows go
+    in through a single executemany INSERT in one transaction. Returns one
+    result per input item, in input order.
+    """
+    requested_ids = set()
+    for item in items:
+        if isinstance(item, dict):
+            try:
+                requested_ids.add(int(item.get('treatment_id')))
+            except (TypeError, ValueError):
+                continue
+
+    active_treatment_ids = set()
+    if requested_ids:
+        active_treatment_ids = {
+            treatment_id for (treatment_id,) in db.session.query(Treatment.id).filter(
+                Treatment.id.in_(requested_ids),
+                Treatment.active == True
+            )
+        }
+
+    now = datetime.utcnow()
+    results = []
+    rows = []
+    positions = []
+    for index, item in enumerate(items):
+        row, error = _validate_referral_item(item, active_treatment_ids)
+        if error:
+            results.append({'index': index, 'status': 'error', 'error': error})
+            continue
+        row.update(affiliate_id=affiliate_id, status='new', created_at=now, updated_at=now)
+        row.update(contact_fields(row['email'], row['phone']))
+        rows.append(row)
+        positions.append(index)
+        results.append(None)
+
+    if rows:
+        try:
+            ids = db.session.scalars(
+                insert(Referral).returning(Referral.id, sort_by_parameter_order=True),
+                rows
+            ).all()
+
+            # Core inserts bypass the ORM flush listeners, so update counters here
+            connection = db.session.connection()
+            deltas = stats_service.StatsDeltas()
+            rollup = daily_stats_service.RollupDeltas()
+            groups = daily_stats_service.treatment_groups(connection, {row['treatment_id'] for row in rows})
+            for row in rows:
+                deltas.add(affiliate_id, stats_service.referral_contribution(row['status'], 0))
+                state = ReferralState(affiliate_id, row['status'], 0, row['treatment_id'], row.get('country'), now)
+                rollup.add(daily_stats_service.rollup_key(state, groups), 0)
+            stats_service.apply_stats_deltas(connection, deltas)
+            daily_stats_service.apply_rollup_deltas(connection, rollup)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        for index, referral_id in zip(positions, ids):
+            results[index] = {'index': index, 'status': 'created', 'id': referral_id}
+
+    logging.info(f"Batch created {len(rows)} of {len(items)} referrals for affiliate {affiliate_id}")
+    return results
+
+
+def _completion_commission(referral):
+    """Return (commission, None) for a referral about to complete, or (None, error)"""
+    treatment = referral.treatment
+    if not treatment:
+        return None, 'Missing treatment information'
+    if not treatment.group:
+        return None, 'Treatment has no group assigned'
+    commission = Decimal(str(treatment.group.commission_amount or 0))
+    if commission <= 0:
+        return None, 'Invalid commission amount'
+    return commission, None
+
+
+def bulk_transition_referrals(referral_ids, new_status, affiliate_id=None):
+    """Move many referrals to ``new_status`` in a single transaction.
+
+    Treatments and groups are loaded for the whole batch up front and
+    completion commissions are computed in one pass; the flush records the
+    earnings changes in the commission ledger. When ``affiliate_id`` is
+    given, referrals belonging to other affiliates are reported as not found.
+
+    Returns (results, transitions): one result per requested id, and a plain
+    dict per referral whose status actually changed, captured before commit
+    so callers can use it without reloading expired rows.
+    """
+    requested = list(dict.fromkeys(referral_ids))
+    referrals = Referral.query.options(
+        selectinload(Referral.treatment).selectinload(Treatment.group)
+    ).filter(Referral.id.in_(requested)).all()
+    by_id = {referral.id: referral for referral in referrals}
+
+    results = []
+    transitions = []
+    for referral_id in requested:
+        referral = by_id.get(referral_id)
+        if not referral or (affiliate_id is not None and referral.affiliate_id != affiliate_id):
+            results.append({'id': referral_id, 'status': 'error', 'error': 'Referral not found'})
+            continue
+
+        old_status = referral.status
+        if old_status == new_status:
+            results.append({'id': referral_id, 'status': 'unchanged'})
+            continue
+
+        if new_status == 'completed':
+            commission, error = _completion_commission(referral)
+            if error:
+                results.append({'id': referral_id, 'status': 'error', 'error': error})
+                continue
+            referral.commission_amount = commission
+
+        referral.status = new_status
+        transitions.append({
+            'id': referral.id,
+            'old_status': old_status,
+            'new_status': new_status,
+            'affiliate_id': referral.affiliate_id,
+            'treatment_id': referral.treatment_id
+        })
+        results.append({'id': referral_id, 'status': 'updated', 'old_status': old_status})
+
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logging.info(f"Bulk moved {len(transitions)} of {len(requested)} referrals to {new_status}")
+    return results, transitions
+
+
+def parse_transition_request(data):
+    """Validate a bulk transition body; return (ids, status, None) or (None, None, error)"""
+    if not isinstance(data, dict):
+        return None, None, 'Send a JSON object with "ids" and "status"'
+
+    status = data.get('status')
+    if status not in REFERRAL_STATUSES:
+        return None, None, f"Status must be one of: {', '.join(REFERRAL_STATUSES)}"
+
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return None, None, '"ids" must be a non-empty array of referral ids'
+    if len(ids) > MAX_TRANSITION_BATCH:
+        return None, None, f'At most {MAX_TRANSITION_BATCH} referrals can be updated at once'
+    try:
+        ids = [int(referral_id) for referral_id in ids]
+    except (TypeError, ValueError):
+        return None, None, '"ids" must contain integers'
+    return ids, status, None
+
+
+def _export_statement(affiliate_id, status=None, created_from=None, created_before=None):
+    """Select an affiliate's referrals with treatment and group names in one join"""
+    statement = select(
+        Referral.id,
+        Referral.name,
+        Referral.surname,
+        Referral.email,
+        Referral.phone,
+        Referral.status,
+        Referral.commission_amount,
+        Referral.treatment_value,
+        Referral.country,
+        Referral.city,
+        Referral.created_at,
+        Referral.updated_at,
+        Referral.treatment_id,
+        Treatment.name.label('treatment_name'),
+        TreatmentGroup.id.label('treatment_group_id'),
+        TreatmentGroup.name.label('treatment_group_name')
+    ).outerjoin(
+        Treatment, Referral.treatment_id == Treatment.id
+    ).outerjoin(
+        TreatmentGroup, Treatment.group_id == TreatmentGroup.id
+    ).where(
+        Referral.affiliate_id == affiliate_id
+    )
+
+    if status:
+        statement = statement.where(Referral.status == status)
+    if created_from:
+        statement = statement.where(Referral.created_at >= created_from)
+    if created_before:
+        statement = statement.where(Referral.created_at < created_before)
+
+    return statement.order_by(Referral.id).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+
+def _export_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def iter_referral_export(affiliate_id, export_format='ndjson', **filters):
+    """Yield an affiliate's referrals as NDJSON or CSV text chunks.
+
+    Rows are read through a server-side cursor ``EXPORT_CHUNK_SIZE`` at a
+    time, so memory use stays flat no matter how long the history is.
+    """
+    result = db.session.execute(_export_statement(affiliate_id, **filters))
+    columns = list(result.keys())
+    try:
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            for partition in result.partitions():
+                for row in partition:
+                    writer.writerow([_export_value(value) for value in row])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue()
+        else:
+            for partition in result.partitions():
+                yield ''.join(
+                    json.dumps(dict(zip(columns, (_export_value(value) for value in row)))) + '\n'
+                    for row in partition
+                )
+    finally:
+        result.close()
@@ -0,0 +1,154 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+import logging
+from sqlalchemy import case, delete, func, literal, select, update
+from extensions import db
+from models import Affiliate, AffiliateStats, Referral
+from db_helpers import dialect_insert
+
+# Referral status -> counter column on AffiliateStats
+STATUS_COLUMNS = {
+    'new': 'new_referrals',
+    'in-progress': 'in_progress_referrals',
+    'completed': 'completed_referrals',
+}
+COUNTER_COLUMNS = ['total_referrals'] + list(STATUS_COLUMNS.values()) + ['completed_commission']
+
+
+def referral_contribution(status, commission_amount):
+    """Counter values a single referral in ``status`` adds to its affiliate's row"""
+    contribution = {'total_referrals': 1}
+    column = STATUS_COLUMNS.get(status)
+    if column:
+        contribution[column] = 1
+    if status == 'completed':
+        contribution['completed_commission'] = Decimal(str(commission_amount or 0))
+    return contribution
+
+
+class StatsDeltas:
+    """Accumulate counter changes per affiliate before writing them"""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: defaultdict(int))
+
+    def add(self, affiliate_id, contribution, sign=1):
+        delta = self._deltas[affiliate_id]
+        for column, value in contribution.items():
+            delta[column] += sign * value
+
+    def items(self):
+        for affiliate_id, delta in self._deltas.items():
+            changes = {column: value for column, value in delta.items() if value}
+            if changes:
+                yield affiliate_id, changes
+
+
+def _aggregate_columns():
+    """Per-affiliate aggregates over the referral table, in COUNTER_COLUMNS order"""
+    columns = [func.count(Referral.id)]
+    for status in STATUS_COLUMNS:
+        columns.append(func.coalesce(func.sum(case((Referral.status == status, 1), else_=0)), 0))
+    columns.append(func.coalesce(func.sum(case(
+        (Referral.status == 'completed', func.coalesce(Referral.commission_amount, 0)),
+        else_=0
+    )), 0))
+    return columns
+
+
+def _seed_statement(connection, affiliate_id, now):
+    """INSERT an affiliate's counters computed from its referrals, unless a row exists"""
+    table = AffiliateStats.__table__
+    source = select(
+        literal(affiliate_id), *_aggregate_columns(), literal(now)
+    ).where(Referral.affiliate_id == affiliate_id)
+    return dialect_insert(connection, table).from_select(
+        ['affiliate_id'] + COUNTER_COLUMNS + ['updated_at'], source
+    ).on_conflict_do_nothing(index_elements=['affiliate_id'])
+
+
+def apply_stats_deltas(connection, deltas):
+    """Apply accumulated counter changes inside the caller's transaction.
+
+    Must run after the referral rows themselves have been written. An
+    affiliate without a counters row is seeded from an aggregate of its
+    referrals, which already includes the current change, so the delta is
+    not applied on top of it.
+    """
+    table = AffiliateStats.__table__
+    now = datetime.utcnow()
+    for affiliate_id, changes in deltas.items():
+        values = {column: table.c[column] + value for column, value in changes.items()}
+        values['updated_at'] = now
+        statement = update(table).where(table.c.affiliate_id == affiliate_id).values(values)
+
+        if connection.execute(statement).rowcount:
+            continue
+        if connection.execute(_seed_statement(connection, affiliate_id, now)).rowcount:
+            continue
+        # Another transaction seeded the row first; its aggregate cannot see our rows
+        connection.execute(statement)
+
+
+def ensure_affiliate_stats(affiliate_id):
+    """Return the AffiliateStats row for ``affiliate_id``, seeding it if missing"""
+    stats = db.session.get(AffiliateStats, affiliate_id)
+    if stats is None:
+        db.session.execute(_seed_statement(db.session.connection(), affiliate_id, datetime.utcnow()))
+        db.session.commit()
+        stats = db.session.get(AffiliateStats, affiliate_id)
+    return stats
+
+
+def _aggregate_query(affiliate_ids=None):
+    query = select(Affiliate.id, *_aggregate_columns()).select_from(Affiliate).outerjoin(
+        Referral, Referral.affiliate_id == Affiliate.id
+    ).group_by(Affiliate.id)
+    if affiliate_ids is not None:
+        query = query.where(Affiliate.id.in_(affiliate_ids))
+    return query
+
+
+def rebuild_affiliate_stats(affiliate_ids=None):
+    """Recompute counters from the referral table with one aggregate query.
+
+    Rebuilds every affiliate, or only ``affiliate_ids`` when given. Runs in
+    the current session transaction; the caller commits.
+    """
+    table = AffiliateStats.__table__
+    now = datetime.utcnow()
+    clear = delete(table)
+    if affiliate_ids is not None:
+        clear = clear.where(table.c.affiliate_id.in_(affiliate_ids))
+    db.session.execute(clear)
+
+    source = _aggregate_query(affiliate_ids).add_columns(literal(now))
+    db.session.execute(table.insert().from_select(
+        ['affiliate_id'] + COUNTER_COLUMNS + ['updated_at'], source
+    ))
+    logging.info(f"Rebuilt affiliate stats for {'all affiliates' if affiliate_ids is None else len(affiliate_ids)}")
+
+
+def verify_affiliate_stats():
+    """Compare stored counters with a fresh aggregate; return mismatching rows.
+
+    An affiliate without a counters row counts as all zeros, since rows are
+    only seeded on the affiliate's first referral write.
+    """
+    stored = {
+        row.affiliate_id: row
+        for row in db.session.execute(select(AffiliateStats.__table__))
+    }
+    mismatches = []
+    for row in db.session.execute(_aggregate_query()):
+        affiliate_id, expected = row[0], dict(zip(COUNTER_COLUMNS, row[1:]))
+        current = stored.get(affiliate_id)
+        if current is None:
+            if any(expected[c] for c in COUNTER_COLUMNS):
+                mismatches.append({'affiliate_id': affiliate_id, 'expected': expected, 'stored': None})
+            continue
+        actual = {column: getattr(current, column) for column in COUNTER_COLUMNS}
+        if any(Decimal(str(actual[c] or 0)) != Decimal(str(expected[c] or 0)) for c in COUNTER_COLUMNS):
+            mismatches.append({'affiliate_id': affiliate_id, 'expected': expected, 'stored': actual})
+    return mismatches
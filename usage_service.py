@@ -0,0 +1,261 @@
+"""Per-API-key usage accounting and daily/monthly quotas.
+
+Requests are counted in worker memory per (key, endpoint, hour) and flushed
+every USAGE_FLUSH_INTERVAL seconds as additive upserts into the hourly and
+daily rollup tables, so serving a request never writes to the database.
+Quotas are checked against the daily rollups plus the worker's unflushed
+counts; requests other workers have not flushed yet can overshoot a quota
+by at most one flush interval.
+"""
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import case, delete, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from extensions import db
+from models import ApiKeyUsageDaily, ApiKeyUsageHourly
+from db_helpers import dialect_insert
+
+USAGE_FLUSH_INTERVAL = 60  # seconds between rollup upserts
+HOURLY_RETENTION_DAYS = 35  # hourly rows older than this are purged
+
+# (daily, monthly) request quotas per API key tier; None means unlimited.
+# Override with the API_USAGE_QUOTAS config value.
+DEFAULT_QUOTAS = {
+    'standard': (2000, 50000),
+    'partner': (20000, 500000),
+    'internal': (None, None),
+}
+
+QuotaResult = namedtuple('QuotaResult', ['allowed', 'period', 'limit', 'used', 'retry_after'])
+
+
+def _hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _period_starts(now):
+    today = now.date()
+    return today, today.replace(day=1)
+
+
+def _next_period(period, now):
+    """Seconds until the current day or month is over"""
+    today = now.date()
+    if period == 'daily':
+        end = today + timedelta(days=1)
+    else:
+        end = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return math.ceil((datetime.combine(end, datetime.min.time()) - now).total_seconds())
+
+
+class UsageRecorder:
+    """Count requests in memory and fold them into the rollup tables in bulk"""
+
+    def __init__(self, interval=USAGE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}  # (key_id, endpoint, hour) -> [requests, errors]
+        self._totals = {}   # key_id -> (day, flushed today, flushed this month)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, key_id, endpoint, status_code, now=None):
+        slot = (key_id, endpoint, _hour(now or datetime.utcnow()))
+        with self._lock:
+            counts = self._pending.setdefault(slot, [0, 0])
+            counts[0] += 1
+            if status_code >= 400:
+                counts[1] += 1
+
+    def pending_usage(self, key_id, now):
+        """Unflushed (today, this month) request counts of ``key_id`` in this worker"""
+        today, month_start = _period_starts(now)
+        day_count = month_count = 0
+        with self._lock:
+            for (pending_key, _, hour), (requests, _) in self._pending.items():
+                if pending_key != key_id:
+                    continue
+                if hour.date() >= month_start:
+                    month_count += requests
+                    if hour.date() == today:
+                        day_count += requests
+        return day_count, month_count
+
+    def flushed_usage(self, key_id, now):
+        """(today, this month) request counts already in the rollups, read once per flush interval"""
+        today = now.date()
+        with self._lock:
+            cached = self._totals.get(key_id)
+        if cached is not None and cached[0] == today:
+            return cached[1], cached[2]
+
+        _, month_start = _period_starts(now)
+        row = db.session.execute(select(
+            func.coalesce(func.sum(case((ApiKeyUsageDaily.day == today, ApiKeyUsageDaily.request_count), else_=0)), 0),
+            func.coalesce(func.sum(ApiKeyUsageDaily.request_count), 0)
+        ).where(
+            ApiKeyUsageDaily.api_key_id == key_id,
+            ApiKeyUsageDaily.day >= month_start
+        )).one()
+        with self._lock:
+            self._totals[key_id] = (today, int(row[0]), int(row[1]))
+        return int(row[0]), int(row[1])
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Add all buffered counts to the hourly and daily rollups in one transaction"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if not pending:
+                # Still pick up what other workers flushed since the last check
+                self._totals.clear()
+                return
+
+        hourly = [
+            {'api_key_id': key_id, 'endpoint': endpoint, 'period_start': hour,
+             'request_count': requests, 'error_count': errors}
+            for (key_id, endpoint, hour), (requests, errors) in pending.items()
+        ]
+        daily = {}
+        for (key_id, endpoint, hour), (requests, errors) in pending.items():
+            counts = daily.setdefault((key_id, endpoint, hour.date()), [0, 0])
+            counts[0] += requests
+            counts[1] += errors
+        daily = [
+            {'api_key_id': key_id, 'endpoint': endpoint, 'day': day,
+             'request_count': requests, 'error_count': errors}
+            for (key_id, endpoint, day), (requests, errors) in daily.items()
+        ]
+
+        try:
+            with db.engine.begin() as conn:
+                for model, rows, period_column in (
+                    (ApiKeyUsageHourly, hourly, 'period_start'),
+                    (ApiKeyUsageDaily, daily, 'day'),
+                ):
+                    table = model.__table__
+                    statement = dialect_insert(conn, table)
+                    conn.execute(statement.on_conflict_do_update(
+                        index_elements=[table.c.api_key_id, table.c.endpoint, table.c[period_column]],
+                        set_={
+                            'request_count': table.c.request_count + statement.excluded.request_count,
+                            'error_count': table.c.error_count + statement.excluded.error_count,
+                        }
+                    ), rows)
+        except SQLAlchemyError as e:
+            logging.error(f"Could not flush API usage counts: {str(e)}")
+            # Put the counts back so the next flush retries them
+            with self._lock:
+                for slot, (requests, errors) in pending.items():
+                    counts = self._pending.setdefault(slot, [0, 0])
+                    counts[0] += requests
+                    counts[1] += errors
+            return
+
+        # The rollups now include what this worker held back; reload on next check
+        with self._lock:
+            self._totals.clear()
+
+
+usage_recorder = UsageRecorder()
+
+
+def get_quota(tier):
+    """(daily, monthly) quota for an API key tier"""
+    quotas = current_app.config.get('API_USAGE_QUOTAS') or DEFAULT_QUOTAS
+    return quotas.get(tier) or quotas.get('standard') or (None, None)
+
+
+def check_quota(identity, now=None):
+    """Return a QuotaResult for the request ``identity`` is about to make"""
+    daily_limit, monthly_limit = get_quota(identity.rate_limit_tier)
+    if daily_limit is None and monthly_limit is None:
+        return QuotaResult(True, None, None, None, 0)
+
+    now = now or datetime.utcnow()
+    try:
+        flushed_day, flushed_month = usage_recorder.flushed_usage(identity.key_id, now)
+    except SQLAlchemyError as e:
+        # Accounting must not take the API down with it
+        db.session.rollback()
+        logging.error(f"Could not read API usage for key {identity.key_id}: {str(e)}")
+        return QuotaResult(True, None, None, None, 0)
+    pending_day, pending_month = usage_recorder.pending_usage(identity.key_id, now)
+
+    for period, limit, used in (
+        ('daily', daily_limit, flushed_day + pending_day),
+        ('monthly', monthly_limit, flushed_month + pending_month),
+    ):
+        if limit is not None and used >= limit:
+            return QuotaResult(False, period, limit, used, _next_period(period, now))
+    return QuotaResult(True, None, None, None, 0)
+
+
+def record_request(identity, endpoint, status_code):
+    """Count one served request for ``identity``; flushes to the rollups when due"""
+    usage_recorder.record(identity.key_id, endpoint or 'unmatched', status_code)
+    usage_recorder.flush_if_due()
+
+
+def usage_chart_data(key_ids, days=30, now=None):
+    """Daily request and error counts for ``key_ids`` over the last ``days`` days.
+
+    Returns {'labels': [...], 'keys': {key_id: {'requests': [...], 'errors': [...]}}}
+    with one entry per day, zeros included, ready for Chart.js.
+    """
+    today = (now or datetime.utcnow()).date()
+    first_day = today - timedelta(days=days - 1)
+    labels = [first_day + timedelta(days=offset) for offset in range(days)]
+    series = {key_id: {'requests': [0] * days, 'errors': [0] * days} for key_id in key_ids}
+    if key_ids:
+        rows = db.session.execute(select(
+            ApiKeyUsageDaily.api_key_id,
+            ApiKeyUsageDaily.day,
+            func.sum(ApiKeyUsageDaily.request_count),
+            func.sum(ApiKeyUsageDaily.error_count)
+        ).where(
+            ApiKeyUsageDaily.api_key_id.in_(key_ids),
+            ApiKeyUsageDaily.day >= first_day
+        ).group_by(ApiKeyUsageDaily.api_key_id, ApiKeyUsageDaily.day))
+        for key_id, day, requests, errors in rows:
+            index = (day - first_day).days
+            series[key_id]['requests'][index] = int(requests)
+            series[key_id]['errors'][index] = int(errors)
+    return {'labels': [day.isoformat() for day in labels], 'keys': series}
+
+
+def usage_totals(key_ids, now=None):
+    """{key_id: (requests today, requests this month)} from the daily rollups"""
+    today, month_start = _period_starts(now or datetime.utcnow())
+    totals = {key_id: (0, 0) for key_id in key_ids}
+    if not key_ids:
+        return totals
+    rows = db.session.execute(select(
+        ApiKeyUsageDaily.api_key_id,
+        func.sum(case((ApiKeyUsageDaily.day == today, ApiKeyUsageDaily.request_count), else_=0)),
+        func.sum(ApiKeyUsageDaily.request_count)
+    ).where(
+        ApiKeyUsageDaily.api_key_id.in_(key_ids),
+        ApiKeyUsageDaily.day >= month_start
+    ).group_by(ApiKeyUsageDaily.api_key_id))
+    for key_id, day_count, month_count in rows:
+        totals[key_id] = (int(day_count), int(month_count))
+    return totals
+
+
+def purge_hourly_usage(retention_days=HOURLY_RETENTION_DAYS):
+    """Delete hourly rollups older than ``retention_days``; daily rollups are kept"""
+    cutoff = _hour(datetime.utcnow()) - timedelta(days=retention_days)
+    removed = db.session.execute(
+        delete(ApiKeyUsageHourly).where(ApiKeyUsageHourly.period_start < cutoff)
+    ).rowcount
+    db.session.commit()
+    return removed
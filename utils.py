@@ -6,6 +6,7 @@ from flask import current_app
 from geoip2.database import Reader
 from geoip2.errors import AddressNotFoundError
 from extensions import db
+from instrumentation import track_http
 
 def generate_unique_slug(length=8):
     characters = string.ascii_letters + string.digits
@@ -23,10 +24,11 @@ def format_phone_number(phone):
 
 def verify_recaptcha(token, min_score=0.5):
     try:
-        response = requests.post('https://www.google.com/recaptcha/api/siteverify', data={
-            'secret': current_app.config['RECAPTCHA_SECRET_KEY'],
-            'response': token
-        })
+        with track_http('recaptcha'):
+            response = requests.post('https://www.google.com/recaptcha/api/siteverify', data={
+                'secret': current_app.config['RECAPTCHA_SECRET_KEY'],
+                'response': token
+            })
         result = response.json()
         
         # Check if the score is above minimum threshold
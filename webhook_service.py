@@ -3,10 +3,12 @@ import hmac
 import hashlib
 import json
 import logging
+from collections import defaultdict
 from datetime import datetime
 from threading import Thread
 from flask import current_app
 from models import Webhook, db
+from instrumentation import track_http
 
 def generate_signature(payload, secret):
     """Generate HMAC signature for webhook payload"""
@@ -18,11 +20,13 @@ def generate_signature(payload, secret):
 
 def send_webhook(webhook_id, event_type, data):
     """Send webhook in a separate thread"""
-    Thread(target=_send_webhook, args=(webhook_id, event_type, data)).start()
+    # The thread has no app context of its own, so hand it the real app object
+    app = current_app._get_current_object()
+    Thread(target=_send_webhook, args=(app, webhook_id, event_type, data)).start()
 
-def _send_webhook(webhook_id, event_type, data):
+def _send_webhook(app, webhook_id, event_type, data):
     """Actually send the webhook"""
-    with current_app.app_context():
+    with app.app_context():
         try:
             webhook = Webhook.query.get(webhook_id)
             if not webhook or not webhook.is_active or event_type not in webhook.events:
@@ -36,16 +40,17 @@ def _send_webhook(webhook_id, event_type, data):
 
             signature = generate_signature(payload, webhook.secret)
             
-            response = requests.post(
-                webhook.url,
-                data=payload,
-                headers={
-                    'Content-Type': 'application/json',
-                    'X-Webhook-Signature': signature,
-                    'X-Event-Type': event_type
-                },
-                timeout=5
-            )
+            with track_http('webhook'):
+                response = requests.post(
+                    webhook.url,
+                    data=payload,
+                    headers={
+                        'Content-Type': 'application/json',
+                        'X-Webhook-Signature': signature,
+                        'X-Event-Type': event_type
+                    },
+                    timeout=5
+                )
             
             webhook.last_triggered = datetime.utcnow()
             
@@ -76,4 +81,19 @@ def trigger_webhook_event(event_type, data, user_id=None):
     
     for webhook in webhooks:
         if event_type in webhook.events:
-            send_webhook(webhook.id, event_type, data) 
\ No newline at end of file
+            send_webhook(webhook.id, event_type, data)
+
+def trigger_webhook_events(events):
+    """Trigger many (event_type, data, user_id) events with one webhook lookup"""
+    user_ids = {user_id for _, _, user_id in events}
+    if not user_ids:
+        return
+
+    webhooks_by_user = defaultdict(list)
+    for webhook in Webhook.query.filter(Webhook.is_active == True, Webhook.user_id.in_(user_ids)):
+        webhooks_by_user[webhook.user_id].append(webhook)
+
+    for event_type, data, user_id in events:
+        for webhook in webhooks_by_user[user_id]:
+            if event_type in webhook.events:
+                send_webhook(webhook.id, event_type, data)